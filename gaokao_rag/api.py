@@ -1,16 +1,33 @@
 # ---------- BEGIN gaokao_rag/api.py ----------
-from fastapi import FastAPI, BackgroundTasks, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, BackgroundTasks, Depends, Header, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 import json, time
-from typing import List, Dict, Any
-from .retriever import build_index, query
+from typing import List, Dict, Any, Optional
+from . import retriever
+from .retriever import build_index, sync_index, query, query_batch
+from .batcher import MicroBatcher
+from .cfg import CFG
+from .runtime import RUNTIME
+from . import embed, hub, metrics, neardup, profiling, versions
+from .filters import normalize as normalize_filters
 
 # --- Pydantic Models for the new API ---
+class MatchFilters(BaseModel):
+    difficulty: Optional[List[Optional[float]]] = Field(default=None, min_length=2, max_length=2,
+                                                        description="难度区间 [最小, 最大]（含端点），null 表示不限")
+    year: Optional[List[int]] = Field(default=None, description="年份，命中任一即可")
+    topic: Optional[List[str]] = Field(default=None, description="知识点名称或 id，命中任一即可")
+
+    def spec(self) -> dict:
+        return self.model_dump(exclude_none=True)
+
 class MatchRequest(BaseModel):
     query_stem: str = Field(..., description="需要匹配的题目文本，可以包含 LaTeX 公式")
     top_k: int = Field(default=5, ge=1, le=50, description="期望返回的最相似题目的数量")
+    filters: Optional[MatchFilters] = Field(default=None, description="元数据过滤，在向量检索阶段生效")
 
 class MatchedProblem(BaseModel):
     id: str = Field(..., description="匹配到的题目的唯一ID")
@@ -19,6 +36,15 @@ class MatchedProblem(BaseModel):
 
 class MatchResponse(BaseModel):
     matched_problems: List[MatchedProblem] = Field(..., description="匹配到的题目列表")
+    profile: Optional[Dict[str, Any]] = Field(default=None, description="仅在管理员请求剖析时返回：各阶段耗时与采样结果")
+
+class BatchMatchRequest(BaseModel):
+    query_stems: List[str] = Field(..., min_length=1, max_length=1000, description="需要批量匹配的题目文本列表")
+    top_k: int = Field(default=5, ge=1, le=50, description="每道题期望返回的最相似题目的数量")
+    filters: Optional[MatchFilters] = Field(default=None, description="对每道题都生效的元数据过滤")
+
+class BatchMatchResponse(BaseModel):
+    results: List[MatchResponse] = Field(..., description="与 query_stems 一一对应（顺序一致）的匹配结果")
 # --- End Pydantic Models ---
 
 app = FastAPI(title="Gaokao-RAG")
@@ -32,17 +58,90 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有头
 )
 
+# --- 动态微批调度 ---
+BATCHER = None
+if CFG.batching.get("enabled", True):
+    BATCHER = MicroBatcher(query_batch,
+                           window_ms=CFG.batching.get("window_ms", 5),
+                           max_batch=CFG.batching.get("max_batch", 32))
+
+def _filters(filters: Optional[MatchFilters]):
+    """Validated, normalized filter (None = unfiltered); malformed filters are a 400."""
+    try:
+        return normalize_filters(filters.spec()) if filters is not None else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _require_admin(x_admin_token: str | None = Header(default=None)):
+    """Admin-only endpoints (import / sync / warmup / unload) need X-Admin-Token; 403 otherwise."""
+    if not profiling.authorized(x_admin_token):
+        raise HTTPException(status_code=403, detail="this endpoint requires a valid X-Admin-Token "
+                                                    "(profiling.admin_token or GAOKAO_ADMIN_TOKEN)")
+
+def _profile_requested(raw: Request, profile: bool) -> bool:
+    """`?profile=1` or `X-Profile: 1`; only honoured with a valid X-Admin-Token (403 otherwise)."""
+    if not (profile or raw.headers.get("x-profile", "").lower() in ("1", "true", "yes")):
+        return False
+    if not profiling.authorized(raw.headers.get("x-admin-token")):
+        raise HTTPException(status_code=403, detail="profiling requires a valid X-Admin-Token")
+    return True
+
+async def _query_async(stem: str, k: int | None, f=None):
+    """Runs query() off the event loop, coalesced with concurrent requests when batching is on."""
+    k = k or CFG.topk_return
+    if BATCHER is not None:
+        return await BATCHER.submit(stem, k, f)
+    return await run_in_threadpool(query, stem, k, f)
+
+# --- 预热：模型 / 数据 / 索引默认在首个请求时才加载 ---
+if CFG.base.get("runtime", {}).get("warmup_on_start", False):
+    @app.on_event("startup")
+    async def _warmup_on_start():
+        await run_in_threadpool(RUNTIME.warmup)
+
+@app.post("/warmup", dependencies=[Depends(_require_admin)])
+async def warmup():
+    return await run_in_threadpool(RUNTIME.warmup)
+
+@app.post("/models/unload", dependencies=[Depends(_require_admin)])
+def unload_models(name: str | None = None):
+    """Releases one model (or all of them); it is reloaded on the next request that needs it."""
+    return {"unloaded": hub.unload(name)}
+
 # --- health ---
 @app.get("/health")
 def health():
-    return {"status": "ok", "ts": time.time()}
+    info = {"status": "ok", "ts": time.time(), "runtime": RUNTIME.status(),
+            "models": hub.loaded_models(), "index_versions": versions.status()}
+    if BATCHER is not None:
+        info["batching"] = BATCHER.stats()
+    if retriever.RESULT_CACHE is not None:
+        info["result_cache"] = retriever.RESULT_CACHE.stats()
+    if embed.FORMULA_CACHE is not None:
+        info["formula_cache"] = embed.FORMULA_CACHE.stats()
+    info["near_duplicate"] = neardup.stats(RUNTIME.get("neardup") if RUNTIME.is_loaded("neardup") else None)
+    return info
+
+# --- Prometheus ---
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Stage latency histograms, candidate counts, index size and load times (Prometheus text format)."""
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="metrics are disabled (metrics.enabled in conf/base.yaml)")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # --- import (后台任务) ---
-@app.post("/import")
+@app.post("/import", dependencies=[Depends(_require_admin)])
 def import_data(bg: BackgroundTasks):
     bg.add_task(build_index)
     return JSONResponse({"msg": "import started"}, status_code=202)
 
+# --- sync (后台任务，只处理增量) ---
+@app.post("/sync", dependencies=[Depends(_require_admin)])
+def sync_data(bg: BackgroundTasks):
+    bg.add_task(sync_index)
+    return JSONResponse({"msg": "sync started"}, status_code=202)
+
 # --- query ---
 class Q(BaseModel):
     stem: str
@@ -55,66 +154,81 @@ def _as_stream(items):
 
 @app.post("/query")
 async def api_query(q: Q):
-    data = query(q.stem, q.topk)
+    data = await _query_async(q.stem, q.topk)
     return StreamingResponse(_as_stream(data),
                              media_type="application/json")
 
+def _to_match_response(retrieved_items) -> MatchResponse:
+    """Converts query() result dicts into a MatchResponse, skipping malformed items."""
+    matched_problems_list: List[MatchedProblem] = []
+    # 假设 retrieved_items 是一个可迭代对象，每个 item 是一个字典
+    # 例如: {'id': 'some_id', 'score': 0.95, 'stem': '题干内容', 'source': ...}
+    
+    # 临时记录第一个item的结构，便于调试（如果需要）
+    # first_item_for_debug = next(iter(retrieved_items), None)
+    # if first_item_for_debug:
+    #     print(f"DEBUG: First item from query(): {first_item_for_debug}")
+    # # 注意：如果retrieved_items是生成器，上面这行会消耗第一个元素。
+    # # 如果需要重新迭代，可能需要再次调用 query() 或将其转为list。
+    # # 为安全起见，实际处理时，我们直接迭代。
+
+    processed_items_count = 0
+    for item in retrieved_items:
+        processed_items_count += 1
+        if not isinstance(item, dict):
+            print(f"Skipping item, not a dictionary: {item}")
+            continue
+
+        problem_id = item.get('id')
+        problem_score = item.get('score')
+        problem_stem = item.get('stem')
+
+        # 确保基本字段存在且类型可转换
+        if problem_id is not None and problem_score is not None and problem_stem is not None:
+            try:
+                matched_problems_list.append(
+                    MatchedProblem(
+                        id=str(problem_id),
+                        stem=str(problem_stem),
+                        score=float(problem_score)
+                    )
+                )
+            except ValueError as e:
+                print(f"Skipping item due to value conversion error: {item}, error: {e}")
+        else:
+            print(f"Skipping item due to missing id, score, or stem: {item}")
+    
+    # 调试信息：如果处理后列表为空但确实有检索到内容
+    if not matched_problems_list and processed_items_count > 0:
+        # 为了获取第一个元素用于调试而不影响主逻辑，可以再次调用 query
+        # 或者在开发阶段将 retrieved_items 转为 list。
+        # 这里我们只打印一个通用警告。
+        print(f"Warning: No problems could be formatted. Processed {processed_items_count} items from query(). Check item structure and keys ('id', 'score', 'stem').")
+
+    return MatchResponse(matched_problems=matched_problems_list)
+
 # --- New API Endpoint: Match Problems ---
-@app.post("/api/v1/match_problems", response_model=MatchResponse, tags=["Problem Matching"])
-async def match_similar_problems(request: MatchRequest):
+@app.post("/api/v1/match_problems", response_model=MatchResponse, response_model_exclude_none=True,
+          tags=["Problem Matching"])
+async def match_similar_problems(request: MatchRequest, raw: Request, profile: bool = False):
     """
     根据输入的题目信息，匹配并返回最相似的 K 道题目。
+    管理员可加 `?profile=1` (或请求头 `X-Profile: 1`) 与 `X-Admin-Token`，
+    该请求将绕过微批与结果缓存单独执行，并在响应中附带采样剖析结果。
     """
+    f = _filters(request.filters)
+    profiled = _profile_requested(raw, profile)
     try:
-        retrieved_items = query(request.query_stem, request.top_k)
-
-        matched_problems_list: List[MatchedProblem] = []
-        # 假设 retrieved_items 是一个可迭代对象，每个 item 是一个字典
-        # 例如: {'id': 'some_id', 'score': 0.95, 'stem': '题干内容', 'source': ...}
-        
-        # 临时记录第一个item的结构，便于调试（如果需要）
-        # first_item_for_debug = next(iter(retrieved_items), None)
-        # if first_item_for_debug:
-        #     print(f"DEBUG: First item from query(): {first_item_for_debug}")
-        # # 注意：如果retrieved_items是生成器，上面这行会消耗第一个元素。
-        # # 如果需要重新迭代，可能需要再次调用 query() 或将其转为list。
-        # # 为安全起见，实际处理时，我们直接迭代。
-
-        processed_items_count = 0
-        for item in retrieved_items:
-            processed_items_count += 1
-            if not isinstance(item, dict):
-                print(f"Skipping item, not a dictionary: {item}")
-                continue
-
-            problem_id = item.get('id')
-            problem_score = item.get('score')
-            problem_stem = item.get('stem')
-
-            # 确保基本字段存在且类型可转换
-            if problem_id is not None and problem_score is not None and problem_stem is not None:
-                try:
-                    matched_problems_list.append(
-                        MatchedProblem(
-                            id=str(problem_id),
-                            stem=str(problem_stem),
-                            score=float(problem_score)
-                        )
-                    )
-                except ValueError as e:
-                    print(f"Skipping item due to value conversion error: {item}, error: {e}")
-            else:
-                print(f"Skipping item due to missing id, score, or stem: {item}")
-        
-        # 调试信息：如果处理后列表为空但确实有检索到内容
-        if not matched_problems_list and processed_items_count > 0:
-            # 为了获取第一个元素用于调试而不影响主逻辑，可以再次调用 query
-            # 或者在开发阶段将 retrieved_items 转为 list。
-            # 这里我们只打印一个通用警告。
-            print(f"Warning: No problems could be formatted. Processed {processed_items_count} items from query(). Check item structure and keys ('id', 'score', 'stem').")
+        if profiled:
+            retrieved_items, report = await run_in_threadpool(
+                profiling.profile_call, query, request.query_stem, request.top_k, f, cache=False)
+            response = _to_match_response(retrieved_items)
+            response.profile = report
+            return response
 
+        retrieved_items = await _query_async(request.query_stem, request.top_k, f)
 
-        return MatchResponse(matched_problems=matched_problems_list)
+        return _to_match_response(retrieved_items)
 
     except Exception as e:
         print(f"Error during matching problems: {e}") # 临时打印
@@ -122,4 +236,17 @@ async def match_similar_problems(request: MatchRequest):
         # import traceback
         # print(traceback.format_exc())
         raise HTTPException(status_code=500, detail="Internal server error while matching problems.")
+
+@app.post("/api/v1/match_problems:batch", response_model=BatchMatchResponse, tags=["Problem Matching"])
+async def match_similar_problems_batch(request: BatchMatchRequest):
+    """
+    批量匹配：一次编码、一次向量检索、一次重排，结果顺序与 query_stems 一致。
+    """
+    f = _filters(request.filters)
+    try:
+        batched = await run_in_threadpool(query_batch, request.query_stems, request.top_k, f)
+        return BatchMatchResponse(results=[_to_match_response(items) for items in batched])
+    except Exception as e:
+        print(f"Error during batch matching problems: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error while matching problems.")
 # ----------  END  gaokao_rag/api.py ----------
\ No newline at end of file
@@ -0,0 +1,110 @@
+# gaokao_rag/batcher.py
+"""
+Dynamic micro-batching for the FastAPI app.
+
+Requests that arrive within `window_ms` of each other (up to `max_batch`) are
+coalesced and run as one `query_batch` call in a worker thread, so the event
+loop never blocks and concurrent users share one forward pass.
+"""
+import asyncio
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+
+
+class MicroBatcher:
+    """Coalesces (stem, k, filters) requests and resolves each caller's own future."""
+
+    def __init__(self, batch_fn: Callable[[List[str], int, List[Any]], List[Any]],
+                 window_ms: float = 5.0, max_batch: int = 32):
+        """
+        Args:
+            batch_fn: Blocking function (stems, k, filters) -> one result list per
+                      stem (filters: one per stem), e.g. retriever.query_batch.
+            window_ms: How long the first request of a batch waits for company.
+            max_batch: Upper bound on the number of stems per batch.
+        """
+        self.batch_fn = batch_fn
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        # 模型推理串行执行：一个工作线程，批与批之间自然排队
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="microbatch")
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+        self.batch_sizes: Counter = Counter()
+        self._waits_ms: deque = deque(maxlen=2048)
+        self.n_requests = 0
+        self.n_batches = 0
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, stem: str, k: int, filters=None):
+        """Queues one request and waits for its slice of the batched result."""
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((stem, k, filters, fut, time.perf_counter()))
+        return await fut
+
+    async def _collect(self) -> List[Tuple[str, int, Any, asyncio.Future, float]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.perf_counter()
+            for *_, enq in batch:
+                self._waits_ms.append((started - enq) * 1000.0)
+            self.batch_sizes[len(batch)] += 1
+            self.n_batches += 1
+            self.n_requests += len(batch)
+
+            stems = [stem for stem, *_ in batch]
+            k_max = max(k for _, k, *_ in batch)
+            fs = [f for _, _, f, *_ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self.batch_fn, stems, k_max, fs)
+            except Exception as e:
+                for *_, fut, _ in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            # 每个请求按各自的 k 截断（排序是逐条查询独立的，截断等价于单独查询）
+            for (_, k, _, fut, _), res in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(res[:k])
+
+    def stats(self) -> dict:
+        waits = np.asarray(self._waits_ms) if self._waits_ms else np.zeros(1)
+        return {
+            "window_ms": self.window * 1000.0,
+            "max_batch": self.max_batch,
+            "requests": self.n_requests,
+            "batches": self.n_batches,
+            "mean_batch_size": self.n_requests / self.n_batches if self.n_batches else 0.0,
+            "batch_size_hist": {str(n): c for n, c in sorted(self.batch_sizes.items())},
+            "queue_wait_ms": {
+                "p50": float(np.percentile(waits, 50)),
+                "p95": float(np.percentile(waits, 95)),
+                "max": float(waits.max()),
+            },
+        }
@@ -0,0 +1,371 @@
+# gaokao_rag/bench.py
+"""
+End-to-end benchmark (`ragmath bench`).
+
+Generates a synthetic Gaokao-style corpus (Chinese stems with `$$…$$` LaTeX,
+difficulty / years / knowledge points like data/df_gk_math.xlsx) and runs the
+real pipeline on it inside a scratch workspace: corpus, snapshot, caches and
+FAISS index versions all live in `--workdir`, so models/ and data/ are never
+touched. With `--models tiny` (default) the encoders and the reranker are
+small numpy stand-ins (character n-gram hashing), so the benchmark runs
+anywhere in seconds and measures the pipeline itself; `--models configured`
+uses the models from conf/model.yaml.
+
+Measured: encode throughput (encode_batch and single-stem encode), build_index
+time, ANN recall@k against an exact IndexFlatIP, per-stage query latency
+(encode / search / rerank / scoring, p50/p95/p99) and HTTP throughput against
+api.app at several concurrency levels (in-process, through httpx's ASGI
+transport). The report is one JSON document, so runs can be diffed.
+"""
+import asyncio
+import copy
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from .cfg import CFG, ROOT, _load_yaml
+from .runtime import RUNTIME
+
+# ---- synthetic corpus ----
+# (知识点, 知识点 id, 题型, 模板)；@a @b @c 换成随机整数
+_TEMPLATES = [
+    ("交集的概念及运算", "10455", "单选题",
+     "已知集合$$A=\\left\\{x\\left| x^{2}-@ax+@b<0\\right.\\right\\}$$，$$B=\\left\\{x\\left| x>@c\\right.\\right\\}$$，则$$A\\cap B=$$（　　）"),
+    ("交集的概念及运算", "10455", "单选题",
+     "设集合$$M=\\{x\\mid \\left| x-@a\\right|\\leqslant @b\\}$$，$$N=\\{x\\mid x<@c\\}$$，则$$M\\cap N$$等于（　　）"),
+    ("余弦定理解三角形", "11821", "解答题",
+     "在$$\\triangle ABC$$中，角$$A$$，$$B$$，$$C$$所对的边分别为$$a$$，$$b$$，$$c$$，已知$$a=@a$$，$$b=@b$$，$$\\cos C=\\dfrac{1}{@c}$$。（1）求$$c$$的值；（2）求$$\\sin A$$的值。"),
+    ("辅助角公式", "12034", "解答题",
+     "已知函数$$f(x)=@a\\sin \\left(@bx+\\dfrac{\\pi }{@c}\\right)$$，求$$f(x)$$的最小正周期及单调递增区间，并求$$f(x)$$在区间$$\\left[0,\\dfrac{\\pi }{2}\\right]$$上的最大值。"),
+    ("等差数列的通项公式", "10873", "填空题",
+     "已知等差数列$$\\left\\{ a_{n} \\right\\}$$的前$$n$$项和为$$S_{n}$$，若$$a_{@a}=@b$$，$$S_{@c}=@b@a$$，则公差$$d=$$______。"),
+    ("等比数列的前n项和", "10891", "解答题",
+     "已知数列$$\\left\\{ a_{n} \\right\\}$$满足$$a_{1}=@a$$，$$a_{n+1}=@ba_{n}+@c$$，证明数列$$\\left\\{ a_{n}+\\dfrac{@c}{@b-1} \\right\\}$$是等比数列，并求$$\\left\\{ a_{n} \\right\\}$$的前$$n$$项和$$S_{n}$$。"),
+    ("利用导数研究函数的单调性", "11356", "解答题",
+     "已知函数$$f(x)=x^{3}-@ax^{2}+@bx-@c$$。（1）求曲线$$y=f(x)$$在点$$(1,f(1))$$处的切线方程；（2）讨论$$f(x)$$的单调性；（3）若$$f(x)\\geqslant 0$$在$$[@a,+\\infty)$$上恒成立，求实数$$@c$$的取值范围。"),
+    ("椭圆的标准方程", "11602", "解答题",
+     "已知椭圆$$C:\\dfrac{x^{2}}{@a}+\\dfrac{y^{2}}{@b}=1$$的离心率为$$\\dfrac{\\sqrt{@c}}{@a}$$，过右焦点$$F$$的直线$$l$$与$$C$$交于$$A$$，$$B$$两点，求$$\\triangle OAB$$面积的最大值。"),
+    ("古典概型的概率计算", "12201", "单选题",
+     "从$$@a$$名男生和$$@b$$名女生中任选$$@c$$人参加志愿活动，则选中的人中至少有$$1$$名女生的概率为（　　）"),
+    ("根据循环结构框图计算输出结果", "12560", "单选题",
+     "执行如图所示的程序框图，若输入的$$k=@a$$，$$s=@b$$，则输出的$$s$$值为（　　）[图片:https://img.example.com/@c.png]"),
+    ("复数的除法运算", "10517", "单选题",
+     "已知$$i$$为虚数单位，则$$\\dfrac{@a+@bi}{@c-i}=$$（　　）"),
+    ("空间向量求线面角", "11958", "解答题",
+     "如图，在四棱锥$$P-ABCD$$中，$$PA\\perp$$平面$$ABCD$$，底面是边长为$$@a$$的正方形，$$PA=@b$$，$$E$$为$$PD$$的中点。（1）证明：$$PB\\parallel$$平面$$AEC$$；（2）求直线$$PC$$与平面$$AEC$$所成角的正弦值（精确到$$0.@c$$）。"),
+]
+_FILLERS = ["", "", "（本小题满分12分）", "请说明理由。", "（结果用分数表示）", "下列说法正确的是"]
+
+
+def synthetic_corpus(n: int, seed: int = 0, start_id: int = 1963669329338368) -> pd.DataFrame:
+    """`n` synthetic problems with the columns of data/df_gk_math.xlsx that the pipeline reads."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for j in range(n):
+        kpoint, kpoint_id, qtype, tpl = _TEMPLATES[int(rng.integers(len(_TEMPLATES)))]
+        stem = tpl
+        for key in ("@a", "@b", "@c"):
+            stem = stem.replace(key, str(int(rng.integers(2, 30))))
+        stem += _FILLERS[int(rng.integers(len(_FILLERS)))]
+        first = int(rng.integers(2015, 2025))
+        years = sorted({first, *rng.integers(first, 2026, size=int(rng.integers(0, 4))).tolist()})
+        rows.append({"id": start_id + j, "stem": stem,
+                     "difficulty": round(float(rng.uniform(0.3, 0.95)), 3),
+                     "type": qtype, "kpoint_ids": kpoint_id, "kpoints": kpoint,
+                     "years": ", ".join(map(str, years))})
+    return pd.DataFrame(rows)
+
+
+# ---- tiny stand-in models ----
+def _grams(text: str, sizes: Sequence[int]) -> np.ndarray:
+    grams = [text[i:i + n] for n in sizes for i in range(max(len(text) - n + 1, 0))] or [text]
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint32, count=len(grams))
+
+
+class HashingEncoder:
+    """SentenceTransformer stand-in: signed character n-gram feature hashing into `dim` buckets."""
+
+    def __init__(self, dim: int, sizes: Sequence[int] = (1, 2, 3), salt: int = 0):
+        self.dim = dim
+        self.sizes = tuple(sizes)
+        self.salt = np.uint32(salt)
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _one(self, text: str) -> np.ndarray:
+        h = _grams(str(text), self.sizes) ^ self.salt
+        sign = np.where(h & np.uint32(1 << 31), -1.0, 1.0)
+        return np.bincount(h % self.dim, weights=sign, minlength=self.dim).astype(np.float32)
+
+    def encode(self, sentences, batch_size: int = 32, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, **_):
+        single = isinstance(sentences, str)
+        vecs = np.stack([self._one(s) for s in ([sentences] if single else sentences)]) \
+            if single or len(sentences) else np.zeros((0, self.dim), dtype=np.float32)
+        if normalize_embeddings:
+            vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        return vecs[0] if single else vecs
+
+
+class OverlapCrossEncoder:
+    """CrossEncoder stand-in: Dice coefficient of the character bigram sets of each pair."""
+
+    def predict(self, pairs, convert_to_numpy: bool = True, **_):
+        out = np.zeros(len(pairs), dtype=np.float32)
+        for i, (a, b) in enumerate(pairs):
+            ga, gb = set(_grams(str(a), (2,)).tolist()), set(_grams(str(b), (2,)).tolist())
+            out[i] = 2.0 * len(ga & gb) / max(len(ga) + len(gb), 1)
+        return out
+
+
+# ---- workspace ----
+MARKER = ".ragmath-bench"    # 标记工作区由 bench 创建，重跑时才允许清空
+_COMPONENTS = ("dims", "df", "records", "store", "neardup", "text_model", "math_model", "reranker")
+
+
+@contextmanager
+def workspace(workdir: Path, models: str = "tiny", factory: str | None = None, text_dim: int = 256,
+              math_dim: int = 128):
+    """
+    Points the process at `workdir`: FAISS store with its versions, corpus,
+    snapshot, embedding caches, near-duplicate index and slow-query log all
+    live there; the stem embedding cache and the result cache are off (every
+    query runs the models). Configuration and runtime components are restored
+    on exit.
+    """
+    from . import embed, retriever
+    from .cache import FormulaCache
+
+    saved_cfg = (copy.deepcopy(CFG.base), CFG.store, CFG.store_name, CFG.embed_dim)
+    saved_mod = (retriever.DATA_FILE_PATH, retriever.MANIFEST_PATH, retriever.RESULT_CACHE,
+                 retriever._STORE_VERSION, embed.FORMULA_CACHE)
+    saved_rt = {n: RUNTIME._objects.pop(n) for n in _COMPONENTS if n in RUNTIME._objects}
+    try:
+        store = _load_yaml(ROOT / "conf/faiss.yaml")     # 总是用本地 FAISS (Milvus 需要服务端)
+        store["index_path"] = str(workdir / "faiss_index.bin")
+        store.setdefault("versions", {})["dir"] = str(workdir / "index_versions")
+        if factory:
+            store.setdefault("index", {})["factory"] = factory
+        CFG.store, CFG.store_name = store, "faiss"
+        CFG.base["store"] = "faiss"
+        CFG.base.setdefault("neardup", {})["path"] = str(workdir / "neardup.npz")
+        CFG.base.setdefault("slow_query", {})["path"] = str(workdir / "slow_queries.jsonl")
+        CFG.cache.update(enabled=False, path=str(workdir / "embed_cache.sqlite"))
+        CFG.snapshot["dir"] = str(workdir / "snapshot")
+        CFG.encode["workers"] = 1       # 替身模型只存在于本进程
+        retriever.DATA_FILE_PATH = workdir / "corpus.xlsx"
+        retriever.MANIFEST_PATH = workdir / "index_manifest.json"
+        retriever.RESULT_CACHE = None
+        retriever._STORE_VERSION = None
+        if embed.FORMULA_CACHE is not None:
+            embed.FORMULA_CACHE = FormulaCache(embed.FORMULA_CACHE.lru_entries, persist=False)
+        if models == "tiny":
+            RUNTIME.set("text_model", HashingEncoder(text_dim, salt=0))
+            RUNTIME.set("math_model", HashingEncoder(math_dim, sizes=(1, 2, 3, 4), salt=0x9E3779B9))
+            RUNTIME.set("reranker", OverlapCrossEncoder())
+        yield
+    finally:
+        for n in _COMPONENTS:
+            RUNTIME.invalidate(n)
+        RUNTIME._objects.update(saved_rt)
+        CFG.base, CFG.store, CFG.store_name, CFG.embed_dim = saved_cfg
+        CFG.cache = CFG.base.get("cache", {})
+        CFG.snapshot = CFG.base.get("snapshot", {})
+        CFG.encode = CFG.base.get("encode", {}) or {}
+        (retriever.DATA_FILE_PATH, retriever.MANIFEST_PATH, retriever.RESULT_CACHE,
+         retriever._STORE_VERSION, embed.FORMULA_CACHE) = saved_mod
+
+
+# ---- measurements ----
+def percentiles(seconds: Sequence[float]) -> Dict[str, float]:
+    """Mean / p50 / p95 / p99 / max of `seconds`, in milliseconds."""
+    ms = np.asarray(seconds, dtype=np.float64) * 1000.0
+    if not len(ms):
+        return {"n": 0}
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99]).tolist()
+    return {"n": int(len(ms)), "mean": round(float(ms.mean()), 3), "p50": round(p50, 3),
+            "p95": round(p95, 3), "p99": round(p99, 3), "max": round(float(ms.max()), 3)}
+
+
+def bench_encode(stems: List[str], batch_size: int, single: int) -> dict:
+    from .embed import encode, encode_batch, ensure_dims, formula_counters, formula_report
+    ensure_dims()
+    before = formula_counters()
+    t0 = time.perf_counter()
+    encode_batch(stems, batch_size=batch_size)
+    batch_s = time.perf_counter() - t0
+    times = []
+    for stem in stems[:single]:
+        t0 = time.perf_counter()
+        encode(stem)
+        times.append(time.perf_counter() - t0)
+    return {"stems": len(stems), "batch_size": batch_size, "dim": CFG.embed_dim,
+            "batch_seconds": round(batch_s, 4), "batch_stems_per_s": round(len(stems) / max(batch_s, 1e-9), 1),
+            "single_stems_per_s": round(len(times) / max(sum(times), 1e-9), 1),
+            "single_latency_ms": percentiles(times), "formula_cache": formula_report(before)}
+
+
+def bench_build() -> dict:
+    from . import retriever
+    t0 = time.perf_counter()
+    retriever.build_index(workers=1)
+    seconds = time.perf_counter() - t0
+    store = retriever.current_store()
+    n = store.count()
+    return {"items": n, "seconds": round(seconds, 3), "items_per_s": round(n / max(seconds, 1e-9), 1),
+            "factory": store.factory_in_use, "memory": store.memory_report()}
+
+
+def bench_recall(corpus_vecs: np.ndarray, query_vecs: np.ndarray, k: int) -> dict:
+    """recall@k of the serving index against exact inner-product search over the same vectors."""
+    import faiss
+    from . import retriever
+    exact = faiss.IndexFlatIP(corpus_vecs.shape[1])
+    exact.add(np.ascontiguousarray(corpus_vecs, dtype=np.float32))
+    _, truth = exact.search(np.ascontiguousarray(query_vecs, dtype=np.float32), k)
+    ids = retriever.RUNTIME.get("df").index.to_numpy()
+    t0 = time.perf_counter()
+    hits = retriever.current_store().search_batch(query_vecs, k)
+    search_s = time.perf_counter() - t0
+    recall = [len(set(got) & set(ids[row[row >= 0]].tolist())) / k for (got, _), row in zip(hits, truth)]
+    return {"k": k, "queries": len(query_vecs), "recall_at_k": round(float(np.mean(recall)), 4),
+            "min_recall": round(float(np.min(recall)), 4),
+            "batch_search_queries_per_s": round(len(query_vecs) / max(search_s, 1e-9), 1)}
+
+
+def bench_stages(stems: List[str], k: int) -> dict:
+    """Per-stage latency of the single-query model path (retriever._query_uncached without the fast path)."""
+    from . import retriever
+    from .embed import encode
+    stages = {"encode": [], "search": [], "rerank": [], "scoring": [], "total": []}
+    candidates = []
+    store = retriever.current_store()
+    for stem in stems:
+        t0 = time.perf_counter()
+        qv = encode(stem)
+        t1 = time.perf_counter()
+        cand_ids, ann = store.search(qv, CFG.topk_recall)
+        t2 = time.perf_counter()
+        q = retriever._rerank_input(stem, qv, cand_ids, ann)
+        [(scored, scores)], _ = retriever._rerank([q], k)
+        t3 = time.perf_counter()
+        retriever._finalize(scored, scores, k)
+        t4 = time.perf_counter()
+        for name, dt in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t4 - t0)):
+            stages[name].append(dt)
+        candidates.append(len(cand_ids))
+    return {"queries": len(stems), "k": k, "recall_k": CFG.topk_recall,
+            "mean_candidates": round(float(np.mean(candidates)), 1) if candidates else 0.0,
+            "latency_ms": {name: percentiles(v) for name, v in stages.items()}}
+
+
+async def _http_level(client, stems: List[str], requests: int, concurrency: int, k: int) -> dict:
+    latencies, errors = [], 0
+    next_i = 0
+
+    async def worker():
+        nonlocal next_i, errors
+        while next_i < requests:
+            i = next_i
+            next_i += 1
+            t0 = time.perf_counter()
+            r = await client.post("/api/v1/match_problems", json={"query_stem": stems[i % len(stems)], "top_k": k})
+            latencies.append(time.perf_counter() - t0)
+            errors += r.status_code != 200
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - t0
+    return {"concurrency": concurrency, "requests": requests, "errors": errors, "seconds": round(seconds, 3),
+            "requests_per_s": round(requests / max(seconds, 1e-9), 1), "latency_ms": percentiles(latencies)}
+
+
+def bench_http(stems: List[str], levels: Sequence[int], requests: int, k: int) -> dict:
+    """Requests/s and latency of POST /api/v1/match_problems at each concurrency level."""
+    try:
+        import httpx
+    except ImportError:
+        return {"skipped": "httpx is not installed (pip install -e .[bench])"}
+    from . import api
+
+    async def run():
+        out = []
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+            await client.post("/api/v1/match_problems", json={"query_stem": stems[0], "top_k": k})   # 预热
+            for c in levels:
+                out.append(await _http_level(client, stems, requests, c, k))
+                print(f"[bench] http concurrency={c}: {out[-1]['requests_per_s']} req/s, "
+                      f"p99 {out[-1]['latency_ms'].get('p99')} ms")
+        return out
+
+    return {"endpoint": "/api/v1/match_problems", "transport": "in-process ASGI",
+            "batching": api.BATCHER is not None, "levels": asyncio.run(run())}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(size: int = 2000, queries: int = 200, k: int = 10, models: str = "tiny", factory: str | None = None,
+        concurrency: Sequence[int] = (1, 4, 16), requests: int = 200, seed: int = 0,
+        workdir: str | None = None, keep: bool = False, http: bool = True) -> dict:
+    """Runs every benchmark on a fresh synthetic corpus and returns the report."""
+    import faiss
+    work = Path(workdir) if workdir else Path(tempfile.mkdtemp(prefix="ragmath-bench-"))
+    if work.exists() and any(work.iterdir()):
+        if not (work / MARKER).exists():
+            raise ValueError(f"{work} is not empty and was not created by `ragmath bench`; pick another --workdir.")
+        shutil.rmtree(work)     # 上一次 --keep 留下的工作区
+    work.mkdir(parents=True, exist_ok=True)
+    (work / MARKER).touch()
+    report = {"meta": {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": _git_commit(),
+                       "size": size, "queries": queries, "k": k, "seed": seed, "models": models,
+                       "python": platform.python_version(), "numpy": np.__version__,
+                       "faiss": getattr(faiss, "__version__", None), "cpu_count": os.cpu_count(),
+                       "device": CFG.device}}
+    try:
+        with workspace(work, models=models, factory=factory):
+            from . import retriever
+            from .embed import encode_batch
+            t0 = time.perf_counter()
+            corpus = synthetic_corpus(size, seed)
+            corpus.to_excel(retriever.DATA_FILE_PATH, index=False)
+            query_stems = synthetic_corpus(queries, seed + 1)["stem"].tolist()   # 同模板、不同数字
+            report["meta"]["corpus_seconds"] = round(time.perf_counter() - t0, 3)
+            retriever.load_dataframe()
+            stems = corpus["stem"].tolist()
+
+            print(f"[bench] encode: {size} stems")
+            report["encode"] = bench_encode(stems, CFG.encode_batch_size, min(queries, size))
+            print(f"[bench] build_index: {size} items")
+            report["build_index"] = bench_build()
+            report["meta"]["factory"] = report["build_index"]["factory"]
+            print(f"[bench] recall@{k} vs IndexFlatIP")
+            report["recall"] = bench_recall(encode_batch(stems, batch_size=CFG.encode_batch_size),
+                                            encode_batch(query_stems, batch_size=CFG.encode_batch_size), k)
+            print(f"[bench] per-stage latency: {queries} queries")
+            report["query"] = bench_stages(query_stems, k)
+            if http:
+                print(f"[bench] http: {requests} requests × concurrency {list(concurrency)}")
+                report["http"] = bench_http(query_stems, concurrency, requests, k)
+    finally:
+        if not keep:
+            shutil.rmtree(work, ignore_errors=True)
+    report["meta"]["workdir"] = str(work) if keep else None
+    return report
@@ -0,0 +1,364 @@
+# gaokao_rag/cache.py
+"""
+On-disk, content-addressed embedding cache (SQLite).
+
+Key = sha256(model identity + stem text). The model identity is derived from
+the `repo`/`local` (and non-torch `backend`) entries in conf/model.yaml, so
+swapping a model changes every key; stale rows of a namespace are dropped the
+first time the process opens it. The database runs in WAL mode with a busy
+timeout, so readers never block on a concurrent import writing the same file.
+
+FormulaCache keeps per-formula math-model vectors (namespace `formula`, keyed
+by the canonical LaTeX form from formula.canonicalize) behind a bounded
+in-process LRU, so repeated formulas never reach MathBERTa twice. It holds one
+reader connection for the life of the process; new vectors and LRU touches
+are written by a background thread, so a query never waits on a write.
+"""
+import atexit
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from .cfg import CFG, ROOT
+from .formula import CANON_VERSION, canonicalize
+
+# 每个命名空间对应的模型组合：mixed = 文本+公式，text = 纯文本索引，formula = 单个公式
+NAMESPACE_MODELS = {
+    "mixed":   ("text", "math"),
+    "text":    ("text",),
+    "formula": ("math",),
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS emb (
+    key        TEXT PRIMARY KEY,
+    ns         TEXT NOT NULL,
+    model_key  TEXT NOT NULL,
+    dim        INTEGER NOT NULL,
+    vec        BLOB NOT NULL,
+    last_used  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS emb_ns_model ON emb(ns, model_key);
+CREATE INDEX IF NOT EXISTS emb_last_used ON emb(last_used);
+"""
+
+
+def model_identity(namespace: str) -> str:
+    """Stable hash of the model entries (conf/model.yaml) used by a namespace."""
+    names = NAMESPACE_MODELS[namespace]
+    ident = {n: {k: CFG.model[n].get(k) for k in ("repo", "local", "revision")} for n in names}
+    for n in names:
+        # 非 torch 后端 (onnx / onnx-int8) 的向量与 torch 略有差异，单独成一组缓存
+        if CFG.model[n].get("backend", "torch") != "torch":
+            ident[n]["backend"] = CFG.model[n]["backend"]
+    if "math" in names:
+        ident["canon"] = CANON_VERSION      # 公式以规范化形式送进模型
+    return hashlib.sha256(json.dumps(ident, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def content_key(model_key: str, stem: str) -> str:
+    return hashlib.sha256(f"{model_key}\0{stem}".encode("utf-8")).hexdigest()
+
+
+def _cache_path() -> Path:
+    p = CFG.cache.get("path", "models/embed_cache.sqlite")
+    return Path(p) if os.path.isabs(p) else ROOT / p
+
+
+# (path, namespace, model_key) 已建表并清理过旧模型行的组合：每个进程只做一次
+_PREPARED: set = set()
+_PREPARED_LOCK = threading.Lock()
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    """WAL-mode connection: readers and the single writer do not block each other."""
+    conn = sqlite3.connect(str(path), timeout=float(CFG.cache.get("busy_timeout_s", 30)),
+                           check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")     # WAL 下提交不再逐次 fsync，只在检查点时落盘
+    return conn
+
+
+class EmbedCache:
+    """SQLite-backed vector cache for one namespace with LRU, size-bounded eviction."""
+
+    def __init__(self, namespace: str = "mixed", path: str | None = None,
+                 max_entries: int | None = None):
+        self.namespace = namespace
+        self.model_key = model_identity(namespace)
+        self.path = Path(path) if path else _cache_path()
+        self.max_entries = max_entries if max_entries is not None else CFG.cache.get("max_entries", 500000)
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = _connect(self.path)
+        key = (str(self.path.resolve()), self.namespace, self.model_key)
+        with _PREPARED_LOCK:
+            if key not in _PREPARED:
+                self.conn.executescript(_SCHEMA)
+                # 模型换了 → 同命名空间下旧模型的向量全部作废
+                cur = self.conn.execute("DELETE FROM emb WHERE ns = ? AND model_key != ?",
+                                        (self.namespace, self.model_key))
+                if cur.rowcount:
+                    print(f"[cache] dropped {cur.rowcount} stale '{self.namespace}' entries (model changed).")
+                self.conn.commit()
+                _PREPARED.add(key)
+
+    def keys_for(self, stems: List[str]) -> List[str]:
+        return [content_key(self.model_key, s) for s in stems]
+
+    def get_many(self, stems: List[str], touch: bool = True) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        """
+        Looks up cached vectors for `stems`; `touch=False` leaves last_used
+        alone (the caller records the hits with `touch` later).
+
+        Returns:
+            Tuple[Dict[int, np.ndarray], List[int]]: position → cached vector,
+            and the positions that missed.
+        """
+        keys = self.keys_for(stems)
+        found: Dict[str, np.ndarray] = {}
+        for i in range(0, len(keys), 500):   # SQLite 变量个数上限
+            chunk = keys[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for key, dim, blob in self.conn.execute(
+                    f"SELECT key, dim, vec FROM emb WHERE key IN ({marks})", chunk):
+                found[key] = np.frombuffer(blob, dtype=np.float32, count=dim)
+
+        hits, misses = {}, []
+        for pos, key in enumerate(keys):
+            if key in found:
+                hits[pos] = found[key]
+            else:
+                misses.append(pos)
+        if found and touch:
+            self.touch_keys(list(found))
+        self.hits += len(hits)
+        self.misses += len(misses)
+        return hits, misses
+
+    def touch_keys(self, keys: List[str]):
+        """Marks rows (by content key) as just used, for LRU eviction."""
+        now = time.time()
+        self.conn.executemany("UPDATE emb SET last_used = ? WHERE key = ?", [(now, k) for k in keys])
+        self.conn.commit()
+
+    def put_many(self, stems: List[str], vecs: np.ndarray):
+        if not stems:
+            return
+        now = time.time()
+        vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+        rows = [(k, self.namespace, self.model_key, int(v.shape[0]), v.tobytes(), now)
+                for k, v in zip(self.keys_for(stems), vecs)]
+        self.conn.executemany("INSERT OR REPLACE INTO emb VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self, max_entries: int | None = None) -> int:
+        """Drops least-recently-used rows until at most `max_entries` remain."""
+        limit = self.max_entries if max_entries is None else max_entries
+        total = self.conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+        excess = total - limit
+        if limit <= 0 or excess <= 0:
+            return 0
+        self.conn.execute("DELETE FROM emb WHERE key IN "
+                          "(SELECT key FROM emb ORDER BY last_used ASC LIMIT ?)", (excess,))
+        self.conn.commit()
+        return excess
+
+    def close(self):
+        self.conn.close()
+
+
+def stats(path: str | None = None) -> dict:
+    """Entry counts and sizes per namespace; flags rows from models no longer configured."""
+    p = Path(path) if path else _cache_path()
+    if not p.exists():
+        return {"path": str(p), "exists": False}
+    conn = _connect(p)
+    conn.executescript(_SCHEMA)
+    current = {ns: model_identity(ns) for ns in NAMESPACE_MODELS}
+    per_ns = {}
+    for ns, model_key, n, nbytes in conn.execute(
+            "SELECT ns, model_key, COUNT(*), SUM(LENGTH(vec)) FROM emb GROUP BY ns, model_key"):
+        d = per_ns.setdefault(ns, {"entries": 0, "stale": 0, "vector_bytes": 0})
+        d["entries"] += n
+        d["vector_bytes"] += nbytes or 0
+        if current.get(ns) != model_key:
+            d["stale"] += n
+    conn.close()
+    return {
+        "path": str(p),
+        "exists": True,
+        "file_bytes": p.stat().st_size,
+        "max_entries": CFG.cache.get("max_entries", 500000),
+        "namespaces": per_ns,
+    }
+
+
+def prune(max_entries: int | None = None, path: str | None = None) -> dict:
+    """Removes stale-model rows, evicts down to `max_entries` (LRU) and vacuums the file."""
+    p = Path(path) if path else _cache_path()
+    if not p.exists():
+        return {"path": str(p), "removed_stale": 0, "evicted": 0}
+    conn = _connect(p)
+    conn.executescript(_SCHEMA)
+    removed = 0
+    for ns in {r[0] for r in conn.execute("SELECT DISTINCT ns FROM emb")}:
+        if ns in NAMESPACE_MODELS:
+            cur = conn.execute("DELETE FROM emb WHERE ns = ? AND model_key != ?", (ns, model_identity(ns)))
+        else:
+            cur = conn.execute("DELETE FROM emb WHERE ns = ?", (ns,))
+        removed += cur.rowcount
+    conn.commit()
+    conn.close()
+
+    cache = EmbedCache("mixed", path=str(p), max_entries=max_entries)
+    evicted = cache.evict()
+    cache.conn.execute("VACUUM")
+    cache.close()
+    return {"path": str(p), "removed_stale": removed, "evicted": evicted}
+
+
+FORMULA_COUNTERS = ("lookups", "lru_hits", "disk_hits", "encoded")
+
+
+class FormulaCache:
+    """
+    Math-model vectors per canonical formula: a bounded in-process LRU in front
+    of the SQLite cache. Duplicates within one call are encoded once. Disk
+    lookups go through one long-lived connection; writes are queued for a
+    background writer thread (`flush()` waits for them).
+    """
+
+    def __init__(self, lru_entries: int = 50000, persist: bool = True):
+        self.lru_entries = lru_entries
+        self.persist = persist
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk: EmbedCache | None = None
+        self._disk_lock = threading.Lock()
+        self._writes: "queue.Queue" = queue.Queue()
+        self._writer: threading.Thread | None = None
+        if persist:
+            atexit.register(self.flush)     # 进程退出前写完排队中的向量
+        self.lookups = 0
+        self.lru_hits = 0
+        self.disk_hits = 0
+        self.encoded = 0    # 实际送进模型的 (去重后) 公式数
+
+    def encode(self, formulas: List[str], encoder: Callable[[List[str]], np.ndarray], dim: int) -> np.ndarray:
+        """Vectors for `formulas` (row i ↔ formulas[i]); `encoder` only sees canonical forms that missed."""
+        keys = [canonicalize(f) for f in formulas]
+        if not keys:
+            return np.zeros((0, dim), dtype=np.float32)
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for k in dict.fromkeys(keys):
+                v = self._lru.get(k)
+                if v is not None:
+                    self._lru.move_to_end(k)
+                    found[k] = v
+        from_lru = set(found)
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+
+        if missing and self.persist:
+            with self._disk_lock:
+                disk = self._reader()
+                hits, missing_pos = disk.get_many(missing, touch=False)
+            for pos, v in hits.items():
+                if v.shape[0] == dim:
+                    found[missing[pos]] = v
+                else:           # 维度对不上，当作未命中
+                    missing_pos.append(pos)
+            missing = [missing[p] for p in sorted(missing_pos)]
+        from_disk = set(found) - from_lru
+        fresh = None
+        if missing:
+            fresh = np.asarray(encoder(missing), dtype=np.float32).reshape(len(missing), dim)
+            found.update(zip(missing, fresh))
+        if self.persist and (from_disk or missing):
+            self._write_behind(list(from_disk), missing, fresh)
+
+        with self._lock:
+            for k, v in found.items():
+                self._lru[k] = v
+                self._lru.move_to_end(k)
+            while len(self._lru) > self.lru_entries:
+                self._lru.popitem(last=False)
+            self.lookups += len(keys)
+            self.lru_hits += sum(k in from_lru for k in keys)
+            self.disk_hits += sum(k in from_disk for k in keys)
+            self.encoded += len(missing)
+        return np.stack([found[k] for k in keys])
+
+    def _reader(self) -> EmbedCache:
+        if self._disk is None:
+            self._disk = EmbedCache("formula")
+        return self._disk
+
+    def _write_behind(self, touched: List[str], formulas: List[str], vecs: np.ndarray | None):
+        self._writes.put((touched, formulas, vecs))
+        if self._writer is None or not self._writer.is_alive():
+            with self._disk_lock:
+                if self._writer is None or not self._writer.is_alive():
+                    self._writer = threading.Thread(target=self._write_loop, name="formula-cache-writer",
+                                                    daemon=True)
+                    self._writer.start()
+
+    def _write_loop(self):
+        disk = EmbedCache("formula")    # 写连接只属于本线程
+        while True:
+            batch = [self._writes.get()]
+            while True:                 # 把排队中的写入合并成一次提交
+                try:
+                    batch.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                touched = [k for t, _, _ in batch for k in t]
+                if touched:
+                    disk.touch_keys(disk.keys_for(touched))
+                fresh = [(f, v) for _, fs, vs in batch if fs for f, v in zip(fs, vs)]
+                if fresh:
+                    disk.put_many([f for f, _ in fresh], np.stack([v for _, v in fresh]))
+            except sqlite3.Error as e:  # 缓存写失败只影响下次命中，不影响查询
+                print(f"[cache] formula cache write failed: {e}")
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    def flush(self):
+        """Blocks until every queued write has reached SQLite."""
+        if self._writer is not None:
+            self._writes.join()
+
+    def counters(self) -> Dict[str, int]:
+        return {c: getattr(self, c) for c in FORMULA_COUNTERS}
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> dict:
+        return {"lru_size": len(self._lru), "lru_entries": self.lru_entries,
+                "persist": self.persist, **formula_hit_rates(self.counters())}
+
+
+def formula_hit_rates(counters: Dict[str, int]) -> dict:
+    """Counters plus hit rates; `hit_rate` = share of formulas that did not reach the math model."""
+    n = counters.get("lookups", 0)
+    return {**counters,
+            "lru_hit_rate": counters.get("lru_hits", 0) / n if n else 0.0,
+            "disk_hit_rate": counters.get("disk_hits", 0) / n if n else 0.0,
+            "hit_rate": 1.0 - counters.get("encoded", 0) / n if n else 0.0}
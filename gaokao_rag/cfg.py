@@ -21,6 +21,14 @@ class Cfg:
         self.topk_return = self.base['topk']['return']
         self.diff_coeff  = self.base['difficulty']['coeff']
         self.store_name  = self.base['store']
+        self.encode_batch_size = self.base.get('encode', {}).get('batch_size', 64)
+        self.encode      = self.base.get('encode', {}) or {}
+        self.cache       = self.base.get('cache', {})
+        self.formula_cache = self.base.get('formula_cache', {}) or {}
+        self.batching    = self.base.get('batching', {})
+        self.result_cache = self.base.get('result_cache', {})
+        self.rerank      = self.base.get('rerank', {}) or {}
+        self.snapshot    = self.base.get('snapshot', {})
 
 # Determine the store config file name from base.yaml
 _base_config = _load_yaml(ROOT / 'conf/base.yaml')
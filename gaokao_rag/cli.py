@@ -5,19 +5,20 @@ from pathlib import Path # Added for path operations
 
 # Use a try-except block for retriever import for robustness during early setup
 try:
-    from .retriever import build_index, query, STORE, CFG # expose STORE and CFG for CLI access
+    from .retriever import build_index, sync_index, query, CFG # STORE is created lazily (retriever.STORE)
     if CFG.store_name == 'faiss':
         from .store.faiss import FaissStore
 except ImportError as e:
     print(f"Warning: Could not import from .retriever or .store: {e}")
     print("CLI functionality might be limited until project is fully set up and installed.")
     # Define dummy functions if import fails, so script can still be parsed by argparser
-    def build_index():
+    def build_index(workers=None):
         print("Error: build_index not available. Check project setup.")
-    def query(stem, k):
+    def sync_index():
+        print("Error: sync_index not available. Check project setup.")
+    def query(stem, k, filters=None):
         print("Error: query not available. Check project setup.")
         return []
-    STORE = None
     CFG = None
     FaissStore = None # Placeholder
 
@@ -25,44 +26,133 @@ def main():
     parser = argparse.ArgumentParser(description="Gaokao-RAG CLI for importing, querying, and managing indexes.")
     subparsers = parser.add_subparsers(dest="cmd", help="Available commands", required=True)
 
-    subparsers.add_parser("import-text",   help="只构建文本索引")
+    it = subparsers.add_parser("import-text",   help="只构建文本索引")
+    it.add_argument("--workers", type=int, default=None, help="编码进程数 (defaults to encode.workers in conf/base.yaml).")
     qt = subparsers.add_parser("query-text", help="纯文本相似度检索")
     qt.add_argument("stem"); qt.add_argument("-k", "--k", type=int, default=10)   # ★ 同时支持 -k/--k
 
     # Import command
     import_parser = subparsers.add_parser("import", help="Import data and build the index.")
-    # No arguments needed for import for now, but can be added later (e.g., --file)
+    import_parser.add_argument("--workers", type=int, default=None,
+                               help="Encode with N processes sharing a memory-mapped output (defaults to encode.workers).")
+
+    # Ingest command
+    ing = subparsers.add_parser("ingest", help="Streaming, resumable import: chunked encode + upsert with a checkpoint and reject file.")
+    ing.add_argument("--chunk-rows", type=int, default=None, help="Rows per chunk (defaults to ingest.chunk_rows).")
+    ing.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint and start from the first row.")
+
+    # Sync command
+    subparsers.add_parser("sync", help="Incrementally sync the index with the spreadsheet (only changed rows).")
 
     # Query command
     query_parser = subparsers.add_parser("query", help="Query for math problems.")
     query_parser.add_argument("stem", type=str, help="The math problem stem to query for.")
     query_parser.add_argument("-k", "--k", type=int, default=10, 
                               help="Number of results to return (defaults to config).")
+    query_parser.add_argument("--filters", type=str, default=None,
+                              help='Metadata filter as JSON, e.g. \'{"difficulty": [0.5, 0.9], "year": [2023], "topic": ["辅助角公式"]}\'.')
     
+    # Rerank report command
+    rr = subparsers.add_parser("rerank-report", help="Compare cascade reranking against full reranking.")
+    rr.add_argument("--queries", type=str, default=None,
+                    help="JSONL with {\"stem\": ..., \"relevant\": [ids]} per line. "
+                         "Defaults to a sample of indexed stems labelled with their own id.")
+    rr.add_argument("--sample", type=int, default=100, help="Number of indexed stems to sample without --queries.")
+    rr.add_argument("--margins", type=str, default="0.02,0.05,0.1", help="Comma-separated cascade margins.")
+    rr.add_argument("-k", "--k", type=int, default=None, help="Result size to compare (defaults to config).")
+
+    # Snapshot command
+    snap = subparsers.add_parser("snapshot", help="Convert the spreadsheet into the fast-loading binary snapshot.")
+    snap.add_argument("--source", type=str, default="data/df_gk_math.xlsx", help="Spreadsheet to convert.")
+
+    # Versions command
+    ver = subparsers.add_parser("versions", help="List, roll back or prune published FAISS index versions.")
+    ver.add_argument("action", choices=["list", "rollback", "prune"], nargs="?", default="list")
+    ver.add_argument("--to", type=str, default=None, help="rollback: version to activate (defaults to the previous one).")
+    ver.add_argument("--keep", type=int, default=None, help="prune: versions to keep (defaults to versions.keep in conf/faiss.yaml).")
+
+    # Warmup command
+    warm = subparsers.add_parser("warmup", help="Load models, data and stores now and report per-component load times.")
+    warm.add_argument("--only", type=str, default=None,
+                      help="Comma-separated components (df,records,text_model,math_model,reranker,store,text_store).")
+
+    # Models command
+    subparsers.add_parser("models", help="List configured models with their local path and on-disk size (loads nothing).")
+
+    # ONNX export / parity commands
+    ox = subparsers.add_parser("export-onnx", help="Export local models to ONNX (and dynamic int8) for backend: onnx|onnx-int8.")
+    ox.add_argument("--models", type=str, default="text,math,rerank", help="Comma-separated model names from conf/model.yaml.")
+    ox.add_argument("--no-int8", action="store_true", help="Skip the dynamically int8-quantized graph.")
+    op = subparsers.add_parser("onnx-parity", help="Compare an ONNX backend against torch (cosine deviation, top-k overlap).")
+    op.add_argument("--models", type=str, default="text,math,rerank", help="Comma-separated model names from conf/model.yaml.")
+    op.add_argument("--backend", choices=["onnx", "onnx-int8"], default="onnx-int8")
+    op.add_argument("--sample", type=int, default=200, help="Number of corpus stems to compare on.")
+    op.add_argument("-k", "--k", type=int, default=10, help="Top-k used for the ranking overlap.")
+
+    # Cache command
+    cache_parser = subparsers.add_parser("cache", help="Inspect or prune the on-disk embedding cache.")
+    cache_parser.add_argument("action", choices=["stats", "prune"], help="stats: 查看缓存; prune: 清理过期模型条目并按 LRU 淘汰")
+    cache_parser.add_argument("--max-entries", type=int, default=None,
+                              help="prune 后保留的最大条目数 (defaults to cache.max_entries in conf/base.yaml).")
+
+    # Benchmark command
+    bench = subparsers.add_parser("bench", help="End-to-end benchmark on a synthetic corpus (encode, build, recall, latency, HTTP).")
+    bench.add_argument("--size", type=int, default=2000, help="Number of synthetic problems in the corpus.")
+    bench.add_argument("--queries", type=int, default=200, help="Number of synthetic query stems.")
+    bench.add_argument("-k", "--k", type=int, default=10, help="k for recall@k and the query results.")
+    bench.add_argument("--models", choices=["tiny", "configured"], default="tiny",
+                       help="tiny: numpy stand-in encoders / reranker (no downloads); configured: conf/model.yaml.")
+    bench.add_argument("--factory", type=str, default=None, help="FAISS index factory (defaults to index.factory in conf/faiss.yaml).")
+    bench.add_argument("--concurrency", type=str, default="1,4,16", help="Comma-separated HTTP concurrency levels.")
+    bench.add_argument("--requests", type=int, default=200, help="HTTP requests per concurrency level.")
+    bench.add_argument("--no-http", action="store_true", help="Skip the HTTP throughput benchmark.")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--workdir", type=str, default=None, help="Scratch directory (defaults to a temporary one).")
+    bench.add_argument("--keep", action="store_true", help="Keep the scratch directory (corpus, index) after the run.")
+    bench.add_argument("--output", type=str, default=None,
+                       help="JSON report path (defaults to models/bench/bench-<timestamp>.json).")
+
     if FaissStore: # Only add dump/load if FaissStore is available
         dump_parser = subparsers.add_parser("dump", help="Dump the FAISS index and ID map to a file.")
         dump_parser.add_argument("--output-path", type=str, default="models/faiss_dump/gaokao_index.bin",
-                                 help="Base path to save the FAISS index and map. (e.g., my_index.bin will save my_index.bin and my_index.bin.map)")
+                                 help="Base path to save the FAISS index and ID table. (e.g., my_index.bin will save my_index.bin and my_index.bin.ids)")
 
         load_parser = subparsers.add_parser("load", help="Load a FAISS index and ID map from a file.")
         load_parser.add_argument("--input-path", type=str, default="models/faiss_dump/gaokao_index.bin",
-                                 help="Base path to load the FAISS index and map from.")
+                                 help="Base path to load the FAISS index and ID table (or legacy .map) from.")
+
+        conv_parser = subparsers.add_parser("convert-map", help="Convert a text <index>.map into the binary, mmap-able <index>.ids table.")
+        conv_parser.add_argument("--index-path", type=str, action="append", default=None,
+                                 help="FAISS index file(s) whose .map to convert (defaults to the mixed and text-only indexes).")
+
+        qr = subparsers.add_parser("quant-report", help="Memory and recall@k of fp16 / int8 / binary storage vs. the exact flat index.")
+        qr.add_argument("--k", type=int, default=10)
+        qr.add_argument("--sample", type=int, default=200, help="Number of corpus vectors used as queries.")
+        qr.add_argument("--oversample", type=int, default=None, help="Candidate over-fetch factor (defaults to quantization.oversample).")
 
     args = parser.parse_args()
 
     if args.cmd == "import":
         print("Starting data import and index building...")
-        build_index()
+        build_index(workers=args.workers)
         print("Import and index building process finished.")
+    elif args.cmd == "ingest":
+        from gaokao_rag import ingest
+        print(json.dumps(ingest.ingest(args.chunk_rows, restart=args.restart), ensure_ascii=False))
+    elif args.cmd == "sync":
+        print("Syncing index with spreadsheet...")
+        print(json.dumps(sync_index(), ensure_ascii=False))
     elif args.cmd == "query":
         # If k is not provided via CLI, it will use the default from CFG in query function
-        results = query(args.stem, args.k)
+        results = query(args.stem, args.k, json.loads(args.filters) if args.filters else None)
         print(json.dumps(results, ensure_ascii=False, indent=2))
     # else: # Not needed because subparsers(required=True) handles no command
     #     parser.print_help()
     elif args.cmd == "dump":
-        if CFG and CFG.store_name == 'faiss' and STORE and isinstance(STORE, FaissStore):
-            print(f"Dumping FAISS index to: {args.output_path} (and .map)")
+        from gaokao_rag import retriever
+        STORE = retriever.STORE if CFG and CFG.store_name == 'faiss' else None
+        if STORE and isinstance(STORE, FaissStore):
+            print(f"Dumping FAISS index to: {args.output_path} (and .ids)")
             # Ensure output directory exists
             output_p = Path(args.output_path)
             output_p.parent.mkdir(parents=True, exist_ok=True)
@@ -70,8 +160,10 @@ def main():
         else:
             print("Error: 'dump' command is only available for FAISS store. Check your conf/base.yaml (store: faiss)")
     elif args.cmd == "load":
-        if CFG and CFG.store_name == 'faiss' and STORE and isinstance(STORE, FaissStore):
-            print(f"Loading FAISS index from: {args.input_path} (and .map)")
+        from gaokao_rag import retriever
+        STORE = retriever.STORE if CFG and CFG.store_name == 'faiss' else None
+        if STORE and isinstance(STORE, FaissStore):
+            print(f"Loading FAISS index from: {args.input_path} (and .ids)")
             if STORE.load(args.input_path):
                 print("FAISS index loaded successfully.")
             else:
@@ -79,9 +171,98 @@ def main():
         else:
             print("Error: 'load' command is only available for FAISS store. Check your conf/base.yaml (store: faiss)")
 
+    elif args.cmd == "convert-map":
+        from gaokao_rag.store.faiss import convert_map
+        from gaokao_rag.cfg import ROOT
+        paths = args.index_path or [CFG.store.get("index_path", "models/faiss_index.bin"), "models/faiss_text.bin"]
+        for p in paths:
+            convert_map(Path(p) if Path(p).is_absolute() else ROOT / p)
+
+    elif args.cmd == "quant-report":
+        from gaokao_rag import retriever
+        from gaokao_rag.embed import encode_cached
+        from gaokao_rag.store.faiss import quantization_report
+        stems = [str(s) for s in retriever.DF["stem"].dropna()]
+        vecs = encode_cached(stems, batch_size=CFG.encode_batch_size)
+        report = {"configured": retriever.current_store().memory_report(),
+                  "modes": quantization_report(vecs, args.k, args.sample,
+                                               factory=CFG.store.get("index", {}).get("factory", "Flat"),
+                                               oversample=args.oversample)}
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    elif args.cmd == "rerank-report":
+        from gaokao_rag import retriever
+        if args.queries:
+            with open(args.queries, 'r', encoding='utf-8') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            stems = [r["stem"] for r in rows]
+            relevant = [r.get("relevant", []) for r in rows]
+        else:
+            sample = retriever.DF["stem"].dropna().sample(min(args.sample, retriever.DF["stem"].notna().sum()), random_state=0)
+            stems = [str(s) for s in sample]
+            relevant = [[str(i)] for i in sample.index]
+        margins = [float(m) for m in args.margins.split(",") if m]
+        print(json.dumps(retriever.rerank_report(stems, args.k, margins, relevant), ensure_ascii=False, indent=2))
+
+    elif args.cmd == "snapshot":
+        from gaokao_rag import snapshot
+        from gaokao_rag.cfg import ROOT
+        src = Path(args.source) if Path(args.source).is_absolute() else ROOT / args.source
+        snapshot.write_snapshot(src)
+
+    elif args.cmd == "versions":
+        from gaokao_rag import versions
+        if args.action == "rollback":
+            versions.rollback(args.to)
+        elif args.action == "prune":
+            versions.prune(args.keep)
+        print(json.dumps(versions.status(), ensure_ascii=False, indent=2))
+
+    elif args.cmd == "warmup":
+        from gaokao_rag.runtime import RUNTIME
+        names = [n for n in args.only.split(",") if n] if args.only else None
+        print(json.dumps(RUNTIME.warmup(names), ensure_ascii=False, indent=2))
+
+    elif args.cmd == "models":
+        from gaokao_rag import hub
+        print(json.dumps(hub.configured_models(), ensure_ascii=False, indent=2))
+
+    elif args.cmd == "export-onnx":
+        from gaokao_rag import onnx_export
+        for name in [m for m in args.models.split(",") if m]:
+            print(json.dumps({name: onnx_export.export(name, quantize=not args.no_int8)}, ensure_ascii=False))
+
+    elif args.cmd == "onnx-parity":
+        from gaokao_rag import onnx_export
+        reports = [onnx_export.parity(name, args.backend, args.sample, args.k)
+                   for name in args.models.split(",") if name]
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+
+    elif args.cmd == "cache":
+        from gaokao_rag import cache
+        if args.action == "stats":
+            print(json.dumps(cache.stats(), ensure_ascii=False, indent=2))
+        else:
+            print(json.dumps(cache.prune(args.max_entries), ensure_ascii=False, indent=2))
+
+    elif args.cmd == "bench":
+        import time
+        from gaokao_rag import bench
+        from gaokao_rag.cfg import ROOT
+        report = bench.run(size=args.size, queries=args.queries, k=args.k, models=args.models,
+                           factory=args.factory, concurrency=[int(c) for c in args.concurrency.split(",") if c],
+                           requests=args.requests, seed=args.seed, workdir=args.workdir, keep=args.keep,
+                           http=not args.no_http)
+        out = Path(args.output) if args.output else ROOT / "models/bench" / time.strftime("bench-%Y%m%d-%H%M%S.json")
+        out.parent.mkdir(parents=True, exist_ok=True)
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        print(f"[bench] report written to {out}")
+
     elif args.cmd == "import-text":
         from gaokao_rag.text_only import build_text_index
-        build_text_index()
+        build_text_index(workers=args.workers)
     elif args.cmd == "query-text":
         from gaokao_rag.text_only import query_text_only
         print(json.dumps(query_text_only(args.stem, args.k), ensure_ascii=False, indent=2))
@@ -1,9 +1,12 @@
 import numpy as np
-import torch # Ensure torch is imported if not already via other means
+from typing import List
 from .hub import get_model
+from .cache import FormulaCache, formula_hit_rates, FORMULA_COUNTERS
+from .formula import canonicalize
 # Assuming formula.py will be created correctly by the user later
 # from .formula import split 
 from .cfg import CFG
+from .runtime import RUNTIME
 
 # Placeholder for split function if formula.py is problematic
 # This is a fallback and should be replaced by importing from formula.py
@@ -11,17 +14,71 @@ def placeholder_split(text: str):
     print("Warning: Using placeholder_split. formula.py might not be loaded correctly.")
     return text, []
 
-_text_model = get_model("text")
-_math_model = get_model("math")
+# 模型在第一次使用时才加载 (见 runtime.py)
+RUNTIME.register("text_model", lambda: get_model("text"))
+RUNTIME.register("math_model", lambda: get_model("math"))
 
-TEXT_DIM = _text_model.get_sentence_embedding_dimension()
-MATH_DIM = _math_model.get_sentence_embedding_dimension()
-AUTO_DIM = TEXT_DIM + MATH_DIM
+# 公式向量缓存 (LRU + SQLite)；关闭时公式仍以规范化形式编码，向量与开启时一致
+FORMULA_CACHE = (FormulaCache(lru_entries=CFG.formula_cache.get('lru_entries', 50000),
+                              persist=CFG.formula_cache.get('persist', True) and CFG.cache.get('enabled', True))
+                 if CFG.formula_cache.get('enabled', True) else None)
 
-if AUTO_DIM != CFG.embed_dim:
-    print(f"[WARN] detected embed_dim={AUTO_DIM}, "
-          f"override conf/base.yaml embed_dim={CFG.embed_dim}")
-    CFG.embed_dim = AUTO_DIM     # 动态覆盖配置
+def _dims(text_dim: int, math_dim: int) -> dict:
+    auto_dim = text_dim + math_dim
+    if auto_dim != CFG.embed_dim:
+        print(f"[WARN] detected embed_dim={auto_dim}, "
+              f"override conf/base.yaml embed_dim={CFG.embed_dim}")
+        CFG.embed_dim = auto_dim     # 动态覆盖配置
+    return {"text": text_dim, "math": math_dim, "auto": auto_dim}
+
+def _detect_dims():
+    return _dims(RUNTIME.get("text_model").get_sentence_embedding_dimension(),
+                 RUNTIME.get("math_model").get_sentence_embedding_dimension())
+
+RUNTIME.register("dims", _detect_dims)
+
+def set_dims(text_dim: int, math_dim: int):
+    """Records dimensions probed elsewhere (e.g. in encode workers) without loading the models here."""
+    RUNTIME.set("dims", _dims(text_dim, math_dim))
+
+def text_dim() -> int:
+    return RUNTIME.get("dims")["text"]
+
+def math_dim() -> int:
+    return RUNTIME.get("dims")["math"]
+
+def ensure_dims() -> int:
+    """Loads both encoders (if needed) and makes sure CFG.embed_dim is the detected size."""
+    return RUNTIME.get("dims")["auto"]
+
+def __getattr__(name):
+    # 兼容旧代码里的 embed.TEXT_DIM / MATH_DIM / AUTO_DIM
+    dims = {"TEXT_DIM": "text", "MATH_DIM": "math", "AUTO_DIM": "auto"}
+    if name in dims:
+        return RUNTIME.get("dims")[dims[name]]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _encode_formulas_uncached(formulas: List[str], batch_size: int = 64) -> np.ndarray:
+    return RUNTIME.get("math_model").encode(formulas, batch_size=batch_size,
+                                           normalize_embeddings=True,
+                                           convert_to_numpy=True).astype('float32')
+
+def encode_formulas(formulas: List[str], batch_size: int = 64) -> np.ndarray:
+    """Math-model vectors of `formulas` (canonical LaTeX, one row each), through FORMULA_CACHE."""
+    if FORMULA_CACHE is not None:
+        return FORMULA_CACHE.encode(formulas, lambda fs: _encode_formulas_uncached(fs, batch_size), math_dim())
+    if not formulas:
+        return np.zeros((0, math_dim()), dtype='float32')
+    return _encode_formulas_uncached([canonicalize(f) for f in formulas], batch_size)
+
+def formula_counters() -> dict:
+    """Cumulative FORMULA_CACHE counters of this process (zeros when disabled)."""
+    return FORMULA_CACHE.counters() if FORMULA_CACHE is not None else dict.fromkeys(FORMULA_COUNTERS, 0)
+
+def formula_report(before: dict, after: dict | None = None) -> dict:
+    """Hit rates of the formula lookups made between two `formula_counters()` snapshots."""
+    after = after if after is not None else formula_counters()
+    return formula_hit_rates({c: after[c] - before[c] for c in FORMULA_COUNTERS})
 
 def encode(sentence: str):
     # Try to import the real split, fallback to placeholder if it fails or not available
@@ -32,19 +89,16 @@ def encode(sentence: str):
         print("Warning: Failed to import split from .formula, using placeholder.")
 
     rep, formulas = split(sentence)
+    ensure_dims()
     
-    v_text = _text_model.encode(rep, normalize_embeddings=True)
+    v_text = RUNTIME.get("text_model").encode(rep, normalize_embeddings=True)
     
     if formulas:
         # Ensure formulas is a list of strings
         formulas_str = [str(f) for f in formulas]
-        v_math_embeddings = _math_model.encode(formulas_str, normalize_embeddings=True)
-        if v_math_embeddings.ndim == 1: # handles case of single formula
-             v_math = v_math_embeddings
-        else:
-             v_math = v_math_embeddings.mean(axis=0)
+        v_math = encode_formulas(formulas_str).mean(axis=0)
     else:
-        v_math = np.zeros(MATH_DIM, dtype='float32') # Ensure correct dtype and shape
+        v_math = np.zeros(math_dim(), dtype='float32') # Ensure correct dtype and shape
         
     # Ensure both vectors are 1D and then concatenate
     if v_text.ndim > 1:
@@ -57,3 +111,94 @@ def encode(sentence: str):
     assert vec.shape[0] == CFG.embed_dim, \
            f"encode dim {vec.shape[0]} ≠ {CFG.embed_dim}  sample:{sentence[:50]}"
     return vec
+
+
+def _segment_mean(values: np.ndarray, counts: np.ndarray, dim: int) -> np.ndarray:
+    """Mean of consecutive row segments of `values`; empty segments map to zeros."""
+    out = np.zeros((len(counts), dim), dtype='float32')
+    nonempty = counts > 0
+    if not nonempty.any():
+        return out
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+    sums = np.add.reduceat(values, starts, axis=0)
+    out[nonempty] = sums / counts[nonempty, None].astype('float32')
+    return out
+
+def encode_batch(stems: List[str], batch_size: int = 64, with_math: bool = True) -> np.ndarray:
+    """
+    Batched equivalent of `encode` for many stems.
+
+    All stems are split up front; texts are encoded in batches of `batch_size`
+    and every formula of every stem goes through `encode_formulas` as one
+    flattened batch, so only formulas missing from the formula cache reach the
+    math model. Per-stem formula means are rebuilt with a segment reduction,
+    so row i matches `encode(stems[i])`.
+
+    Args:
+        stems (List[str]): Problem stems, may contain LaTeX.
+        batch_size (int): Forward-pass batch size for both models.
+        with_math (bool): If False, only the text part is returned
+                          (same layout as text_only.encode_text_only).
+
+    Returns:
+        np.ndarray: float32 array of shape (len(stems), dim).
+    """
+    from .formula import split
+
+    ensure_dims()
+    out_dim = CFG.embed_dim if with_math else text_dim()
+    if not stems:
+        return np.zeros((0, out_dim), dtype='float32')
+
+    reps, all_formulas, counts = [], [], []
+    for s in stems:
+        rep, formulas = split(str(s))
+        reps.append(rep)
+        all_formulas.extend(str(f) for f in formulas)
+        counts.append(len(formulas))
+
+    v_text = RUNTIME.get("text_model").encode(reps, batch_size=batch_size,
+                                normalize_embeddings=True,
+                                convert_to_numpy=True).astype('float32')
+    if not with_math:
+        return v_text
+
+    v_formulas = encode_formulas(all_formulas, batch_size=batch_size)
+    v_math = _segment_mean(v_formulas, np.asarray(counts, dtype=np.int64), math_dim())
+
+    vecs = np.concatenate([v_text, v_math], axis=1).astype('float32')
+    assert vecs.shape[1] == CFG.embed_dim, \
+           f"encode_batch dim {vecs.shape[1]} ≠ {CFG.embed_dim}"
+    return vecs
+
+def encode_cached(stems: List[str], batch_size: int = 64, with_math: bool = True) -> np.ndarray:
+    """
+    `encode_batch` behind the on-disk embedding cache (see cache.py):
+    only stems whose (text, model identity) hash is not cached get encoded.
+    """
+    if not CFG.cache.get('enabled', True):
+        return encode_batch(stems, batch_size=batch_size, with_math=with_math)
+
+    from .cache import EmbedCache
+    ensure_dims()
+    out_dim = CFG.embed_dim if with_math else text_dim()
+    out = np.zeros((len(stems), out_dim), dtype='float32')
+
+    cache = EmbedCache('mixed' if with_math else 'text')
+    try:
+        hits, misses = cache.get_many(stems)
+        for pos, v in hits.items():
+            if v.shape[0] == out_dim:
+                out[pos] = v
+            else:                       # 维度对不上，当作未命中
+                misses.append(pos)
+        misses.sort()
+        if misses:
+            miss_stems = [stems[i] for i in misses]
+            fresh = encode_batch(miss_stems, batch_size=batch_size, with_math=with_math)
+            out[misses] = fresh
+            cache.put_many(miss_stems, fresh)
+        print(f"[cache] {len(stems) - len(misses)} cached, {len(misses)} encoded")
+    finally:
+        cache.close()
+    return out
@@ -0,0 +1,145 @@
+# gaokao_rag/filters.py
+"""
+Metadata filters (difficulty range, year, topic) pushed down into the vector store.
+
+A filter is a dict such as
+
+    {"difficulty": [0.5, 0.9], "year": [2022, 2023], "topic": ["余弦定理解三角形"]}
+
+`difficulty` is an inclusive range (either end may be None); `year` and
+`topic` match when the problem has any of the listed values. Years come from
+the `years` column, topics from `kpoints` (names) and `kpoint_ids`. The stores
+receive these attributes together with the vectors (`attrs=` on build / add /
+upsert) and only score vectors that can match: FAISS through an IDSelector
+bitmap over its per-attribute index (store/attributes.py), Milvus through the
+search `expr` over scalar fields.
+"""
+import hashlib
+import json
+import math
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+# 过滤字段 → 题库中的来源列
+ATTRIBUTES = {"difficulty": ("difficulty",), "year": ("years",), "topic": ("kpoints", "kpoint_ids")}
+MULTI = ("year", "topic")                 # 多值字段：命中任一取值即可
+COLUMNS = [c for cols in ATTRIBUTES.values() for c in cols]
+
+Filter = Tuple[Tuple[str, tuple], ...]    # normalize() 的结果：可哈希，可作缓存键
+UNKNOWN_DIFFICULTY = -1.0                 # Milvus 标量字段不能存 NaN，未标注难度写成这个值
+
+_SEP = re.compile(r"[,，;；]")
+
+
+def normalize(spec) -> Filter | None:
+    """
+    Validates a filter dict and returns its canonical, hashable form (None for
+    "no filter"). Raises ValueError for unknown fields or malformed values.
+    """
+    if spec is None:
+        return None
+    if isinstance(spec, tuple):
+        return spec or None                # 已经规范化过
+    if not isinstance(spec, dict):
+        raise ValueError(f"filters must be an object, got {type(spec).__name__}")
+    unknown = set(spec) - set(ATTRIBUTES)
+    if unknown:
+        raise ValueError(f"Unknown filter field(s) {sorted(unknown)}; supported: {sorted(ATTRIBUTES)}")
+    out = []
+    lo_hi = spec.get("difficulty")
+    if lo_hi is not None:
+        if not isinstance(lo_hi, (list, tuple)) or len(lo_hi) != 2:
+            raise ValueError("filters.difficulty must be [min, max] (either may be null)")
+        lo = -math.inf if lo_hi[0] is None else float(lo_hi[0])
+        hi = math.inf if lo_hi[1] is None else float(lo_hi[1])
+        if lo > hi:
+            raise ValueError(f"filters.difficulty: min {lo} > max {hi}")
+        if (lo, hi) != (-math.inf, math.inf):
+            out.append(("difficulty", (lo, hi)))
+    for name in MULTI:
+        values = spec.get(name)
+        if values is None:
+            continue
+        if isinstance(values, (str, int)):
+            values = [values]
+        try:
+            values = sorted({int(v) for v in values} if name == "year" else {str(v).strip() for v in values})
+        except (TypeError, ValueError):
+            raise ValueError(f"filters.{name} must be a list of {'integers' if name == 'year' else 'strings'}")
+        if values:
+            out.append((name, tuple(values)))
+    return tuple(sorted(out)) or None
+
+
+def as_dict(f: Filter | None) -> dict:
+    return {name: list(v) for name, v in (f or ())}
+
+
+def _split(value) -> List[str]:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return []
+    return [p.strip() for p in _SEP.split(str(value)) if p.strip()]
+
+
+def attributes(frame: pd.DataFrame) -> Dict[str, object]:
+    """
+    Filterable attributes of the rows of `frame` (any columns missing are
+    treated as unknown): difficulty as a float array (NaN = unknown), year and
+    topic as one list of values per row.
+    """
+    n = len(frame)
+    diff = (pd.to_numeric(frame["difficulty"], errors="coerce").to_numpy(dtype=np.float64)
+            if "difficulty" in frame.columns else np.full(n, np.nan))
+    years = ([[int(y) for y in _split(v) if y.isdigit()] for v in frame["years"].tolist()]
+             if "years" in frame.columns else [[] for _ in range(n)])
+    topics = [[] for _ in range(n)]
+    for col in ATTRIBUTES["topic"]:
+        if col in frame.columns:
+            for row, v in zip(topics, frame[col].tolist()):
+                row.extend(t for t in _split(v) if t not in row)
+    return {"difficulty": diff, "year": years, "topic": topics}
+
+
+def subset(attrs: Dict[str, object] | None, rows) -> Dict[str, object] | None:
+    """The attributes of the given row positions."""
+    if attrs is None:
+        return None
+    rows = list(rows)
+    return {"difficulty": np.asarray(attrs["difficulty"])[rows] if rows else np.zeros(0),
+            **{name: [attrs[name][j] for j in rows] for name in MULTI}}
+
+
+def concat(parts: List[Dict[str, object]]) -> Dict[str, object]:
+    """Row-wise concatenation of several attribute dicts."""
+    return {"difficulty": np.concatenate([np.asarray(p["difficulty"], dtype=np.float64) for p in parts])
+            if parts else np.zeros(0),
+            **{name: [row for p in parts for row in p[name]] for name in MULTI}}
+
+
+def row_hashes(attrs: Dict[str, object]) -> List[str]:
+    """Short hash of each row's attributes (kept in the index manifest so sync notices attribute edits)."""
+    out = []
+    for j, d in enumerate(np.asarray(attrs["difficulty"]).tolist()):
+        key = json.dumps([None if math.isnan(d) else round(d, 6), attrs["year"][j], attrs["topic"][j]],
+                         ensure_ascii=False)
+        out.append(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8])
+    return out
+
+
+def milvus_expr(f: Filter | None) -> str | None:
+    """Boolean expression over the Milvus scalar fields (see MilvusStore._create_collection)."""
+    parts = []
+    for name, value in f or ():
+        if name == "difficulty":
+            lo, hi = value
+            # 未标注难度 (UNKNOWN_DIFFICULTY) 不满足任何难度条件，与 FAISS 的 NaN 一致
+            parts.append(f"difficulty >= {lo!r}" if lo > UNKNOWN_DIFFICULTY
+                         else f"difficulty != {UNKNOWN_DIFFICULTY!r}")
+            if hi != math.inf:
+                parts.append(f"difficulty <= {hi!r}")
+        else:
+            parts.append(f"array_contains_any({name}, {json.dumps(list(value), ensure_ascii=False)})")
+    return " and ".join(parts) or None
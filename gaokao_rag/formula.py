@@ -1,3 +1,5 @@
+import html
+
 import regex as re
 
 # Pattern to find LaTeX blocks: $$...$$, \[...\] (display math), and $...$ (inline math)
@@ -12,4 +14,103 @@ def split(text: str):
         return f"[M{len(formulas)-1}]" # Placeholder like [M0], [M1], ...
     
     processed_text = PATTERN.sub(repl, text)
-    return processed_text, formulas
\ No newline at end of file
+    return processed_text, formulas
+
+
+# --- canonical form (formula cache key and math-model input) ---
+# 改动规则时递增，使缓存里旧规则下的向量失效 (见 cache.model_identity)
+CANON_VERSION = 1
+
+_TOKEN = re.compile(r"\\[A-Za-z]+|\\.|\s+|.", re.S)
+_DELIMS = (("$$", "$$"), ("\\[", "\\]"), ("\\(", "\\)"), ("$", "$"))
+
+# 写法不同、含义相同的宏；映射为空串的宏直接丢弃 (定界符尺寸、显示样式等)
+_ALIASES = {
+    "\\dfrac": "\\frac", "\\tfrac": "\\frac",
+    "\\le": "\\leq", "\\leqslant": "\\leq", "\\ge": "\\geq", "\\geqslant": "\\geq",
+    "\\ne": "\\neq", "\\lt": "<", "\\gt": ">",
+    "\\vartriangle": "\\triangle", "\\bigtriangleup": "\\triangle",
+    "\\lbrace": "\\{", "\\rbrace": "\\}", "\\to": "\\rightarrow", "\\gets": "\\leftarrow",
+    "\\implies": "\\Rightarrow", "\\iff": "\\Leftrightarrow",
+    "\\land": "\\wedge", "\\lor": "\\vee", "\\lnot": "\\neg",
+    "\\ldots": "\\dots", "\\varnothing": "\\emptyset",
+    "\\left": "", "\\right": "", "\\big": "", "\\Big": "", "\\bigg": "", "\\Bigg": "",
+    "\\bigl": "", "\\bigr": "", "\\Bigl": "", "\\Bigr": "",
+    "\\displaystyle": "", "\\textstyle": "", "\\limits": "", "\\quad": "", "\\qquad": "",
+}
+_SPACING = {"\\,", "\\;", "\\:", "\\!", "\\ ", "~"}
+_TEXT_MACROS = {"\\text", "\\textrm", "\\mathrm", "\\mbox", "\\operatorname"}
+# 单参数宏：\mathbb R 与 \mathbb{R} 统一成带括号的写法
+_ONE_ARG = {"\\mathbb", "\\mathbf", "\\mathcal", "\\mathrm", "\\overline", "\\bar",
+            "\\vec", "\\hat", "\\widehat", "\\overrightarrow", "\\sqrt"}
+
+
+def _is_word(tok: str) -> bool:
+    return len(tok) > 1 and tok[0] == "\\" and tok[1:].isalpha()
+
+
+def _strip_delims(s: str) -> str:
+    for left, right in _DELIMS:
+        if len(s) >= len(left) + len(right) and s.startswith(left) and s.endswith(right):
+            return s[len(left):len(s) - len(right)].strip()
+    return s
+
+
+def canonicalize(formula: str) -> str:
+    """
+    Normalized LaTeX for one formula: HTML entities decoded, `$`/`$$`/`\\[`
+    delimiters stripped, whitespace and spacing commands dropped (outside
+    `\\text{}`), trivial macro variants unified (`\\dfrac` → `\\frac`,
+    `\\le` → `\\leq`, `\\left(` → `(` ...) and redundant braces removed
+    (`{{a}_{n}}` → `a_n`). Copies of the same formula map to one cache key.
+    """
+    toks = []
+    for t in _TOKEN.findall(_strip_delims(html.unescape(str(formula)).strip())):
+        if t.isspace():
+            t = " "
+        elif _is_word(t):
+            t = _ALIASES.get(t, t)
+            if not t:
+                continue
+        elif t in _SPACING:
+            continue
+        if t != " " and len(toks) > 1 and toks[-1] == " " and toks[-2] in _ONE_ARG:
+            toks.pop()
+        if toks and toks[-1] in _ONE_ARG and t not in ("{", "}", "[", " "):
+            toks += ["{", t, "}"]
+        else:
+            toks.append(t)
+
+    stack, groups = [], []
+    for i, t in enumerate(toks):
+        if t == "{":
+            stack.append(i)
+        elif t == "}" and stack:
+            groups.append((stack.pop(), i))
+
+    drop, text_spans = set(), []
+    for start, end in groups:
+        j = start - 1
+        while j >= 0 and toks[j] == " ":
+            j -= 1
+        prev = toks[j] if j >= 0 else None
+        inner = [t for t in toks[start + 1:end] if t != " "]
+        if prev in _TEXT_MACROS:
+            text_spans.append((start, end))
+        elif prev is None or not (_is_word(prev) or prev in ("^", "_", "]", "}")):
+            drop.update((start, end))           # 纯分组用的括号
+        elif prev in ("^", "_") and len(inner) == 1 and inner[0] not in ("{", "}"):
+            drop.update((start, end))           # a_{n} → a_n
+
+    out = []
+    for i, t in enumerate(toks):
+        if i in drop:
+            continue
+        if t == " ":
+            if out and out[-1] != " " and any(a < i < b for a, b in text_spans):
+                out.append(" ")
+            continue
+        if out and _is_word(out[-1]) and t[0].isalpha():
+            out.append(" ")                     # \angle A 不能粘成 \angleA
+        out.append(t)
+    return "".join(out).strip()
@@ -1,17 +1,171 @@
-from huggingface_hub import snapshot_download
-from sentence_transformers import SentenceTransformer
+"""
+Process-wide model registry.
+
+`get_model(name)` returns one shared instance per (model, device, kind,
+backend): embed.py, text_only.py and the reranker all reuse the same object
+instead of each loading their own copy. `kind` is bi_encoder
+(SentenceTransformer) or cross_encoder; `backend` is the inference runtime
+from conf/model.yaml (torch, onnx or onnx-int8, see onnx_export.py). `model_path(name)` resolves (and downloads, if
+needed) the local directory without instantiating anything; `loaded_models()`
+reports what is resident and `unload()` releases it.
+"""
+import gc
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
 from .cfg import CFG, ROOT
+from .runtime import RUNTIME
+
+KINDS = ("bi_encoder", "cross_encoder")
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_FILE = "onnx/model.onnx"
 
-def get_model(name: str):
+_REGISTRY: Dict[Tuple[str, str, str, str], dict] = {}
+_LOCK = threading.Lock()
+_KEY_LOCKS: Dict[Tuple[str, str, str, str], threading.Lock] = {}
+
+
+def model_path(name: str) -> Path:
+    """Local directory of model `name` (downloaded from the hub on first use)."""
     info = CFG.model[name]
     local = ROOT / info['local']
     if not local.exists():
+        # 重依赖放在函数内导入：import gaokao_rag / ragmath --help 不必加载 torch
+        from huggingface_hub import snapshot_download
         local.parent.mkdir(parents=True, exist_ok=True) # Ensure parent directory exists
         snapshot_download(info['repo'],
                           local_dir=str(local), # snapshot_download expects string path
                           resume_download=True,
                           local_dir_use_symlinks=False,
                           endpoint=CFG.model.get('hf_mirror')) # Use .get for optional hf_mirror
-    return SentenceTransformer(str(local),
-                               device=CFG.device,
-                               trust_remote_code=True) 
\ No newline at end of file
+    return local
+
+
+def model_backend(name: str) -> str:
+    """Inference backend configured for model `name` (conf/model.yaml `backend`, default torch)."""
+    backend = CFG.model[name].get('backend', 'torch')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}' for model '{name}'. Expected one of {BACKENDS}.")
+    return backend
+
+
+def onnx_file(name: str, backend: str) -> str:
+    """Path of the ONNX graph for `backend`, relative to the model directory."""
+    if backend == "onnx-int8":
+        return f"onnx/model_qint8_{CFG.model.get('onnx_quantization', 'avx512_vnni')}.onnx"
+    return ONNX_FILE
+
+
+def _instantiate(name: str, device: str, kind: str, backend: str):
+    path = model_path(name)
+    kwargs = {"device": device}
+    if backend != "torch":
+        file_name = onnx_file(name, backend)
+        if not (path / file_name).exists():
+            raise FileNotFoundError(f"{path / file_name} not found; run `ragmath export-onnx --models {name}` first.")
+        kwargs.update(backend="onnx", model_kwargs={"file_name": file_name})
+    if kind == "cross_encoder":
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(str(path), **kwargs)
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(str(path), trust_remote_code=True, **kwargs)
+
+
+def get_model(name: str, device: str | None = None, kind: str = "bi_encoder", backend: str | None = None):
+    """Shared instance of model `name`; loaded on the first call for each (device, kind, backend)."""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown model kind '{kind}'. Expected one of {KINDS}.")
+    backend = backend or model_backend(name)
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown model backend '{backend}'. Expected one of {BACKENDS}.")
+    key = (name, device or CFG.device, kind, backend)
+    entry = _REGISTRY.get(key)
+    if entry is not None:
+        return entry["model"]
+    with _LOCK:
+        lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _REGISTRY:        # 另一个线程可能已经加载完
+            t0 = time.perf_counter()
+            model = _instantiate(*key)
+            _REGISTRY[key] = {"model": model,
+                              "load_seconds": time.perf_counter() - t0,
+                              "loaded_at": time.time()}
+        return _REGISTRY[key]["model"]
+
+
+def _param_bytes(model) -> int | None:
+    """Bytes held by the torch parameters and buffers of `model` (None if not a torch model)."""
+    # ONNX 后端没有 torch 参数，按 .onnx 文件大小近似（见 loaded_models）
+    module = model if hasattr(model, "parameters") else getattr(model, "model", None)
+    if module is None or not hasattr(module, "parameters"):
+        return None
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def loaded_models() -> List[dict]:
+    out = []
+    for (name, device, kind, backend), entry in list(_REGISTRY.items()):
+        if backend == "torch":
+            size = _param_bytes(entry["model"])
+        else:
+            onnx_path = model_path(name) / onnx_file(name, backend)
+            size = onnx_path.stat().st_size if onnx_path.exists() else None
+        out.append({
+            "name": name,
+            "device": device,
+            "kind": kind,
+            "backend": backend,
+            "path": str(model_path(name)),
+            "memory_mb": None if size is None else round(size / 2**20, 1),
+            "load_seconds": round(entry["load_seconds"], 3),
+            "loaded_at": entry["loaded_at"],
+        })
+    return out
+
+
+def configured_models() -> List[dict]:
+    """Models declared in conf/model.yaml with their local path and on-disk size (nothing is loaded)."""
+    out = []
+    for name, info in CFG.model.items():
+        if not isinstance(info, dict) or 'local' not in info:
+            continue
+        local = ROOT / info['local']
+        files = [p for p in local.rglob('*') if p.is_file()] if local.exists() else []
+        out.append({
+            "name": name,
+            "repo": info.get('repo'),
+            "path": str(local),
+            "downloaded": local.exists(),
+            "backend": info.get('backend', 'torch'),
+            "onnx_exported": [b for b in BACKENDS[1:] if (local / onnx_file(name, b)).exists()],
+            "disk_mb": round(sum(p.stat().st_size for p in files) / 2**20, 1),
+            "loaded": [{"device": k[1], "kind": k[2], "backend": k[3]} for k in _REGISTRY if k[0] == name],
+        })
+    return out
+
+
+def unload(name: str | None = None, device: str | None = None, backend: str | None = None) -> List[dict]:
+    """
+    Drops registry entries matching the given filters (all models when no
+    filter is given) and frees cached GPU memory. Components that held the
+    model are re-created on next use.
+    """
+    with _LOCK:
+        keys = [k for k in _REGISTRY
+                if (name is None or k[0] == name)
+                and (device is None or k[1] == device)
+                and (backend is None or k[3] == backend)]
+        dropped = [_REGISTRY.pop(k) for k in keys]
+    for entry in dropped:
+        RUNTIME.forget(entry["model"])
+    dropped.clear()
+    gc.collect()
+    torch = sys.modules.get("torch")       # 只有已经加载过 torch 才需要清显存
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return [{"name": k[0], "device": k[1], "kind": k[2], "backend": k[3]} for k in keys]
@@ -0,0 +1,274 @@
+# gaokao_rag/ingest.py
+"""
+Streaming, resumable ingestion (`ragmath ingest`).
+
+The corpus is read from the columnar snapshot `ingest.chunk_rows` rows at a
+time, so peak memory is bounded by the chunk size (plus, for IVF/PQ indexes,
+one training sample) rather than by the corpus. Every chunk is encoded and
+upserted into a staging store. The staging FAISS index is saved (a full
+rewrite) only every `ingest.save_every` chunks, and at least
+`ingest.save_growth` × the rows already saved must have arrived since the
+last save, so total write I/O stays linear in the corpus. `checkpoint.json`
+is advanced only after a save. An interrupted run resumes after the last
+checkpoint; upsert makes replaying the unsaved chunks harmless. Rows that cannot be indexed
+(missing stem, encoder error, wrong dimension, non-finite values) go to the
+reject file instead of aborting the run.
+
+FAISS stages into its own directory and is published like build_index
+(a new index version, or the configured index files when versioning is off).
+Milvus is upserted in place.
+"""
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from . import filters, retriever, snapshot, versions
+from .cache import model_identity
+from .cfg import CFG, ROOT
+from .embed import encode_cached, ensure_dims, formula_counters, formula_report
+from .runtime import RUNTIME
+
+CHECKPOINT = "checkpoint.json"
+MANIFEST_PART = "manifest.part"
+
+
+def _cfg() -> dict:
+    return CFG.base.get("ingest", {}) or {}
+
+
+def _path(p: str) -> Path:
+    return Path(p) if os.path.isabs(p) else ROOT / p
+
+
+def staging_dir() -> Path:
+    if CFG.store_name == "faiss" and versions.enabled():
+        return versions.versions_dir() / ".ingest"
+    return _path(_cfg().get("dir", f"models/.ingest-{CFG.store_name}"))
+
+
+def _reject_path() -> Path:
+    return _path(_cfg().get("reject_file", "models/ingest_rejects.jsonl"))
+
+
+def _read_checkpoint(staging: Path):
+    try:
+        with open(staging / CHECKPOINT, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(staging: Path, ckpt: dict):
+    tmp = staging / f"{CHECKPOINT}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(ckpt, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, staging / CHECKPOINT)
+
+
+def _truncate(path: Path, size: int):
+    with open(path, "a+b") as f:
+        f.truncate(size)
+
+
+def _encode_chunk(ids: List[str], stems: List[str]) -> Tuple[List[str], List[str], np.ndarray, List[dict]]:
+    """
+    Encodes a chunk; if the batch fails (or comes back with the wrong width),
+    falls back to row-by-row encoding to isolate the rows that break the encoder.
+    """
+    dim = CFG.embed_dim
+    try:
+        vecs = encode_cached(stems, batch_size=CFG.encode_batch_size)
+        if vecs.ndim != 2 or vecs.shape[1] != dim:
+            raise ValueError(f"batch dimension {vecs.shape[1:]} != {dim}")
+        errors = [None] * len(ids)
+    except Exception:
+        vecs, errors = np.zeros((len(ids), dim), dtype=np.float32), []
+        for j, stem in enumerate(stems):
+            try:
+                row = np.asarray(encode_cached([stem], batch_size=1)[0], dtype=np.float32).reshape(-1)
+            except Exception as e:
+                errors.append(f"encode error: {type(e).__name__}: {e}")
+                continue
+            if row.shape[0] != dim:
+                errors.append(f"dimension {row.shape[0]} != {dim}")
+            else:
+                vecs[j] = row
+                errors.append(None)
+
+    keep, rejects = [], []
+    for j, (item_id, stem) in enumerate(zip(ids, stems)):
+        reason = errors[j]
+        if reason is None and not np.isfinite(vecs[j]).all():
+            reason = "non-finite embedding"
+        if reason is None:
+            keep.append(j)
+        else:
+            rejects.append({"id": item_id, "reason": reason, "stem": stem[:200]})
+    return ([ids[j] for j in keep], [stems[j] for j in keep],
+            np.ascontiguousarray(vecs[keep], dtype=np.float32), rejects)
+
+
+def _open_store(staging: Path):
+    if CFG.store_name == "faiss":
+        return retriever._open_faiss(staging / versions.INDEX_FILE, autosave=False)
+    return RUNTIME.get("store")
+
+
+def ingest(chunk_rows: int | None = None, restart: bool = False) -> dict:
+    chunk_rows = int(chunk_rows or _cfg().get("chunk_rows", 2000))
+    source = retriever.DATA_FILE_PATH
+    ensure_dims()
+    ident = {
+        "source_sha256": snapshot.source_sha256(source),
+        "model": model_identity("mixed"),
+        "store": CFG.store_name,
+        "factory": (CFG.store.get("index", {}) or {}).get("factory"),
+    }
+    staging, rejects_path = staging_dir(), _reject_path()
+    ckpt = None if restart else _read_checkpoint(staging)
+    if ckpt is None or ckpt.get("ident") != ident:
+        if ckpt is not None:
+            print("[ingest] checkpoint is for another corpus / model / store; starting over.")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        rejects_path.parent.mkdir(parents=True, exist_ok=True)
+        rejects_path.write_bytes(b"")
+        ckpt = {"ident": ident, "rows_done": 0, "accepted": 0, "rejected": 0,
+                "manifest_bytes": 0, "reject_bytes": 0}
+    else:
+        print(f"[ingest] resuming after row {ckpt['rows_done']} "
+              f"({ckpt['accepted']} indexed, {ckpt['rejected']} rejected so far).")
+    # 丢掉上次崩溃时写了一半、尚未记入检查点的内容
+    _truncate(staging / MANIFEST_PART, ckpt["manifest_bytes"])
+    _truncate(rejects_path, ckpt["reject_bytes"])
+
+    store = _open_store(staging)
+    train_first = (CFG.store_name == "faiss" and store.index is None and store.needs_training())
+    train_rows = int((CFG.store.get("index", {}) or {}).get("train_sample", 50000)) if train_first else 0
+    buf_ids, buf_stems, buf_vecs, buf_attrs, buf_rejects = [], [], [], [], []
+    buf_end = ckpt["rows_done"]
+    probe: Tuple[List[str], np.ndarray] = ([], np.zeros((0, CFG.embed_dim), dtype=np.float32))
+    t0, rows_seen, formula_before = time.perf_counter(), 0, formula_counters()
+    # FAISS 每次 save 都整体重写暂存索引：按块数 + 几何增长攒批保存，总写入量与语料成线性
+    save_every = max(1, int(_cfg().get("save_every", 10)))
+    save_growth = float(_cfg().get("save_growth", 0.25))
+    pending = {"chunks": 0, "rows": 0, "accepted": 0, "rejected": 0}
+
+    def flush(final: bool = False):
+        nonlocal buf_ids, buf_stems, buf_vecs, buf_attrs, buf_rejects, probe
+        attrs = filters.concat(buf_attrs)
+        if buf_ids:
+            vecs = np.concatenate(buf_vecs)
+            store.upsert(buf_ids, vecs, attrs)
+            probe = (buf_ids[-64:], vecs[-64:].copy())
+        # 清单与坏行随块追加；未记入检查点的部分在续传时按字节截掉
+        with open(staging / MANIFEST_PART, "a", encoding="utf-8") as f:
+            f.writelines(f"{i}\t{retriever.stem_hash(s)}\t{a}\n"
+                         for i, s, a in zip(buf_ids, buf_stems, filters.row_hashes(attrs)))
+        with open(rejects_path, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in buf_rejects)
+        pending["chunks"] += 1
+        pending["rows"] += len(buf_ids)
+        pending["accepted"] += len(buf_ids)
+        pending["rejected"] += len(buf_rejects)
+        buf_ids, buf_stems, buf_vecs, buf_attrs, buf_rejects = [], [], [], [], []
+        if CFG.store_name == "faiss":
+            if not final and (pending["chunks"] < save_every or pending["rows"] < save_growth * ckpt["accepted"]):
+                return
+            store.save()
+        ckpt.update(rows_done=buf_end, accepted=ckpt["accepted"] + pending["accepted"],
+                    rejected=ckpt["rejected"] + pending["rejected"],
+                    manifest_bytes=(staging / MANIFEST_PART).stat().st_size,
+                    reject_bytes=rejects_path.stat().st_size)
+        _write_checkpoint(staging, ckpt)
+        pending.update(chunks=0, rows=0, accepted=0, rejected=0)
+
+    columns = ["id", "stem"] + [c for c in filters.COLUMNS if c in snapshot.column_names(source)]
+    for offset, total, chunk in snapshot.iter_chunks(source, columns, chunk_rows, start=ckpt["rows_done"]):
+        ids, stems, missing, row_of = [], [], [], {}
+        for j, (item_id, stem) in enumerate(zip(chunk["id"].tolist(), chunk["stem"].tolist())):
+            item_id = str(item_id)
+            if stem is None or pd.isna(stem) or not str(stem).strip():
+                missing.append({"id": item_id, "reason": "missing stem", "stem": ""})
+            else:
+                ids.append(item_id)
+                stems.append(str(stem))
+                row_of[item_id] = j
+        ids, stems, vecs, bad = _encode_chunk(ids, stems)
+        buf_ids += ids
+        buf_stems += stems
+        buf_vecs.append(vecs)
+        buf_attrs.append(filters.subset(filters.attributes(chunk), [row_of[i] for i in ids]))
+        buf_rejects += missing + bad
+        buf_end = offset + len(chunk)
+        rows_seen += len(chunk)
+        # IVF / PQ 需要先训练：攒够 train_sample 行再第一次写入
+        if not train_first or sum(len(v) for v in buf_vecs) >= train_rows or buf_end >= total:
+            flush()
+            train_first = False
+        dt = max(time.perf_counter() - t0, 1e-9)
+        print(f"[ingest] {buf_end}/{total} rows ({buf_end / max(total, 1):.1%}), "
+              f"{rows_seen / dt:.1f} rows/s, {ckpt['rejected'] + pending['rejected'] + len(buf_rejects)} rejected")
+    if buf_ids or buf_rejects or pending["chunks"]:
+        flush(final=True)
+
+    return _finish(staging, ckpt, probe, formula_report(formula_before))
+
+
+def _finish(staging: Path, ckpt: dict, probe, formula: dict) -> dict:
+    items, attrs = {}, {}
+    if (staging / MANIFEST_PART).exists():
+        with open(staging / MANIFEST_PART, "r", encoding="utf-8") as f:
+            for line in f:
+                item_id, h, a = (line.rstrip("\n").split("\t") + [""])[:3]
+                items[item_id] = h
+                attrs[item_id] = a
+    report = {"rows": ckpt["rows_done"], "indexed": len(items), "rejected": ckpt["rejected"],
+              "reject_file": str(_reject_path()), "formula_cache": formula}
+    if not items:
+        raise RuntimeError(f"Nothing was indexed; see {_reject_path()} ({ckpt['rejected']} rejected rows).")
+
+    if CFG.store_name != "faiss":
+        RUNTIME.get("store").flush()     # 分块 upsert 不逐块 flush，最后统一一次
+        retriever.save_manifest(items, attrs=attrs)
+        retriever.bump_index_generation()
+        shutil.rmtree(staging, ignore_errors=True)
+        print(f"[ingest] done: {report}")
+        return report
+
+    retriever._validate_version(staging, len(items), *probe)
+    (staging / CHECKPOINT).unlink(missing_ok=True)
+    (staging / MANIFEST_PART).unlink(missing_ok=True)
+    if versions.enabled():
+        retriever.save_manifest(items, staging / versions.MANIFEST_FILE, attrs)
+        name = versions.publish(staging)
+        retriever._swap_store(name)
+        report["version"] = name
+    else:
+        # 无版本化：把暂存文件原子替换到配置的索引路径
+        from .store.attributes import AttributeIndex
+        from .store.faiss import FaissStore
+        target = _path(CFG.store.get("index_path", "models/faiss_index.bin"))
+        target.parent.mkdir(parents=True, exist_ok=True)
+        src = staging / versions.INDEX_FILE
+        for a, b in ((FaissStore._ids_path(src), FaissStore._ids_path(target)),
+                     (FaissStore._meta_path(src), FaissStore._meta_path(target)),
+                     (FaissStore._raw_path(src), FaissStore._raw_path(target)),
+                     (AttributeIndex.path_for(src), AttributeIndex.path_for(target)),
+                     (src, target)):
+            if a.exists():
+                os.replace(a, b)
+            elif b.exists():
+                os.remove(b)    # 例如换回未压缩索引后残留的 .f32
+        shutil.rmtree(staging, ignore_errors=True)
+        retriever.save_manifest(items, attrs=attrs)
+        RUNTIME.invalidate("store")
+        retriever.bump_index_generation()
+    print(f"[ingest] done: {report}")
+    return report
@@ -0,0 +1,223 @@
+# gaokao_rag/metrics.py
+"""
+Per-stage timing spans and the Prometheus exposition behind GET /metrics.
+
+`span(op, stage)` times one stage of an operation (query, query_batch,
+build_index, sync, publish) into the `gaokao_stage_seconds{op,stage}`
+histogram; `stage="total"` is the whole call. `candidates(op, n)` records how
+many ANN candidates a query got. While a `Trace` is active in the current
+context (slow-query log, request profiling) the same spans also add up the
+per-stage time of that one call. Index size, model / component load times and
+the result-cache and near-duplicate counters are read from the runtime when
+/metrics is scraped, so nothing is loaded or computed for them in between.
+
+With `metrics.enabled: false` (conf/base.yaml) and no active trace, `span`
+returns one shared no-op context manager and nothing is recorded.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import nullcontext
+from typing import Dict, List, Tuple
+
+from .cfg import CFG
+
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                    30.0, 120.0, 600.0)
+_CANDIDATE_BUCKETS = (0, 1, 5, 10, 20, 30, 50, 100, 200, 500)
+_NOOP = nullcontext()
+
+
+def _cfg() -> dict:
+    return CFG.base.get("metrics", {}) or {}
+
+
+ENABLED = bool(_cfg().get("enabled", True))
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label tuple (Prometheus semantics)."""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...], buckets):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._series: Dict[tuple, list] = {}     # labels → [bucket counts…, +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in sorted(self._series.items())}
+        for labels, s in series.items():
+            base = _labels(zip(self.labels, labels))
+            cum = 0
+            for b, n in zip(self.buckets + (float("inf"),), s[:-1]):
+                cum += n
+                le = "+Inf" if b == float("inf") else repr(b)
+                out.append(f'{self.name}_bucket{_labels(list(zip(self.labels, labels)) + [("le", le)])} {cum}')
+            out.append(f"{self.name}_sum{base} {s[-1]!r}")
+            out.append(f"{self.name}_count{base} {cum}")
+        return out
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+def _labels(pairs) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+STAGE_SECONDS = Histogram("gaokao_stage_seconds", "Wall time of each stage of query / build / sync operations.",
+                          ("op", "stage"), _cfg().get("buckets", _DEFAULT_BUCKETS))
+CANDIDATES = Histogram("gaokao_ann_candidates", "ANN candidates returned by the vector store per query.",
+                       ("op",), _CANDIDATE_BUCKETS)
+
+
+class Trace:
+    """Stage times (seconds, summed per stage) and notes of one call, filled by the spans inside it."""
+    __slots__ = ("stages", "info")
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.info: Dict[str, object] = {"candidates": 0}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def stages_ms(self) -> Dict[str, float]:
+        return {k: round(v * 1000.0, 3) for k, v in self.stages.items()}
+
+
+TRACE: contextvars.ContextVar = contextvars.ContextVar("gaokao_trace", default=None)
+
+
+def current_trace() -> Trace | None:
+    return TRACE.get()
+
+
+class _Span:
+    __slots__ = ("op", "stage", "t0")
+
+    def __init__(self, op: str, stage: str):
+        self.op, self.stage = op, stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        dt = time.perf_counter() - self.t0
+        if ENABLED:
+            STAGE_SECONDS.observe(dt, self.op, self.stage)
+        trace = TRACE.get()
+        if trace is not None:
+            trace.add(self.stage, dt)
+        return False
+
+
+def span(op: str, stage: str = "total"):
+    """Context manager timing `stage` of `op` (no-op when metrics are disabled and nothing is traced)."""
+    return _Span(op, stage) if ENABLED or TRACE.get() is not None else _NOOP
+
+
+def candidates(op: str, n: int):
+    if ENABLED:
+        CANDIDATES.observe(n, op)
+    trace = TRACE.get()
+    if trace is not None:
+        trace.info["candidates"] += n
+
+
+def note(key: str, value):
+    """Records `key` on the active trace, if any (e.g. which path served a query)."""
+    trace = TRACE.get()
+    if trace is not None:
+        trace.info[key] = value
+
+
+def reset():
+    STAGE_SECONDS.reset()
+    CANDIDATES.reset()
+
+
+# ---- scrape-time gauges ----
+def _gauge(name: str, help: str, samples, kind: str = "gauge") -> List[str]:
+    samples = list(samples)
+    if not samples:
+        return []
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}"] + \
+           [f"{name}{_labels(labels)} {float(v)!r}" for labels, v in samples]
+
+
+def _index_samples():
+    from .runtime import RUNTIME
+    if not RUNTIME.is_loaded("store"):
+        return [], []
+    store = RUNTIME.get("store")
+    try:
+        vectors = [([("store", CFG.store_name)], store.count())]
+    except Exception as e:
+        print(f"[metrics] store.count() failed: {e}")
+        vectors = []
+    files = []
+    path = getattr(store, "index_file_path", None)
+    if path is not None:
+        # 索引本身按 mmap 读取，磁盘文件大小即常驻上限；序列化整个索引代价太高，不在抓取时做
+        from .store.attributes import AttributeIndex
+        for kind, p in (("index", path), ("ids", store._ids_path(path)), ("rescore", store._raw_path(path)),
+                        ("attributes", AttributeIndex.path_for(path))):
+            try:
+                files.append(([("store", CFG.store_name), ("file", kind)], p.stat().st_size))
+            except OSError:
+                pass
+    return vectors, files
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    from . import embed, hub, neardup, retriever
+    from .runtime import RUNTIME
+    lines = STAGE_SECONDS.render() + CANDIDATES.render()
+    vectors, files = _index_samples()
+    lines += _gauge("gaokao_index_vectors", "Vectors in the serving index.", vectors)
+    lines += _gauge("gaokao_index_file_bytes", "On-disk size of the serving FAISS index files.", files)
+    lines += _gauge("gaokao_component_load_seconds", "Time taken to initialize each runtime component.",
+                    [([("component", n)], s) for n, s in sorted(RUNTIME.load_seconds.items())])
+    models = hub.loaded_models()
+    lines += _gauge("gaokao_model_load_seconds", "Load time of each resident model.",
+                    [([("model", m["name"]), ("device", m["device"]), ("backend", m["backend"])], m["load_seconds"])
+                     for m in models])
+    lines += _gauge("gaokao_model_memory_bytes", "Approximate memory of each resident model.",
+                    [([("model", m["name"]), ("device", m["device"]), ("backend", m["backend"])],
+                      m["memory_mb"] * 2**20) for m in models if m["memory_mb"] is not None])
+    if retriever.RESULT_CACHE is not None:
+        st = retriever.RESULT_CACHE.stats()
+        lines += _gauge("gaokao_result_cache_requests_total", "Result cache lookups.",
+                        [([("result", "hit")], st["hits"]), ([("result", "miss")], st["misses"]),
+                         ([("result", "shared_inflight")], st["shared_inflight"])], kind="counter")
+        lines += _gauge("gaokao_result_cache_entries", "Entries in the result cache.", [([], st["entries"])])
+    if embed.FORMULA_CACHE is not None:
+        c = embed.FORMULA_CACHE.counters()
+        lines += _gauge("gaokao_formula_lookups_total", "Formula vector lookups by outcome.",
+                        [([("result", "lru_hit")], c["lru_hits"]), ([("result", "disk_hit")], c["disk_hits"]),
+                         ([("result", "encoded")], c["encoded"])], kind="counter")
+    nd = neardup.STATS
+    lines += _gauge("gaokao_near_duplicate_lookups_total", "Near-duplicate fast path lookups by outcome.",
+                    [([("result", "hit")], nd["hits"]), ([("result", "miss")], nd["lookups"] - nd["hits"])],
+                    kind="counter")
+    return "\n".join(lines) + "\n"
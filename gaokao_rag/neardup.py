@@ -0,0 +1,217 @@
+# gaokao_rag/neardup.py
+"""
+Near-duplicate fast path: MinHash LSH over character shingles of the stems.
+
+Stems are NFKC/whitespace-normalized, their formulas replaced by the canonical
+LaTeX form (formula.canonicalize) and cut into character n-grams. Each stem
+gets a `num_perm`-value MinHash signature; the signature is split into `bands`
+bands whose hashes are kept as sorted arrays, so a lookup is a handful of
+`np.searchsorted` calls and no model runs. Candidates sharing a band are
+verified with the estimated Jaccard similarity (fraction of equal MinHash
+values) against `neardup.threshold`.
+
+build_index writes the index next to the FAISS index (`neardup.npz`, inside
+the version directory when versioning is on), optionally with each item's
+precomputed ANN neighbours, and sync_index updates it incrementally.
+"""
+import os
+import threading
+import zlib
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from .cfg import CFG, ROOT
+from .formula import PATTERN, canonicalize
+from .result_cache import normalize_stem
+
+FILE = "neardup.npz"
+_PRIME = np.uint64(4294967291)       # 小于 2^32 的最大素数
+_MAX_BUCKET = 256                     # 单个桶最多取多少候选 (防止极短题干挤满一个桶)
+
+
+def _cfg() -> dict:
+    return CFG.base.get("neardup", {}) or {}
+
+
+def enabled() -> bool:
+    return bool(_cfg().get("enabled", True))
+
+
+def neighbours_wanted() -> int:
+    return int(_cfg().get("neighbours", 0) or 0)
+
+
+def index_path() -> Path | None:
+    """Where the published near-duplicate index lives (None before the first FAISS version)."""
+    from . import versions
+    if versions.enabled():
+        cur = versions.current_version()
+        return None if cur is None else versions.version_path(cur) / FILE
+    p = _cfg().get("path", "models/neardup.npz")
+    return Path(p) if os.path.isabs(p) else ROOT / p
+
+
+def shingle_text(stem: str) -> str:
+    """Normalized stem with canonical formulas and no whitespace."""
+    text = PATTERN.sub(lambda m: canonicalize(m.group(0)), normalize_stem(str(stem)))
+    return "".join(text.split())
+
+
+def _params(num_perm: int, bands: int, seed: int):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 31, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, 2 ** 32, size=num_perm, dtype=np.uint64)
+    mult = rng.integers(1, 2 ** 63, size=num_perm // bands, dtype=np.uint64) | np.uint64(1)
+    return a, b, mult
+
+
+class NearDupIndex:
+    def __init__(self, ids: np.ndarray, sigs: np.ndarray, nbr_ids: np.ndarray, nbr_scores: np.ndarray,
+                 shingle: int, bands: int, seed: int = 0):
+        self.ids = ids                  # str[N]
+        self.sigs = sigs                # uint32[N, num_perm]
+        self.nbr_ids = nbr_ids          # str[N, n]，'' 表示空位
+        self.nbr_scores = nbr_scores    # float32[N, n]，归一化 ANN 分数
+        self.shingle = shingle
+        self.bands = bands
+        self.seed = seed
+        self._a, self._b, self._mult = _params(sigs.shape[1], bands, seed)
+        self._reindex()
+
+    # ---- construction ----
+    @classmethod
+    def empty(cls, num_perm: int = 128, bands: int = 32, shingle: int = 4, neighbours: int = 0,
+              seed: int = 0) -> "NearDupIndex":
+        if num_perm % bands:
+            raise ValueError(f"neardup.num_perm ({num_perm}) must be a multiple of neardup.bands ({bands})")
+        return cls(np.zeros(0, dtype=str), np.zeros((0, num_perm), dtype=np.uint32),
+                   np.zeros((0, neighbours), dtype=str), np.zeros((0, neighbours), dtype=np.float32),
+                   shingle, bands, seed)
+
+    @classmethod
+    def from_config(cls) -> "NearDupIndex":
+        c = _cfg()
+        return cls.empty(int(c.get("num_perm", 128)), int(c.get("bands", 32)), int(c.get("shingle", 4)),
+                         neighbours_wanted())
+
+    def _reindex(self):
+        keys = self._band_keys(self.sigs)                       # (N, bands)
+        self._order = np.argsort(keys, axis=0, kind="stable").T  # (bands, N)
+        self._keys = np.take_along_axis(keys.T, self._order, axis=1) if len(keys) else keys.T
+
+    def _band_keys(self, sigs: np.ndarray) -> np.ndarray:
+        r = sigs.shape[1] // self.bands
+        with np.errstate(over="ignore"):    # uint64 乘法按 2^64 回绕，正是想要的哈希
+            return (sigs.reshape(len(sigs), self.bands, r).astype(np.uint64) * self._mult).sum(axis=2)
+
+    def signature(self, stem: str) -> np.ndarray:
+        text = shingle_text(stem)
+        n = self.shingle
+        grams = {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
+        hv = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)) % _PRIME
+        return ((self._a[:, None] * hv[None, :] + self._b[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+    def signatures(self, stems: List[str]) -> np.ndarray:
+        out = np.zeros((len(stems), self.sigs.shape[1]), dtype=np.uint32)
+        for i, s in enumerate(stems):
+            out[i] = self.signature(s)
+        return out
+
+    def update(self, removed: List[str], ids: List[str], stems: List[str],
+               nbr_ids: np.ndarray | None = None, nbr_scores: np.ndarray | None = None):
+        """
+        Drops `removed` and (re)inserts `ids` (edited stems replace their old
+        signature). `nbr_ids` / `nbr_scores` must have this index's neighbour width.
+        """
+        drop = set(removed) | set(ids)
+        keep = np.array([i not in drop for i in self.ids.tolist()], dtype=bool)
+        n = self.nbr_ids.shape[1]
+        if nbr_ids is None:
+            nbr_ids, nbr_scores = np.full((len(ids), n), ""), np.zeros((len(ids), n), dtype=np.float32)
+        self.ids = np.concatenate([self.ids[keep].astype(object), np.asarray(ids, dtype=object)]).astype(str)
+        self.sigs = np.concatenate([self.sigs[keep], self.signatures(stems)])
+        self.nbr_ids = np.concatenate([self.nbr_ids[keep].astype(object),
+                                       np.asarray(nbr_ids, dtype=object).reshape(len(ids), n)]).astype(str)
+        self.nbr_scores = np.concatenate([self.nbr_scores[keep],
+                                          np.asarray(nbr_scores, dtype=np.float32).reshape(len(ids), n)])
+        self._reindex()
+
+    # ---- lookup ----
+    def lookup(self, stem: str, threshold: float) -> Tuple[int, float] | None:
+        """Row and estimated Jaccard of the most similar indexed stem, if ≥ threshold."""
+        if not len(self.ids):
+            return None
+        sig = self.signature(stem)
+        qk = self._band_keys(sig[None, :])[0]
+        cand = []
+        for b in range(self.bands):
+            lo, hi = np.searchsorted(self._keys[b], qk[b], "left"), np.searchsorted(self._keys[b], qk[b], "right")
+            if hi > lo:
+                cand.append(self._order[b, lo:min(hi, lo + _MAX_BUCKET)])
+        if not cand:
+            return None
+        rows = np.unique(np.concatenate(cand))
+        sim = (self.sigs[rows] == sig).mean(axis=1)
+        best = int(np.argmax(sim))
+        return (int(rows[best]), float(sim[best])) if sim[best] >= threshold else None
+
+    def neighbours(self, row: int) -> Tuple[List[str], np.ndarray]:
+        ids = self.nbr_ids[row] if self.nbr_ids.shape[1] else np.zeros(0, dtype=str)
+        keep = ids != ""
+        return ids[keep].tolist(), self.nbr_scores[row][keep]
+
+    # ---- persistence ----
+    def save(self, path):
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}.npz")
+        np.savez(tmp, ids=self.ids, sigs=self.sigs, nbr_ids=self.nbr_ids, nbr_scores=self.nbr_scores,
+                 params=np.array([self.shingle, self.bands, self.seed], dtype=np.int64))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path) -> "NearDupIndex":
+        with np.load(path, allow_pickle=False) as z:
+            shingle, bands, seed = z["params"].tolist()
+            return cls(z["ids"], z["sigs"], z["nbr_ids"], z["nbr_scores"], shingle, bands, seed)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def ann_neighbours(store, ids: List[str], vecs: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-`n` ANN neighbours of every item (itself excluded), scores normalized by ‖v‖²."""
+    out_ids = np.full((len(ids), n), "", dtype=object)
+    out_scores = np.zeros((len(ids), n), dtype=np.float32)
+    if n <= 0:
+        return out_ids.astype(str), out_scores
+    for start in range(0, len(ids), 1024):
+        chunk = np.asarray(vecs[start:start + 1024], dtype=np.float32)
+        qq = np.maximum(np.einsum("ij,ij->i", chunk, chunk), 1e-12)
+        for r, (hit_ids, hit_scores) in enumerate(store.search_batch(chunk, n + 1)):
+            row = start + r
+            pairs = [(h, s) for h, s in zip(hit_ids, hit_scores) if h != ids[row]][:n]
+            for j, (h, s) in enumerate(pairs):
+                out_ids[row, j] = h
+                out_scores[row, j] = min(max(s / qq[r], 0.0), 1.0)
+    return out_ids.astype(str), out_scores
+
+
+# ---- hit-rate counters (per process) ----
+_LOCK = threading.Lock()
+STATS = {"lookups": 0, "hits": 0, "no_neighbours": 0}
+
+
+def record(hit: bool, no_neighbours: bool = False):
+    with _LOCK:
+        STATS["lookups"] += 1
+        STATS["hits"] += int(hit)
+        STATS["no_neighbours"] += int(no_neighbours)
+
+
+def stats(index: NearDupIndex | None = None) -> dict:
+    n = STATS["lookups"]
+    return {"enabled": enabled(), "threshold": float(_cfg().get("threshold", 0.9)),
+            "indexed": len(index) if index is not None else 0,
+            **STATS, "hit_rate": STATS["hits"] / n if n else 0.0}
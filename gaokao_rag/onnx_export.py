@@ -0,0 +1,111 @@
+# gaokao_rag/onnx_export.py
+"""
+ONNX Runtime backends for the encoders and the reranker.
+
+`export(name)` converts a local model under models/ to `onnx/model.onnx`
+(plus, optionally, a dynamically int8-quantized `onnx/model_qint8_*.onnx`)
+inside the model directory. Selecting `backend: onnx` / `onnx-int8` for a
+model in conf/model.yaml makes hub.get_model load that graph through
+sentence-transformers' ONNX backend, so embed.encode and the reranker keep
+calling the same `.encode` / `.predict` API.
+
+`parity(name, backend)` compares a backend against torch on corpus stems:
+per-row cosine deviation of the embeddings (or absolute score difference for
+the reranker) and the top-k overlap of the resulting rankings.
+"""
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from .cfg import CFG
+from .hub import ONNX_FILE, get_model, model_path, onnx_file
+
+MODEL_KINDS = {"text": "bi_encoder", "math": "bi_encoder", "rerank": "cross_encoder"}
+
+
+def _load_onnx(path: Path, kind: str):
+    # 目录里还没有 onnx/model.onnx 时，sentence-transformers 会用 optimum 即时导出
+    if kind == "cross_encoder":
+        from sentence_transformers import CrossEncoder
+        return CrossEncoder(str(path), device="cpu", backend="onnx")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(str(path), device="cpu", backend="onnx", trust_remote_code=True)
+
+
+def export(name: str, quantize: bool = True) -> Dict[str, str]:
+    """Writes the ONNX (and int8) graphs of model `name` into its local directory."""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    local = model_path(name)
+    had_onnx = (local / ONNX_FILE).exists()
+    model = _load_onnx(local, MODEL_KINDS[name])
+    if not had_onnx:
+        # 只把导出的 onnx/ 拷回模型目录，不覆盖原有的 torch 权重与配置
+        with tempfile.TemporaryDirectory() as tmp:
+            model.save_pretrained(tmp)
+            (local / "onnx").mkdir(exist_ok=True)
+            for f in (Path(tmp) / "onnx").iterdir():
+                shutil.copy2(f, local / "onnx" / f.name)
+    written = {"onnx": str(local / ONNX_FILE)}
+
+    if quantize:
+        export_dynamic_quantized_onnx_model(model, CFG.model.get("onnx_quantization", "avx512_vnni"), str(local))
+        written["onnx-int8"] = str(local / onnx_file(name, "onnx-int8"))
+    return written
+
+
+def _parity_texts(name: str, sample: int) -> List[str]:
+    from .formula import split
+    from .runtime import RUNTIME
+    from . import retriever  # noqa: F401  (registers the "df" runtime component)
+
+    stems = [str(s) for s in RUNTIME.get("df")["stem"].dropna()]
+    rng = np.random.default_rng(0)
+    stems = [stems[i] for i in rng.permutation(len(stems))[:sample]]
+    if name == "math":
+        return [f for s in stems for f in split(s)[1]][:sample]
+    if name == "text":
+        return [split(s)[0] for s in stems]
+    return stems
+
+
+def _topk_overlap(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    """Mean |top-k(a_i) ∩ top-k(b_i)| / k over the rows of two score matrices."""
+    k = min(k, a.shape[1])
+    ta = np.argpartition(-a, k - 1, axis=1)[:, :k]
+    tb = np.argpartition(-b, k - 1, axis=1)[:, :k]
+    return float(np.mean([len(set(x) & set(y)) / k for x, y in zip(ta.tolist(), tb.tolist())]))
+
+
+def parity(name: str, backend: str = "onnx-int8", sample: int = 200, k: int = 10) -> dict:
+    """Compares `backend` against torch for model `name` on a sample of corpus stems."""
+    texts = _parity_texts(name, sample)
+    if len(texts) < 2:
+        return {"model": name, "backend": backend, "n": len(texts), "error": "not enough texts"}
+    ref = get_model(name, device="cpu", kind=MODEL_KINDS[name], backend="torch")
+    alt = get_model(name, device="cpu", kind=MODEL_KINDS[name], backend=backend)
+
+    if MODEL_KINDS[name] == "bi_encoder":
+        ea = np.asarray(ref.encode(texts, normalize_embeddings=True), dtype=np.float32)
+        eb = np.asarray(alt.encode(texts, normalize_embeddings=True), dtype=np.float32)
+        dev = 1.0 - np.sum(ea * eb, axis=1)
+        # 以样本自身为语料：每行的近邻排序是否一致
+        sa, sb = ea @ ea.T, eb @ eb.T
+        np.fill_diagonal(sa, -np.inf)
+        np.fill_diagonal(sb, -np.inf)
+        report = {"cosine_deviation_mean": float(dev.mean()),
+                  "cosine_deviation_max": float(dev.max())}
+    else:
+        # 每道题与其余样本题组成 (query, candidate) 对，比较 cross-encoder 分数与排序
+        n = min(len(texts), 50)
+        pairs = [(texts[i], texts[j]) for i in range(n) for j in range(n) if i != j]
+        sa = np.asarray(ref.predict(pairs, convert_to_numpy=True), dtype=np.float32).reshape(n, n - 1)
+        sb = np.asarray(alt.predict(pairs, convert_to_numpy=True), dtype=np.float32).reshape(n, n - 1)
+        diff = np.abs(sa - sb)
+        report = {"score_abs_diff_mean": float(diff.mean()),
+                  "score_abs_diff_max": float(diff.max())}
+    return {"model": name, "backend": backend, "n": len(texts), "k": k,
+            **report, f"top{k}_overlap": _topk_overlap(sa, sb, k)}
@@ -0,0 +1,146 @@
+# gaokao_rag/parallel_encode.py
+"""
+Multi-process sharded encoding for large imports (`ragmath import --workers N`).
+
+The parent looks stems up in the embedding cache and splits the misses into
+shards of `encode.shard_rows`. A spawn-context pool of N workers loads both
+encoders once per process (on its first task), with torch intra-op threads capped at
+cpu_count // N (`encode.threads_per_worker`) so the pool does not oversubscribe
+the machine. Every worker writes its rows straight into one shared
+memory-mapped float32 file at their original positions, so the result is
+already in corpus order when the pool finishes.
+"""
+import multiprocessing as mp
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from .cfg import CFG
+
+
+def _threads_per_worker(workers: int) -> int:
+    n = int(CFG.encode.get("threads_per_worker", 0) or 0)
+    return n if n > 0 else max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(threads: int):
+    # 必须在 torch 建立线程池之前设置
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+    # 模型不在 initializer 里加载：initializer 出错时 Pool 会无限重启 worker，
+    # 放到任务里出错则会作为异常抛回父进程。每个进程仍只加载一次 (RUNTIME 缓存)。
+
+
+def _worker_dims():
+    from .embed import text_dim, math_dim
+    return text_dim(), math_dim()
+
+
+def _encode_shard(task):
+    positions, stems, out_path, shape, batch_size, with_math = task
+    from . import embed
+    from .embed import encode_batch, formula_counters
+    before = formula_counters()
+    vecs = encode_batch(stems, batch_size=batch_size, with_math=with_math)
+    after = formula_counters()
+    if embed.FORMULA_CACHE is not None:
+        embed.FORMULA_CACHE.flush()     # 进程池退出时不跑 atexit：新公式在此写完
+    out = np.memmap(out_path, dtype=np.float32, mode="r+", shape=shape)
+    out[positions] = vecs
+    out.flush()
+    del out
+    return len(stems), {c: after[c] - before[c] for c in after}
+
+
+def encode_parallel(stems: List[str], workers: int, batch_size: int = 64,
+                    with_math: bool = True) -> Tuple[np.ndarray, Dict[str, int] | None]:
+    """
+    `encode_cached` spread over `workers` processes; rows come back in input order.
+    Also returns the workers' summed formula-cache counters (None if no pool was started).
+    """
+    from .cache import EmbedCache, FORMULA_COUNTERS
+    from .embed import encode_cached, set_dims
+
+    cache = EmbedCache('mixed' if with_math else 'text') if CFG.cache.get('enabled', True) else None
+    try:
+        hits, misses = cache.get_many(stems) if cache else ({}, list(range(len(stems))))
+        if cache and not misses:    # 全部命中缓存：不值得启动进程池
+            cache.close()
+            cache = None
+            return encode_cached(stems, batch_size=batch_size, with_math=with_math), None
+        threads = _threads_per_worker(workers)
+        print(f"[encode] starting {workers} workers × {threads} torch threads "
+              f"for {len(misses)} uncached rows...")
+        ctx = mp.get_context("spawn")    # fork 后的 torch / tokenizers 线程池不可靠
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(threads,)) as pool, \
+                tempfile.TemporaryDirectory(prefix="ragmath-encode-") as tmp:
+            text_d, math_d = pool.apply(_worker_dims)
+            set_dims(text_d, math_d)                 # 父进程无需再加载模型
+            dim = CFG.embed_dim if with_math else text_d
+            shape = (len(stems), dim)
+            out_path = str(Path(tmp) / "vectors.f32")
+            out = np.memmap(out_path, dtype=np.float32, mode="w+", shape=shape)
+            for pos, v in hits.items():
+                if v.shape[0] == dim:
+                    out[pos] = v
+                else:                       # 维度对不上，当作未命中
+                    misses.append(pos)
+            misses.sort()
+            out.flush()
+
+            shard = int(CFG.encode.get("shard_rows", 0) or batch_size * 8)
+            tasks = [(misses[i:i + shard], [stems[j] for j in misses[i:i + shard]],
+                      out_path, shape, batch_size, with_math)
+                     for i in range(0, len(misses), shard)]
+            formula = dict.fromkeys(FORMULA_COUNTERS, 0)     # worker 各自的公式缓存计数之和
+            with tqdm(total=len(misses), unit="row", desc=f"encode ×{workers}") as bar:
+                for n, counts in pool.imap_unordered(_encode_shard, tasks):
+                    bar.update(n)
+                    for c in formula:
+                        formula[c] += counts[c]
+            vecs = np.array(out)    # 拷回进程内存；临时文件随目录删除
+            del out
+        if cache and misses:
+            cache.put_many([stems[i] for i in misses], vecs[misses])
+        print(f"[cache] {len(stems) - len(misses)} cached, {len(misses)} encoded")
+    finally:
+        if cache:
+            cache.close()
+    return vecs, formula
+
+
+def encode_corpus(stems: List[str], with_math: bool = True, workers: int | None = None) -> np.ndarray:
+    """Corpus encoding for build_index / build_text_index: cached, optionally multi-process, with throughput."""
+    from .cache import formula_hit_rates
+    from .embed import encode_cached, formula_counters, formula_report
+
+    workers = int(workers or CFG.encode.get("workers", 1) or 1)
+    t0, before = time.perf_counter(), formula_counters()
+    formula = None
+    if workers > 1 and len(stems) > 1:
+        vecs, formula = encode_parallel(stems, workers, batch_size=CFG.encode_batch_size, with_math=with_math)
+    else:
+        workers = 1
+        vecs = encode_cached(stems, batch_size=CFG.encode_batch_size, with_math=with_math)
+    dt = max(time.perf_counter() - t0, 1e-9)
+    print(f"[encode] {len(stems)} rows in {dt:.1f}s ({len(stems) / dt:.1f} rows/s, {workers} worker(s))")
+    if with_math:
+        print_formula_report(formula_hit_rates(formula) if formula is not None else formula_report(before))
+    return vecs
+
+
+def print_formula_report(r: dict):
+    print(f"[formula-cache] {r['lookups']} formulas: {r['lru_hits']} LRU hits, {r['disk_hits']} disk hits, "
+          f"{r['encoded']} encoded (hit rate {r['hit_rate']:.1%})")
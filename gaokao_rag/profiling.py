@@ -0,0 +1,144 @@
+# gaokao_rag/profiling.py
+"""
+On-demand sampled profile of a single request (admin only, see api.py).
+
+`profile_call(fn, ...)` runs `fn` in the calling thread while a background
+thread samples that thread's Python stack every `profiling.interval_ms`
+(sys._current_frames). The report gives the exact stage breakdown from the
+request's metrics.Trace, the share of samples spent inside the three hot calls
+— embed.encode (and encode_batch / encode_formulas), the vector store's
+search and the cross-encoder's predict — plus the hottest functions and
+collapsed stacks. Native code (torch, FAISS) is attributed to the Python frame
+that called it.
+
+Access needs `X-Admin-Token` equal to `profiling.admin_token` (conf/base.yaml)
+or the GAOKAO_ADMIN_TOKEN environment variable; with neither set, profiling
+is off.
+"""
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Tuple
+
+from . import metrics
+from .cfg import CFG, ROOT
+
+_PKG = str(ROOT / "gaokao_rag")
+# 采样线程要拿到 GIL 才能采样：剖析期间把解释器的线程切换间隔 (默认 5 ms) 调到采样间隔以下
+_SWITCH_LOCK = threading.Lock()
+_SWITCH = {"active": 0, "saved": None}
+
+# 热点调用：样本栈中出现任一 (文件路径片段, 函数名) 即计入该组件
+COMPONENTS = {
+    "embed.encode": (("gaokao_rag/embed.py", "encode"), ("gaokao_rag/embed.py", "encode_batch"),
+                     ("gaokao_rag/embed.py", "encode_formulas")),
+    "store.search": (("gaokao_rag/store/", "search"), ("gaokao_rag/store/", "search_batch")),
+    "reranker.predict": (("", "predict"),),
+}
+
+
+def _cfg() -> dict:
+    return CFG.base.get("profiling", {}) or {}
+
+
+def admin_token() -> str:
+    return os.environ.get("GAOKAO_ADMIN_TOKEN") or str(_cfg().get("admin_token") or "")
+
+
+def authorized(token: str | None) -> bool:
+    expected = admin_token()
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def _frame_key(code) -> Tuple[str, str]:
+    path = code.co_filename.replace("\\", "/")
+    if path.startswith(_PKG):
+        path = "gaokao_rag" + path[len(_PKG):]
+    else:
+        parts = path.split("/site-packages/")
+        path = parts[-1] if len(parts) > 1 else os.path.basename(path)
+    return path, code.co_name
+
+
+class Sampler:
+    """Samples the Python stack of one thread at a fixed interval."""
+
+    def __init__(self, thread_id: int, interval_s: float):
+        self.thread_id = thread_id
+        self.interval = interval_s
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_key(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+                self.samples += 1
+
+    def __enter__(self):
+        with _SWITCH_LOCK:
+            if not _SWITCH["active"]:
+                _SWITCH["saved"] = sys.getswitchinterval()
+                sys.setswitchinterval(min(_SWITCH["saved"], self.interval / 2))
+            _SWITCH["active"] += 1
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        with _SWITCH_LOCK:
+            _SWITCH["active"] -= 1
+            if not _SWITCH["active"]:
+                sys.setswitchinterval(_SWITCH["saved"])
+        return False
+
+    def report(self, top: int = 25) -> dict:
+        n = max(self.samples, 1)
+        own, total, comp = Counter(), Counter(), Counter()
+        for stack, c in self.stacks.items():
+            own[stack[-1]] += c
+            for key in set(stack):
+                total[key] += c
+            for name, patterns in COMPONENTS.items():
+                if any(fn == want and part in f for f, fn in stack for part, want in patterns):
+                    comp[name] += c
+        fmt = lambda key: f"{key[0]}:{key[1]}"
+        return {
+            "interval_ms": round(self.interval * 1000.0, 3),
+            "samples": self.samples,
+            "components": {name: {"samples": comp[name], "share": round(comp[name] / n, 4)} for name in COMPONENTS},
+            "top_functions": [{"function": fmt(key), "self": own[key], "total": total[key],
+                               "self_share": round(own[key] / n, 4)}
+                              for key, _ in own.most_common(top)],
+            "stacks": [{"stack": ";".join(fmt(k) for k in stack), "samples": c}
+                       for stack, c in self.stacks.most_common(top)],
+        }
+
+
+def profile_call(fn: Callable, *args, **kwargs) -> Tuple[object, Dict]:
+    """Runs `fn(*args, **kwargs)` under a trace and the stack sampler; returns (result, profile)."""
+    interval = float(_cfg().get("interval_ms", 1)) / 1000.0
+    trace = metrics.Trace()
+    token = metrics.TRACE.set(trace)
+    t0 = time.perf_counter()
+    try:
+        with Sampler(threading.get_ident(), interval) as sampler:
+            result = fn(*args, **kwargs)
+    finally:
+        metrics.TRACE.reset(token)
+    ms = (time.perf_counter() - t0) * 1000.0
+    profile = {"total_ms": round(ms, 3), "path": trace.info.get("path", "cache"),
+               "candidates": trace.info.get("candidates", 0), "stages_ms": trace.stages_ms(),
+               **sampler.report(int(_cfg().get("top", 25)))}
+    return result, profile
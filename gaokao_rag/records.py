@@ -0,0 +1,51 @@
+# gaokao_rag/records.py
+"""
+Compact columnar view of the question bank for the query hot path.
+
+Each problem gets an integer ordinal; difficulty lives in a float array and
+stems in one packed UTF-8 buffer with an offsets array, so candidate metadata
+is gathered with NumPy fancy indexing instead of per-row `DF.loc` lookups.
+"""
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+
+class ProblemRecords:
+    def __init__(self, ids: List[str], stems: List[str], difficulty: np.ndarray):
+        self.ids = np.asarray(ids, dtype=object)
+        self.ordinal: Dict[str, int] = {i: n for n, i in enumerate(ids)}
+        self.difficulty = np.asarray(difficulty, dtype=np.float64)   # NaN = 未标注难度
+
+        encoded = [s.encode("utf-8") for s in stems]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.blob = b"".join(encoded)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "ProblemRecords":
+        stems = df["stem"] if "stem" in df.columns else pd.Series([None] * len(df), index=df.index)
+        diff = (pd.to_numeric(df["difficulty"], errors="coerce").to_numpy(dtype=np.float64)
+                if "difficulty" in df.columns else np.full(len(df), np.nan))
+        return cls([str(i) for i in df.index],
+                   ["" if pd.isna(s) else str(s) for s in stems],
+                   diff)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, item_id) -> bool:
+        return str(item_id) in self.ordinal
+
+    def ordinals(self, ids: Iterable) -> np.ndarray:
+        """String ids → ordinals; unknown ids map to -1."""
+        get = self.ordinal.get
+        return np.fromiter((get(str(i), -1) for i in ids), dtype=np.int64)
+
+    def stem(self, ordinal: int) -> str:
+        return self.blob[self.offsets[ordinal]:self.offsets[ordinal + 1]].decode("utf-8")
+
+    def stems(self, ordinals: np.ndarray) -> List[str]:
+        starts, ends = self.offsets[ordinals], self.offsets[np.asarray(ordinals) + 1]
+        return [self.blob[a:b].decode("utf-8") for a, b in zip(starts, ends)]
@@ -0,0 +1,107 @@
+# gaokao_rag/rerank.py
+"""
+Cross-encoder reranking driver: full mode or an adaptive cascade.
+
+Cascade mode scores candidates in ANN order, chunk by chunk, and stops a query
+once its top-k can no longer change (provable bound) or the ANN score gap to
+the next unscored candidate exceeds `margin` (heuristic). A near-exact ANN top
+hit skips the cross-encoder entirely. Chunks of all still-active queries are
+scored together, so a batch costs one `predict` call per round.
+"""
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+
+def rerank_many(queries: List[Dict],
+                predict: Callable[[List[Tuple[str, str]]], Sequence[float]],
+                cand_text: Callable[[str], str],
+                score_fn: Callable[[List[str], np.ndarray], np.ndarray],
+                k: int,
+                mode: str = "full",
+                chunk: int = 8,
+                margin: float = 0.05,
+                exact_match: float | None = None) -> Tuple[List[Tuple[List[str], np.ndarray]], dict]:
+    """
+    Args:
+        queries: One dict per query with keys `stem`, `cids` (ANN order),
+                 `ann` (ANN inner products) and `qq` (query self inner product,
+                 used to make thresholds scale-free).
+        predict: Cross-encoder call on (query, candidate) pairs; scores in [0, 1].
+        cand_text: Candidate id (or ordinal) → stem text.
+        score_fn: Final (hybrid) score for candidate ids given rerank scores;
+                  must be non-decreasing in the rerank score.
+        k: Number of results the caller will keep.
+        mode: "full" scores every candidate, "cascade" stops early.
+        chunk: Candidates per query scored per round in cascade mode.
+        margin: Relative ANN gap (fraction of qq) that counts as "stable".
+        exact_match: Cascade only: if ann[0] >= exact_match * qq, skip the cross-encoder.
+
+    Returns:
+        Per query the scored candidate ids with their rerank scores, and a stats
+        dict (pairs scored, predict calls, skipped / early-stopped queries).
+    """
+    stats = {"pairs": 0, "calls": 0, "skipped": 0, "early_stop": 0}
+    n = len(queries)
+    scores: List[List[float]] = [[] for _ in range(n)]
+    done = [False] * n
+    out: List[Tuple[List[str], np.ndarray]] = [None] * n
+
+    for i, q in enumerate(queries):
+        ann, qq = np.asarray(q["ann"], dtype=np.float32), max(float(q["qq"]), 1e-12)
+        if not len(q["cids"]):
+            out[i], done[i] = ([], np.zeros(0, dtype=np.float32)), True
+        elif mode == "cascade" and exact_match is not None and ann[0] >= exact_match * qq:
+            # 几乎原题：直接用归一化 ANN 分数，不跑 cross-encoder
+            out[i], done[i] = (list(q["cids"]), np.clip(ann / qq, 0.0, 1.0)), True
+            stats["skipped"] += 1
+
+    first_round = True
+    while not all(done):
+        pairs, spans = [], []
+        for i, q in enumerate(queries):
+            if done[i]:
+                continue
+            start = len(scores[i])
+            if mode == "cascade":
+                step = max(chunk, k) if first_round else chunk
+            else:
+                step = len(q["cids"])
+            stop = min(start + step, len(q["cids"]))
+            pairs.extend((q["stem"], cand_text(cid)) for cid in q["cids"][start:stop])
+            spans.append((i, stop - start))
+        first_round = False
+
+        new_scores = np.asarray(predict(pairs), dtype=np.float32).reshape(-1)
+        stats["pairs"] += len(pairs)
+        stats["calls"] += 1
+
+        offset = 0
+        for i, m in spans:
+            scores[i].extend(new_scores[offset:offset + m].tolist())
+            offset += m
+            q = queries[i]
+            n_done = len(scores[i])
+            if n_done >= len(q["cids"]):
+                done[i] = True
+            elif mode == "cascade" and n_done >= k and _is_stable(q, scores[i], score_fn, k, margin):
+                done[i] = True
+                stats["early_stop"] += 1
+            if done[i]:
+                out[i] = (list(q["cids"][:n_done]), np.asarray(scores[i], dtype=np.float32))
+    return out, stats
+
+
+def _is_stable(q: Dict, rs: List[float], score_fn, k: int, margin: float) -> bool:
+    n_done = len(rs)
+    cids, ann, qq = q["cids"], np.asarray(q["ann"], dtype=np.float32), max(float(q["qq"]), 1e-12)
+    final = score_fn(cids[:n_done], np.asarray(rs, dtype=np.float32))
+    top = np.argsort(-final, kind="stable")[:k]
+    kth = final[top].min()
+
+    # 可证明：剩余候选即使 rerank 满分 (1.0) 也进不了 top-k
+    rest = cids[n_done:]
+    if score_fn(rest, np.ones(len(rest), dtype=np.float32)).max() < kth:
+        return True
+    # 启发式：当前 top-k 中 ANN 最弱者与下一个未打分候选的 ANN 差距足够大
+    return float(ann[top].min() - ann[n_done]) >= margin * qq
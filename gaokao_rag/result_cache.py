@@ -0,0 +1,106 @@
+# gaokao_rag/result_cache.py
+"""
+In-process LRU/TTL cache for query results with single-flight de-duplication.
+
+Keys are built by the caller (retriever) from the normalized stem, k, the
+scoring configuration and the index generation, so a rebuild or sync simply
+makes old entries unreachable; `clear()` frees them eagerly.
+"""
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, Tuple
+
+import regex as re
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_stem(stem: str) -> str:
+    """NFKC + collapsed whitespace, so trivially different copies share one entry."""
+    return _WS.sub(" ", unicodedata.normalize("NFKC", stem)).strip()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 10000, ttl_s: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: dict = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0     # 搭上同一份正在进行的计算的请求数
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if self.ttl_s <= 0 or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def claim(self, key: Hashable) -> Tuple[Future, bool]:
+        """Returns the in-flight future for `key` and whether the caller must compute it."""
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.shared += 1
+                return fut, False
+            fut = Future()
+            self._inflight[key] = fut
+            return fut, True
+
+    def resolve(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_s, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            fut = self._inflight.pop(key, None)
+        if fut is not None:
+            fut.set_result(value)
+
+    def fail(self, key: Hashable, exc: BaseException):
+        with self._lock:
+            fut = self._inflight.pop(key, None)
+        if fut is not None:
+            fut.set_exception(exc)
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        hit, value = self.lookup(key)
+        if hit:
+            return value
+        fut, owner = self.claim(key)
+        if not owner:
+            return fut.result()
+        try:
+            value = compute()
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+        self.resolve(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_inflight": self.shared,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
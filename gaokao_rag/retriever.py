@@ -1,154 +1,680 @@
 import pandas as pd
 import numpy as np
 import json
-from sentence_transformers import CrossEncoder
+import hashlib
+import shutil
+import threading
 from .hub import get_model
-from .embed import encode
+from .embed import encode, encode_batch, encode_cached, ensure_dims
 from .score import hybrid
 from .cfg import CFG, ROOT
-# Dynamic store import based on configuration
-if CFG.store_name == "milvus":
-    from .store import milvus as store_module
-elif CFG.store_name == "faiss":
-    from .store import faiss as store_module
-else:
+from .cache import model_identity
+from .result_cache import ResultCache, normalize_stem
+from .rerank import rerank_many
+from .records import ProblemRecords
+from .snapshot import read_corpus
+from .runtime import RUNTIME
+from .parallel_encode import encode_corpus
+from . import versions, neardup, filters, metrics, slowlog
+from .metrics import span
+from .neardup import NearDupIndex
+from .filters import normalize as normalize_filters
+# Store backend is chosen by configuration and created lazily (see _create_store)
+if CFG.store_name not in ("milvus", "faiss"):
     raise ImportError(f"Unsupported store type: {CFG.store_name}. Check conf/base.yaml.")
 
 # -------- data frame 缓存 --------
 # Ensure the data path is robust
 DATA_FILE_PATH = ROOT / 'data/df_gk_math.xlsx'
-DF = None
 def load_dataframe():
-    global DF
+    """(Re)reads the corpus into the runtime; RECORDS is rebuilt from it on next use."""
     if not DATA_FILE_PATH.exists():
         print(f"Warning: Data file not found at {DATA_FILE_PATH}. Queries might fail or use empty data.")
         # Create an empty DataFrame with expected columns to prevent downstream errors
-        DF = pd.DataFrame(columns=['id', 'stem', 'difficulty']).set_index("id")
-        return
-    try:
-        DF = pd.read_excel(DATA_FILE_PATH).set_index("id")
-    except Exception as e:
-        print(f"Error loading data from {DATA_FILE_PATH}: {e}")
-        DF = pd.DataFrame(columns=['id', 'stem', 'difficulty']).set_index("id")
-    DF.index = DF.index.astype(str)             # 只需在 load_dataframe() 里做一次
+        df = pd.DataFrame(columns=['id', 'stem', 'difficulty']).set_index("id")
+    else:
+        try:
+            df = read_corpus(DATA_FILE_PATH).set_index("id")   # 优先读二进制快照
+        except Exception as e:
+            print(f"Error loading data from {DATA_FILE_PATH}: {e}")
+            df = pd.DataFrame(columns=['id', 'stem', 'difficulty']).set_index("id")
+    df.index = df.index.astype(str)             # 只需在 load_dataframe() 里做一次
+    RUNTIME.set("df", df)
+    RUNTIME.invalidate("records")
+    return df
 
-load_dataframe() # Load on module import
+RUNTIME.register("df", load_dataframe)
+# 列式题库 (records.ProblemRecords)，查询热路径只用它
+RUNTIME.register("records", lambda: ProblemRecords.from_dataframe(RUNTIME.get("df")))
 
 # -------- store 选择 --------
-if CFG.store_name == "milvus":
-    STORE = store_module.MilvusStore()
-elif CFG.store_name == "faiss":
-    STORE = store_module.FaissStore() # Assuming FaissStore is defined in faiss.py
+# FAISS 索引按版本目录发布 (versions.py)；_STORE_VERSION 是本进程当前在用的版本
+_STORE_VERSION = None
+_SWAP_LOCK = threading.Lock()
+
+def _open_faiss(index_path=None, autosave=True):
+    ensure_dims()
+    from .store.faiss import FaissStore
+    return FaissStore(index_path_override=None if index_path is None else str(index_path), autosave=autosave)
+
+def _create_store():
+    global _STORE_VERSION
+    ensure_dims()   # 向量维度由模型探测得到
+    if CFG.store_name == "milvus":
+        from .store.milvus import MilvusStore
+        return MilvusStore()
+    cur = versions.current_version() if versions.enabled() else None
+    _STORE_VERSION = cur
+    # 还没有发布过版本时沿用旧的 models/faiss_index.bin
+    return _open_faiss(None if cur is None else versions.index_path(cur))
+
+RUNTIME.register("store", _create_store)
+
+def _swap_store(name: str):
+    """Opens version `name` and makes it the serving store; running queries keep the old object."""
+    global _STORE_VERSION
+    with _SWAP_LOCK:
+        if name == _STORE_VERSION and RUNTIME.is_loaded("store"):
+            return
+        RUNTIME.set("store", _open_faiss(versions.index_path(name)))
+        _STORE_VERSION = name
+    bump_index_generation()
+    print(f"[versions] serving index version {name}")
+
+def current_store():
+    """The serving store; switches to a newly published index version (from any process) first."""
+    if versions.enabled() and RUNTIME.is_loaded("store"):
+        cur = versions.current_version()
+        if cur is not None and cur != _STORE_VERSION:
+            _swap_store(cur)
+    return RUNTIME.get("store")
 
 # -------- reranker --------
-# Use a try-except block for model loading for robustness
-CE = None
-try:
-    # Assuming get_model("rerank") returns a SentenceTransformer-like object
-    # and CrossEncoder needs the model path or name from it.
-    # The original code was CE = CrossEncoder(get_model("rerank").model)
-    # This implies get_model("rerank") has a .model attribute which is the path/name for CrossEncoder
-    rerank_model_obj = get_model("rerank")
-    if hasattr(rerank_model_obj, 'model_path'): # Common for ST models
-        reranker_model_name_or_path = str(rerank_model_obj.model_path)
-    elif hasattr(rerank_model_obj, 'name_or_path'): # Common for HF models
-        reranker_model_name_or_path = str(rerank_model_obj.name_or_path)
-    else:
-        # Fallback: if get_model returns the raw SentenceTransformer, its path is often the first arg
-        reranker_model_name_or_path = str(ROOT / CFG.model["rerank"]["local"])
+def _create_reranker():
+    # Use a try-except block for model loading for robustness
+    try:
+        # 直接按路径加载为 CrossEncoder，并与其他模块共享同一实例 (见 hub.py)
+        return get_model("rerank", kind="cross_encoder")
+    except Exception as e:
+        print(f"Error loading CrossEncoder model: {e}. Reranking might not work.")
+        return None
 
-    CE = CrossEncoder(reranker_model_name_or_path, device=CFG.device)
-except Exception as e:
-    print(f"Error loading CrossEncoder model: {e}. Reranking might not work.")
+RUNTIME.register("reranker", _create_reranker)
 
-def build_index():
-    if DF is None or DF.empty:
-        print("Error: DataFrame is not loaded or is empty. Cannot build index.")
-        return
-    ids, vecs = [], []
-    print(f"Building index from {len(DF)} items...")
-    for _id, row in DF.iterrows():
-        if 'stem' not in row or pd.isna(row['stem']):
+# -------- near-duplicate fast path (neardup.py) --------
+def _load_neardup():
+    path = neardup.index_path() if neardup.enabled() else None
+    if path is None or not path.exists():
+        return None
+    try:
+        return NearDupIndex.load(path)
+    except Exception as e:
+        print(f"Error loading near-duplicate index {path}: {e}. Fast path disabled.")
+        return None
+
+RUNTIME.register("neardup", _load_neardup)
+
+_LAZY = {"DF": "df", "RECORDS": "records", "STORE": "store", "CE": "reranker"}
+
+def __getattr__(name):
+    # retriever.DF / STORE / CE / RECORDS 仍可访问，只是第一次访问时才初始化
+    if name in _LAZY:
+        return RUNTIME.get(_LAZY[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# -------- index manifest (id → stem hash) --------
+MANIFEST_PATH = ROOT / CFG.base.get('sync', {}).get('manifest', 'models/index_manifest.json')
+
+def stem_hash(stem: str) -> str:
+    return hashlib.sha256(stem.encode('utf-8')).hexdigest()[:16]
+
+def manifest_path():
+    """Manifest of the published index version (None before the first one), or MANIFEST_PATH."""
+    if versions.enabled():
+        cur = versions.current_version()
+        return None if cur is None else versions.version_path(cur) / versions.MANIFEST_FILE
+    return MANIFEST_PATH
+
+def load_manifest():
+    path = manifest_path()
+    if path is None or not path.exists():
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading index manifest {path}: {e}")
+        return None
+
+def save_manifest(items: dict, path=None, attrs: dict | None = None):
+    """`items`: id → stem hash; `attrs`: id → hash of its filter attributes (filters.row_hashes)."""
+    path = path or MANIFEST_PATH
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({"store": CFG.store_name, "model": model_identity("mixed"), "items": items,
+                   "attrs": attrs or {}}, f, ensure_ascii=False)
+    tmp.replace(path)
+
+# -------- query result cache + index generation --------
+_INDEX_GENERATION = 0
+RESULT_CACHE = None
+if CFG.result_cache.get('enabled', True):
+    RESULT_CACHE = ResultCache(max_entries=CFG.result_cache.get('max_entries', 10000),
+                               ttl_s=CFG.result_cache.get('ttl_s', 3600))
+
+def index_generation():
+    """
+    Changes whenever this process rebuilds/syncs the index, or another process
+    publishes a version / rewrites the manifest (e.g. another uvicorn worker
+    handled /import).
+    """
+    path = manifest_path()
+    try:
+        mtime = path.stat().st_mtime_ns if path is not None else 0
+    except OSError:
+        mtime = 0
+    cur = versions.current_version() if versions.enabled() else None
+    return (_INDEX_GENERATION, cur, mtime)
+
+def bump_index_generation():
+    global _INDEX_GENERATION
+    _INDEX_GENERATION += 1
+    RUNTIME.invalidate("neardup")       # 随索引一起重建 / 切换版本
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.clear()
+
+def _result_key(stem: str, k: int, f=None):
+    scoring = (CFG.topk_recall, CFG.diff_coeff, CFG.base['difficulty']['default'])
+    return (normalize_stem(stem), k, f, scoring, index_generation())
+
+def _indexable_rows():
+    ids, stems = [], []
+    for _id, stem in RUNTIME.get("df")['stem'].items():
+        if pd.isna(stem):
             print(f"Skipping item with id {_id} due to missing or NaN stem.")
             continue
-        try:
-            ids.append(str(_id)) # Ensure ID is string
-            vecs.append(encode(str(row.stem)))
-            
-        except Exception as e:
-            print(f"Error encoding item {_id} ('{row.stem}'): {e}")
+        ids.append(str(_id)) # Ensure ID is string
+        stems.append(str(stem))
+    return ids, stems
+
+def _indexable_attrs(ids):
+    """Filter attributes (filters.attributes) of the given ids, aligned with them."""
+    df = RUNTIME.get("df")
+    return filters.attributes(df[~df.index.duplicated()].loc[ids])
+
+def build_index(workers: int | None = None):
+    with span("build_index"):
+        return _build_index(workers)
+
+def _build_index(workers):
+    with span("build_index", "load"):
+        df = RUNTIME.get("df")
+    if df.empty:
+        print("Error: DataFrame is not loaded or is empty. Cannot build index.")
+        return
+    print(f"Building index from {len(df)} items...")
+    ids, stems = _indexable_rows()
     
     if not ids:
         print("No valid items to index after processing.")
         return
 
-    #vecs_np = np.array(vecs, dtype=np.float32) #这里改了
     try:
-        vecs_np = np.stack(vecs).astype('float32')   # (N, dim)
-    except ValueError as e:
-        # 堆叠失败 => 至少有一个子向量维度不同
-        print("❌ np.stack failed:", e)
-        for i, v in enumerate(vecs[:5]):            # 看前 5 条诊断
-            print(f"vec[{i}].shape =", getattr(v, "shape", None))
+        with span("build_index", "encode"):
+            vecs_np = encode_corpus(stems, workers=workers)   # (N, dim)，workers>1 时多进程分片编码
+    except Exception as e:
+        print(f"❌ encoding failed: {e}")
         return
     
-    STORE.build(ids, vecs_np) #这里改了
+    manifest = {i: stem_hash(s) for i, s in zip(ids, stems)}
+    attrs = _indexable_attrs(ids)
+    attr_hashes = dict(zip(ids, filters.row_hashes(attrs)))
+    if versions.enabled():
+        name = _publish_version(lambda store: store.build(ids, vecs_np, attrs), manifest, ids, vecs_np,
+                                extra=lambda store, staging: _write_neardup(
+                                    staging / neardup.FILE, store, ids, stems, vecs_np),
+                                attrs=attr_hashes)
+        print(f"Index built successfully with {len(ids)} items (version {name}).")
+        return
+    with span("build_index", "store_build"):
+        RUNTIME.get("store").build(ids, vecs_np, attrs) #这里改了
+    if neardup.enabled():
+        with span("build_index", "neardup"):
+            _write_neardup(neardup.index_path(), RUNTIME.get("store"), ids, stems, vecs_np)
+    save_manifest(manifest, attrs=attr_hashes)
+    bump_index_generation()
     print(f"Index built successfully with {len(ids)} items.")
 
-def query(stem: str, k=None):
+def _publish_version(apply, manifest: dict, probe_ids, probe_vecs, base: str | None = None,
+                     extra=None, attrs: dict | None = None) -> str:
+    """
+    Builds a new index version in a staging directory (starting from a copy
+    of version `base`, if given), validates it and publishes it atomically.
+    `extra(store, staging)` may write further files into the version (e.g. the
+    near-duplicate index). The serving store is never mutated.
+    """
+    staging = versions.new_staging_dir()
+    try:
+        if base is not None:
+            for f in versions.version_path(base).iterdir():
+                if f.name != versions.MANIFEST_FILE:
+                    shutil.copy2(f, staging / f.name)
+        store = _open_faiss(staging / versions.INDEX_FILE, autosave=False)
+        with span("publish", "store_apply"):
+            apply(store)
+        with span("publish", "store_save"):
+            store.save()   # 整个版本只落盘一次
+        if extra is not None:
+            with span("publish", "neardup"):
+                extra(store, staging)
+        save_manifest(manifest, staging / versions.MANIFEST_FILE, attrs)
+        with span("publish", "validate"):
+            _validate_version(staging, len(manifest), probe_ids, probe_vecs)
+        name = versions.publish(staging)
+    except BaseException:
+        versions.discard(staging)
+        raise
+    _swap_store(name)
+    return name
+
+def _validate_version(staging, expected: int, probe_ids, probe_vecs):
+    """Reopens the staged files from disk: counts must match and sampled vectors must find themselves."""
+    check = _open_faiss(staging / versions.INDEX_FILE)
+    if check.count() != expected or check._id_count() != expected:
+        raise RuntimeError(f"Index validation failed: {check.count()} vectors / {check._id_count()} ids, "
+                           f"expected {expected}.")
+    if len(probe_ids):
+        rng = np.random.default_rng(0)
+        pick = rng.choice(len(probe_ids), min(16, len(probe_ids)), replace=False)
+        hits = check.search_batch(np.asarray(probe_vecs)[pick], 10)
+        recall = float(np.mean([probe_ids[j] in h[0] for j, h in zip(pick, hits)]))
+        min_recall = float(CFG.store.get("versions", {}).get("validate_recall", 0.9))
+        if recall < min_recall:
+            raise RuntimeError(f"Index validation failed: self-recall@10 {recall:.2f} < {min_recall}.")
+
+def _write_neardup(path, store, ids, stems, vecs, removed=None, rows=None):
+    """
+    Writes the near-duplicate index for `store` to `path`. For a sync, pass the
+    `removed` ids and the positions `rows` of changed items (vecs then holds
+    only their vectors): the existing file is updated and neighbours are
+    recomputed for the changed items only.
+    """
+    if not neardup.enabled():
+        return
+    n = neardup.neighbours_wanted()
+    index = None
+    if rows is not None and path.exists():
+        try:
+            index = NearDupIndex.load(path)
+        except Exception as e:
+            print(f"Error reading near-duplicate index {path}: {e}. Rebuilding it.")
+        if index is not None and index.nbr_ids.shape[1] != n:
+            index = None        # neighbours 配置变了
+    if index is None:
+        index = NearDupIndex.from_config()
+        if rows is not None:
+            # 没有可用的旧索引：先收录全部题目 (不带近邻，命中时走正常检索)
+            index.update([], ids, stems)
+            removed = []
+    sel = range(len(ids)) if rows is None else rows
+    sel_ids = [ids[j] for j in sel]
+    index.update(removed or [], sel_ids, [stems[j] for j in sel],
+                 *neardup.ann_neighbours(store, sel_ids, vecs, n))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index.save(path)
+    print(f"[neardup] {len(index)} stems indexed, {n} neighbours each → {path}")
+
+def sync_index():
+    """
+    Re-reads the spreadsheet and applies only the delta to the store:
+    removed ids → store.delete, new or edited stems → store.upsert.
+    Falls back to a full build_index() when there is no usable manifest.
+    """
+    with span("sync"):
+        return _sync_index()
+
+def _sync_index():
+    with span("sync", "load"):
+        load_dataframe()
+    manifest = load_manifest()
+    if (manifest is None or manifest.get("store") != CFG.store_name
+            or manifest.get("model") != model_identity("mixed")):
+        print("No usable index manifest (missing, other store or model changed); running full build.")
+        build_index()
+        return {"mode": "full"}
+
+    indexed = manifest.get("items", {})
+    indexed_attrs = manifest.get("attrs", {})
+    ids, stems = _indexable_rows()
+    current = {i: stem_hash(s) for i, s in zip(ids, stems)}
+    attrs = _indexable_attrs(ids)
+    attr_hashes = dict(zip(ids, filters.row_hashes(attrs)))
+
+    removed = [i for i in indexed if i not in current]
+    # 只改了难度 / 年份 / 知识点的题目也要重新写入 (向量来自缓存，不会重新编码)
+    changed = [j for j, i in enumerate(ids)
+               if indexed.get(i) != current[i] or indexed_attrs.get(i) != attr_hashes[i]]
+    print(f"Sync: {len(removed)} removed, "
+          f"{sum(1 for j in changed if ids[j] not in indexed)} added, "
+          f"{sum(1 for j in changed if ids[j] in indexed)} modified.")
+
+    with span("sync", "encode"):
+        vecs_np = (encode_cached([stems[j] for j in changed], batch_size=CFG.encode_batch_size)
+                   if changed else None)
+    changed_attrs = filters.subset(attrs, changed)
+    if versions.enabled():
+        if removed or changed:
+            def apply(store):
+                if removed:
+                    store.delete(removed)
+                if changed:
+                    store.upsert([ids[j] for j in changed], vecs_np, changed_attrs)
+            _publish_version(apply, current, [ids[j] for j in changed], vecs_np,
+                             base=versions.current_version(),
+                             extra=lambda store, staging: _write_neardup(
+                                 staging / neardup.FILE, store, ids, stems, vecs_np, removed, changed),
+                             attrs=attr_hashes)
+        return {"mode": "delta", "removed": len(removed), "upserted": len(changed), "total": len(current),
+                "version": versions.current_version()}
+
+    store = RUNTIME.get("store")
+    if removed:
+        with span("sync", "store_delete"):
+            store.delete(removed)
+    if changed:
+        with span("sync", "store_upsert"):
+            store.upsert([ids[j] for j in changed], vecs_np, changed_attrs)
+    if removed or changed:
+        with span("sync", "store_flush"):
+            store.flush()
+    if neardup.enabled() and (removed or changed):
+        with span("sync", "neardup"):
+            _write_neardup(neardup.index_path(), store, ids, stems, vecs_np, removed, changed)
+    save_manifest(current, attrs=attr_hashes)
+    bump_index_generation()
+    return {"mode": "delta", "removed": len(removed), "upserted": len(changed), "total": len(current)}
+
+def query(stem: str, k=None, filters=None, cache: bool = True):
+    """
+    Top-k similar problems for `stem`. `filters` (see filters.py), e.g.
+    {"difficulty": [0.5, 0.9], "year": [2023]}, restricts the candidates inside
+    the vector store; raises ValueError for malformed filters. `cache=False`
+    bypasses RESULT_CACHE (used when profiling a request).
+    """
     if k is None:
         k = CFG.topk_return
+    f = normalize_filters(filters)
+    with slowlog.watch("query", [stem], k, f), span("query"):
+        if RESULT_CACHE is None or not cache:
+            return _query_uncached(stem, k, f)
+        return list(RESULT_CACHE.get_or_compute(_result_key(stem, k, f), lambda: _query_uncached(stem, k, f)))
 
-    if DF is None:
-        print("Error: DataFrame not loaded. Query cannot be processed.")
-        return []
-    if CE is None:
+def _near_duplicate(stem: str, k: int):
+    """
+    Fast path: if `stem` is a near-verbatim copy of an indexed problem, returns
+    it plus its precomputed neighbours without running any model; None means
+    "take the normal path".
+
+    Scores are on the ANN scale of neardup.ann_neighbours (inner product with
+    the duplicate's vector / ‖v‖², clipped to [0, 1]): the duplicate itself is
+    pinned at rank 1 with 1.0 and its neighbours follow by their stored score.
+    The difficulty blend of _hybrid_scores is not applied. A hit can return at
+    most 1 + neardup.neighbours results, so larger k take the normal path.
+    """
+    if not neardup.enabled():
+        return None
+    current_store()     # 先切换到最新发布的版本 (旧版本的 neardup 随之失效)
+    index = RUNTIME.get("neardup")
+    if index is None:
+        return None
+    found = index.lookup(stem, float(CFG.base.get("neardup", {}).get("threshold", 0.9)))
+    if found is None:
+        neardup.record(False)
+        return None
+    row, _ = found
+    nbr_ids, nbr_scores = index.neighbours(row)
+    if neardup.neighbours_wanted() and not nbr_ids:
+        neardup.record(False, no_neighbours=True)
+        return None
+    ords = RUNTIME.get("records").ordinals([str(index.ids[row])] + nbr_ids)
+    keep = ords >= 0
+    # 原题已被删除，或预存近邻 (去掉已删除的) 凑不满 k 条：走正常检索
+    if ords[0] < 0 or int(keep.sum()) < k:
+        neardup.record(False)
+        return None
+    neardup.record(True)
+    scores = np.concatenate([[1.0], np.asarray(nbr_scores, dtype=np.float64)])[keep]
+    ords = ords[keep]
+    order = np.concatenate([[0], 1 + np.argsort(-scores[1:], kind="stable")])[:k]
+    return _format(ords[order], scores[order])
+
+def _query_uncached(stem: str, k: int, f=None):
+    # 近重复通道的预存近邻未经过滤，带过滤条件的查询总走正常检索
+    if f is None:
+        with span("query", "near_duplicate"):
+            fast = _near_duplicate(stem, k)
+        if fast is not None:
+            metrics.note("path", "near_duplicate")
+            return fast
+    metrics.note("path", "model")
+    if RUNTIME.get("reranker") is None:
         print("Warning: CrossEncoder not loaded. Reranking will be skipped.")
 
-    qv = encode(stem)
-    cand_ids, _ = STORE.search(qv, CFG.topk_recall)
+    with span("query", "encode"):
+        qv = encode(stem)
+    with span("query", "search"):
+        cand_ids, ann_scores = current_store().search(qv, CFG.topk_recall, f)
+    metrics.candidates("query", len(cand_ids))
 
     if not cand_ids:
         return []
 
     # Filter out IDs not present in the DataFrame (if any inconsistencies)
-    valid_cand_ids = [str(cid) for cid in cand_ids if cid in DF.index]
-    if not valid_cand_ids:
+    with span("query", "lookup"):
+        q = _rerank_input(stem, qv, cand_ids, ann_scores)
+    if not len(q["cids"]):
         return []
 
-    if CE is not None:
-        cross_inp = [(stem, DF.loc[i, "stem"]) for i in valid_cand_ids]
-        rerank_scores = CE.predict(cross_inp, convert_to_numpy=True)
-    else: # Fallback if reranker is not available
-        rerank_scores = [0.5] * len(valid_cand_ids) # Neutral score
-
-    final_candidates = []
-    for cid, rs_score in zip(valid_cand_ids, rerank_scores):
-        difficulty = DF.loc[cid, "difficulty"] if "difficulty" in DF.columns and not pd.isna(DF.loc[cid, "difficulty"]) else None
-        final_score = hybrid(rs_score, difficulty)
-        final_candidates.append((cid, final_score))
-    
-    # Sort by final score descending and take top k
-    final_sorted = sorted(final_candidates, key=lambda x: x[1], reverse=True)[:k]
-    
-    # Prepare results
-    results_with_scores = []
-    for problem_id, score_val in final_sorted: # final_sorted is list of (cid, final_score)
-        if problem_id in DF.index: # Check if id exists in DataFrame index
-            stem_val = DF.loc[problem_id, 'stem']
-            # 也可以在这里添加其他你想从DF中获取的字段
-            # 例如: source_val = DF.loc[problem_id, 'source'] if 'source' in DF.columns else None
-            results_with_scores.append({
-                'id': str(problem_id),      # 确保是字符串
-                'stem': str(stem_val),    # 确保是字符串
-                'score': float(score_val) # 确保是浮点数
-                # 如果添加了其他字段，也在这里加入
-                # 'source': source_val
-            })
+    with span("query", "rerank"):
+        [(scored_ids, rerank_scores)], _ = _rerank([q], k)
+    with span("query", "scoring"):
+        return _finalize(scored_ids, rerank_scores, k)
+
+def query_batch(stems, k=None, filters=None):
+    """
+    Batched `query`: one encode_batch, one multi-query ANN search and one
+    cross-encoder predict over every (query, candidate) pair. Hybrid scoring
+    is applied per query; results are returned in input order.
+    Cached stems are served from RESULT_CACHE, stems already being computed by
+    another request are waited on, and only the rest go through the models.
+    `filters` is one filter for every stem or a list aligned with `stems`.
+    """
+    if k is None:
+        k = CFG.topk_return
+    if not stems:
+        return []
+    if isinstance(filters, list):
+        if len(filters) != len(stems):
+            raise ValueError(f"{len(filters)} filters for {len(stems)} stems")
+        fs = [normalize_filters(spec) for spec in filters]
+    else:
+        fs = [normalize_filters(filters)] * len(stems)
+    with slowlog.watch("query_batch", stems, k, fs[0] if len(set(fs)) == 1 else None), span("query_batch"):
+        return _query_batch_cached(stems, k, fs)
+
+def _query_batch_cached(stems, k, fs):
+    if RESULT_CACHE is None:
+        return _query_batch_uncached(stems, k, fs)
+
+    results = [None] * len(stems)
+    owned, waiting = {}, {}
+    for i, stem in enumerate(stems):
+        key = _result_key(stem, k, fs[i])
+        if key in owned:                 # 同一批内的重复题目
+            owned[key].append(i)
+            continue
+        hit, value = RESULT_CACHE.lookup(key)
+        if hit:
+            results[i] = value
+            continue
+        fut, is_owner = RESULT_CACHE.claim(key)
+        if is_owner:
+            owned[key] = [i]
         else:
-            # 这通常不应该发生，因为 final_sorted 中的 id 应该都来自 valid_cand_ids，而 valid_cand_ids 已经检查过存在于 DF.index
-            print(f"Warning: ID {problem_id} from final_sorted not found in DF.index. This indicates a potential data inconsistency. Skipping.")
-    
-    return results_with_scores
+            waiting[i] = fut
+
+    if owned:
+        keys = list(owned)
+        try:
+            computed = _query_batch_uncached([stems[owned[key][0]] for key in keys], k,
+                                             [fs[owned[key][0]] for key in keys])
+        except Exception as e:
+            for key in keys:
+                RESULT_CACHE.fail(key, e)
+            raise
+        for key, res in zip(keys, computed):
+            RESULT_CACHE.resolve(key, res)
+            for i in owned[key]:
+                results[i] = res
+    for i, fut in waiting.items():
+        results[i] = fut.result()
+    return [list(r) for r in results]
+
+def _query_batch_uncached(stems, k, fs):
+    with span("query_batch", "near_duplicate"):
+        results = [_near_duplicate(stem, k) if f is None else None for stem, f in zip(stems, fs)]
+    rest = [i for i, r in enumerate(results) if r is None]
+    metrics.note("path", "model" if rest else "near_duplicate")
+    if rest:
+        for i, r in zip(rest, _query_batch_models([stems[i] for i in rest], k, [fs[i] for i in rest])):
+            results[i] = r
+    return results
+
+def _query_batch_models(stems, k, fs):
+    if RUNTIME.get("reranker") is None:
+        print("Warning: CrossEncoder not loaded. Reranking will be skipped.")
+
+    with span("query_batch", "encode"):
+        qvs = encode_batch(list(stems), batch_size=CFG.encode_batch_size)
+    # 一种过滤条件一次多查询检索
+    store, hits = current_store(), [None] * len(stems)
+    with span("query_batch", "search"):
+        for f in dict.fromkeys(fs):
+            rows = [i for i, g in enumerate(fs) if g == f]
+            for i, hit in zip(rows, store.search_batch(qvs[rows], CFG.topk_recall, f)):
+                hits[i] = hit
+    for cand_ids, _ in hits:
+        metrics.candidates("query_batch", len(cand_ids))
+
+    with span("query_batch", "lookup"):
+        queries = [_rerank_input(stem, qv, cand_ids, ann_scores)
+                   for stem, qv, (cand_ids, ann_scores) in zip(stems, qvs, hits)]
+    with span("query_batch", "rerank"):
+        reranked, _ = _rerank(queries, k)
+    with span("query_batch", "scoring"):
+        return [_finalize(cids, scores, k) if len(cids) else [] for cids, scores in reranked]
+
+def _rerank_input(stem, qv, cand_ids, ann_scores):
+    """Candidates as records ordinals (ids unknown to the data file are dropped)."""
+    ords = RUNTIME.get("records").ordinals(cand_ids)
+    keep = ords >= 0
+    return {"stem": stem,
+            "cids": ords[keep],
+            "ann": np.asarray(ann_scores, dtype=np.float32)[keep],
+            "qq": float(np.dot(qv, qv))}
+
+def _hybrid_scores(ords, rerank_scores):
+    ords = np.asarray(ords, dtype=np.int64)
+    return hybrid(np.asarray(rerank_scores, dtype=np.float64), RUNTIME.get("records").difficulty[ords])
+
+def _rerank(queries, k, **overrides):
+    """
+    Cross-encoder scores for every query (see rerank.rerank_many). Mode, chunk,
+    margin and exact_match come from the `rerank` section of conf/base.yaml
+    unless overridden (used by rerank_report).
+    """
+    ce = RUNTIME.get("reranker")
+    if ce is None: # Fallback if reranker is not available
+        return [(q["cids"], np.full(len(q["cids"]), 0.5)) for q in queries], {"pairs": 0} # Neutral score
+    opts = {"mode": "full", "chunk": 8, "margin": 0.05, "exact_match": None}
+    opts.update({key: CFG.rerank[key] for key in opts if key in CFG.rerank})
+    opts.update(overrides)
+    return rerank_many(queries,
+                       predict=lambda pairs: ce.predict(pairs, convert_to_numpy=True),
+                       cand_text=RUNTIME.get("records").stem,
+                       score_fn=_hybrid_scores,
+                       k=k, **opts)
+
+def rerank_report(stems, k=None, margins=(0.02, 0.05, 0.1), relevant=None):
+    """
+    Compares cascade reranking against full reranking on the given queries.
+
+    Args:
+        stems: Query stems.
+        k: Result size to compare (defaults to topk_return).
+        margins: Cascade margins to evaluate.
+        relevant: Optional list (aligned with stems) of labelled relevant id lists;
+                  enables recall@k for every mode.
+
+    Returns:
+        dict: per mode → mean top-k overlap with full, exact-order agreement,
+        cross-encoder pairs per query and (if labelled) recall@k.
+    """
+    k = k or CFG.topk_return
+    qvs = encode_batch(list(stems), batch_size=CFG.encode_batch_size)
+    hits = current_store().search_batch(qvs, CFG.topk_recall)
+    queries = [_rerank_input(stem, qv, c, a) for stem, qv, (c, a) in zip(stems, qvs, hits)]
+
+    def run(**opts):
+        reranked, st = _rerank(queries, k, **opts)
+        tops = [[r["id"] for r in _finalize(cids, sc, k)] if len(cids) else [] for cids, sc in reranked]
+        return tops, st
+
+    full, full_stats = run(mode="full")
+    modes = {"full": (full, full_stats)}
+    for m in margins:
+        modes[f"cascade@{m}"] = run(mode="cascade", margin=m)
+
+    report = {"queries": len(stems), "k": k, "modes": {}}
+    for name, (tops, st) in modes.items():
+        overlap = [len(set(t) & set(f)) / max(len(f), 1) for t, f in zip(tops, full)]
+        entry = {
+            "overlap_at_k": float(np.mean(overlap)) if overlap else 0.0,
+            "same_order": float(np.mean([t == f for t, f in zip(tops, full)])) if full else 0.0,
+            "pairs_per_query": st.get("pairs", 0) / max(len(stems), 1),
+            "skipped": st.get("skipped", 0),
+            "early_stop": st.get("early_stop", 0),
+        }
+        if relevant is not None:
+            rec = [len(set(t) & set(map(str, rel))) / max(min(len(rel), k), 1)
+                   for t, rel in zip(tops, relevant) if rel]
+            entry["recall_at_k"] = float(np.mean(rec)) if rec else 0.0
+        report["modes"][name] = entry
+    return report
+
+def _finalize(ords, rerank_scores, k):
+    """Hybrid-scores reranked candidates of one query (vectorized) and formats the top k."""
+    ords = np.asarray(ords, dtype=np.int64)
+    final = _hybrid_scores(ords, rerank_scores)
+
+    # Top k by final score descending; ties keep ANN order (same as a stable sort)
+    if len(final) > k:
+        kth = np.partition(final, len(final) - k)[len(final) - k]
+        sel = np.flatnonzero(final >= kth)
+    else:
+        sel = np.arange(len(final))
+    top = sel[np.lexsort((sel, -final[sel]))][:k]
+
+    return _format(ords[top], final[top])
+
+def _format(ords, scores):
+    """Result dicts (id, stem, score) for the given record ordinals, in order."""
+    records = RUNTIME.get("records")
+    return [{
+        'id': str(problem_id),      # 确保是字符串
+        'stem': stem_val,           # 确保是字符串
+        'score': float(score_val)   # 确保是浮点数
+    } for problem_id, stem_val, score_val in zip(records.ids[ords], records.stems(ords), scores)]
 
 # ----------  END  gaokao_rag/retriever.py ---------- 
\ No newline at end of file
@@ -0,0 +1,83 @@
+# gaokao_rag/runtime.py
+"""
+Lazily initialized process runtime.
+
+Models, the corpus and vector stores are no longer created at import time.
+Each module registers a factory under a name (e.g. "text_model", "df",
+"store"); the first `RUNTIME.get(name)` builds the object (thread-safe) and
+records how long it took. `warmup()` preloads everything on demand
+(`ragmath warmup`, POST /warmup).
+"""
+import importlib
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+# 按依赖顺序预热；模块被导入时会注册各自的工厂函数
+WARMUP_ORDER: List[str] = ["df", "records", "text_model", "math_model", "reranker", "store", "neardup", "text_store"]
+_FACTORY_MODULES = ("gaokao_rag.embed", "gaokao_rag.retriever", "gaokao_rag.text_only")
+
+
+class Runtime:
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._objects: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+        self.load_seconds: Dict[str, float] = {}
+        self.created_at = time.time()
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        with self._guard:
+            self._factories[name] = factory
+            self._locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str) -> Any:
+        try:
+            return self._objects[name]
+        except KeyError:
+            pass
+        if name not in self._factories:
+            raise KeyError(f"No runtime component registered as '{name}'")
+        with self._locks[name]:
+            if name not in self._objects:      # 另一个线程可能已经建好
+                t0 = time.perf_counter()
+                self._objects[name] = self._factories[name]()
+                self.load_seconds[name] = time.perf_counter() - t0
+                print(f"[runtime] {name} ready in {self.load_seconds[name]:.2f}s")
+        return self._objects[name]
+
+    def set(self, name: str, value: Any):
+        """Replaces a component (e.g. after reloading the corpus)."""
+        self._objects[name] = value
+
+    def invalidate(self, name: str):
+        self._objects.pop(name, None)
+
+    def forget(self, value: Any):
+        """Drops every component whose object is `value` (e.g. an unloaded model)."""
+        for name in [n for n, v in self._objects.items() if v is value]:
+            del self._objects[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._objects
+
+    def warmup(self, names: Iterable[str] | None = None) -> dict:
+        """Builds the given (default: all core) components; returns per-component seconds."""
+        for mod in _FACTORY_MODULES:
+            importlib.import_module(mod)
+        t0 = time.perf_counter()
+        for name in (names or WARMUP_ORDER):
+            if name in self._factories:
+                self.get(name)
+        return {"total_seconds": time.perf_counter() - t0, **self.status()}
+
+    def status(self) -> dict:
+        return {
+            "loaded": sorted(self._objects),
+            "load_seconds": {k: round(v, 4) for k, v in self.load_seconds.items()},
+            "uptime_seconds": round(time.time() - self.created_at, 1),
+        }
+
+
+RUNTIME = Runtime()
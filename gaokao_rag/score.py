@@ -1,35 +1,35 @@
 import numpy as np
 from .cfg import CFG
 
-def hybrid(rerank_score: float, difficulty: float = None) -> float:
+# 只在导入时读一次配置，避免每次打分都查 CFG.base 字典
+_D0 = float(CFG.base['difficulty']['default'])
+_COEFF = float(CFG.diff_coeff)
+
+def hybrid(rerank_score, difficulty=None):
     """
     Calculates a hybrid score combining rerank_score and difficulty.
 
+    Accepts scalars or NumPy arrays (one vectorized expression for all
+    candidates of a query).
+
     Args:
-        rerank_score (float): The semantic similarity score, already in [0, 1].
-        difficulty (float, optional): The difficulty of the item, in [0, 100]. 
-                                       If None, difficulty penalty is not applied.
+        rerank_score (float | np.ndarray): The semantic similarity score, already in [0, 1].
+        difficulty (float | np.ndarray, optional): The difficulty of the item, in [0, 100].
+                                       If None (or NaN in an array), the difficulty
+                                       penalty is not applied to that item.
 
     Returns:
-        float: The final hybrid score.
+        float | np.ndarray: The final hybrid score (same shape as rerank_score).
     """
-    d0 = CFG.base['difficulty']['default']
-    coeff = CFG.diff_coeff # direct access as per new Cfg structure
-
-    if difficulty is None or coeff == 0: # If no difficulty or coeff is 0, only rerank_score matters
+    if difficulty is None or _COEFF == 0: # If no difficulty or coeff is 0, only rerank_score matters
         return rerank_score
 
-    # Normalize difficulty penalty to be in [0, 1]
-    # Penalty is 0 if difficulty == d0, and 1 if difficulty is 0 or 100 (assuming d0 is between 0 and 100)
-    # max_diff = max(d0, 100 - d0)
-    # diff_penalty = abs(difficulty - d0) / max_diff if max_diff !=0 else 0 
-    # Simpler penalty as per original: abs(difficulty - d0) / 100
-    diff_penalty = abs(difficulty - d0) / 100.0
-    
+    rs = np.asarray(rerank_score, dtype=np.float64)
+    d = np.asarray(difficulty, dtype=np.float64)
+
+    # Penalty is abs(difficulty - d0) / 100, as in the original formula.
     # Original formula: (1-coeff)*rerank_score - coeff*diff_penalty
-    # This means higher penalty REDUCES the score.
-    # If rerank_score is high (e.g., 1) and penalty is high (e.g., 1), and coeff is high (e.g., 0.7)
-    # Score = (0.3*1) - (0.7*1) = -0.4. Scores can be negative.
-    final_score = (1 - coeff) * rerank_score - coeff * diff_penalty
-    
-    return final_score 
\ No newline at end of file
+    # This means higher penalty REDUCES the score; scores can be negative.
+    final_score = np.where(np.isnan(d), rs, (1 - _COEFF) * rs - _COEFF * np.abs(d - _D0) / 100.0)
+
+    return final_score if final_score.ndim else float(final_score)
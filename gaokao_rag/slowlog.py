@@ -0,0 +1,97 @@
+# gaokao_rag/slowlog.py
+"""
+Slow-query log.
+
+`watch(op, stems, k, filters)` wraps one `query` / `query_batch` call in a
+metrics.Trace. When the call takes longer than `slow_query.threshold_ms`, one
+JSON line is appended to `slow_query.path` with the stage breakdown
+(near_duplicate / encode / search / lookup / rerank / scoring), the formula
+count and length of the stem(s), the ANN candidate count and which path served
+it (cache, near_duplicate, model). A micro-batched API request is logged as
+the query_batch it ran in. The log is off whenever `metrics.enabled` is false,
+so that switch leaves no timing on the query path.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List
+
+from . import metrics
+from .cfg import CFG, ROOT
+from .filters import as_dict
+
+_LOCK = threading.Lock()
+
+
+def _cfg() -> dict:
+    return CFG.base.get("slow_query", {}) or {}
+
+
+def enabled() -> bool:
+    return metrics.ENABLED and bool(_cfg().get("enabled", True))
+
+
+def threshold_ms() -> float:
+    return float(_cfg().get("threshold_ms", 1000))
+
+
+def log_path() -> Path:
+    p = _cfg().get("path", "models/slow_queries.jsonl")
+    return Path(p) if os.path.isabs(p) else ROOT / p
+
+
+def _stem_record(stems: List[str]) -> dict:
+    from .formula import split
+    formulas = [len(split(str(s))[1]) for s in stems]
+    chars = [len(str(s)) for s in stems]
+    limit = int(_cfg().get("max_stem_chars", 300))
+    if len(stems) == 1:
+        return {"stem_chars": chars[0], "formulas": formulas[0], "stem": str(stems[0])[:limit]}
+    # 批量：给出合计与最大值，并附上公式最多的那道题
+    worst = max(range(len(stems)), key=formulas.__getitem__)
+    return {"stems": len(stems), "stem_chars": sum(chars), "max_stem_chars": max(chars),
+            "formulas": sum(formulas), "max_formulas": formulas[worst], "stem": str(stems[worst])[:limit]}
+
+
+def record(op: str, ms: float, trace: metrics.Trace, stems: List[str], k=None, f=None):
+    entry = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "op": op, "ms": round(ms, 3), "k": k,
+             "filters": as_dict(f) or None, "path": trace.info.get("path", "cache"),
+             "candidates": trace.info.get("candidates", 0), "stages_ms": trace.stages_ms(),
+             **_stem_record(stems)}
+    path = log_path()
+    line = json.dumps(entry, ensure_ascii=False) + "\n"
+    with _LOCK:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as fh:
+            fh.write(line)
+    print(f"[slow-query] {op} took {ms:.0f} ms "
+          f"({', '.join(f'{s} {v:.0f}' for s, v in entry['stages_ms'].items() if s != 'total')}) → {path}")
+
+
+@contextmanager
+def watch(op: str, stems: List[str], k=None, f=None):
+    """
+    Traces the enclosed call (reusing an outer trace, e.g. of a profiled
+    request) and logs it if it exceeded the threshold.
+    """
+    outer = metrics.current_trace()
+    if outer is None and not enabled():
+        yield None
+        return
+    trace = outer if outer is not None else metrics.Trace()
+    token = metrics.TRACE.set(trace) if outer is None else None
+    t0 = time.perf_counter()
+    try:
+        yield trace
+    finally:
+        if token is not None:
+            metrics.TRACE.reset(token)
+        ms = (time.perf_counter() - t0) * 1000.0
+        if enabled() and ms >= threshold_ms():
+            try:
+                record(op, ms, trace, stems, k, f)
+            except Exception as e:          # 日志失败不能影响查询本身
+                print(f"[slow-query] could not write {log_path()}: {e}")
@@ -0,0 +1,236 @@
+# gaokao_rag/snapshot.py
+"""
+Fast-loading binary snapshot of the question-bank spreadsheet.
+
+Parsing xlsx is slow and happened in every process (retriever + text_only,
+every uvicorn worker). `write_snapshot` stores each column as a .npy file
+(numeric) or as a UTF-8 blob + offsets + null mask (text), next to a meta.json
+holding the source sha256, size and mtime. `read_corpus` returns the snapshot
+when it is current and transparently regenerates it when the xlsx changed.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .cfg import CFG, ROOT
+
+FORMAT_VERSION = 1
+
+
+def snapshot_dir(source: Path) -> Path:
+    base = CFG.snapshot.get("dir", "data/.snapshot")
+    base = Path(base) if os.path.isabs(base) else ROOT / base
+    return base / Path(source).stem
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _read_meta(snap: Path):
+    try:
+        with open(snap / "meta.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(source: Path) -> bool:
+    """Cheap (size, mtime) check first; falls back to the sha256 when only the mtime moved."""
+    source = Path(source)
+    snap = snapshot_dir(source)
+    meta = _read_meta(snap)
+    if meta is None or meta.get("version") != FORMAT_VERSION:
+        return False
+    st = source.stat()
+    if meta["source_size"] == st.st_size and meta["source_mtime_ns"] == st.st_mtime_ns:
+        return True
+    if meta["source_size"] != st.st_size or meta["source_sha256"] != _sha256(source):
+        return False
+    # 内容未变，只是被 touch 过：更新 mtime 以便下次走快速路径
+    meta["source_mtime_ns"] = st.st_mtime_ns
+    with open(snap / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return True
+
+
+def _write_text_column(path: Path, name: str, values: list):
+    mask = np.array([v is None for v in values], dtype=bool)
+    encoded = [b"" if v is None else v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    np.save(path / f"{name}.offsets.npy", offsets)
+    np.save(path / f"{name}.null.npy", mask)
+    with open(path / f"{name}.blob", "wb") as f:
+        f.write(b"".join(encoded))
+
+
+def _read_text_column(path: Path, name: str) -> list:
+    offsets = np.load(path / f"{name}.offsets.npy", mmap_mode="r")
+    mask = np.load(path / f"{name}.null.npy", mmap_mode="r")
+    blob = (path / f"{name}.blob").read_bytes()
+    return [None if m else blob[a:b].decode("utf-8")
+            for a, b, m in zip(offsets[:-1].tolist(), offsets[1:].tolist(), mask.tolist())]
+
+
+def write_snapshot(source: Path, df: pd.DataFrame | None = None) -> Path:
+    """Converts `source` (xlsx) into the columnar snapshot; returns its directory."""
+    source = Path(source)
+    if df is None:
+        df = pd.read_excel(source)
+    snap = snapshot_dir(source)
+    tmp = snap.with_name(f"{snap.name}.tmp-{os.getpid()}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        name = f"c{i}"
+        s = df[col]
+        if s.dtype.kind in "biuf":
+            np.save(tmp / f"{name}.npy", s.to_numpy())
+            kind = "numeric"
+        else:
+            values = [None if (v is None or (isinstance(v, float) and np.isnan(v))) else v for v in s.tolist()]
+            if all(v is None or isinstance(v, str) for v in values):
+                kind = "text"
+            else:
+                # 混合类型 (如 int 与 "1, 2" 共存)：逐格 JSON 编码以保留原类型
+                kind = "json"
+                values = [None if v is None else json.dumps(v, ensure_ascii=False, default=str) for v in values]
+            _write_text_column(tmp, name, values)
+        columns.append({"name": str(col), "file": name, "kind": kind})
+
+    st = source.stat()
+    meta = {
+        "version": FORMAT_VERSION,
+        "source": str(source),
+        "source_sha256": _sha256(source),
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "rows": len(df),
+        "columns": columns,
+    }
+    with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    shutil.rmtree(snap, ignore_errors=True)
+    os.replace(tmp, snap)
+    print(f"[snapshot] {source.name} → {snap} ({len(df)} rows, {len(columns)} columns)")
+    return snap
+
+
+def load_snapshot(source: Path) -> pd.DataFrame:
+    snap = snapshot_dir(source)
+    meta = _read_meta(snap)
+    data = {}
+    for c in meta["columns"]:
+        if c["kind"] == "numeric":
+            data[c["name"]] = np.load(snap / f"{c['file']}.npy")
+        elif c["kind"] == "text":
+            data[c["name"]] = pd.Series(_read_text_column(snap, c["file"]), dtype=object)
+        else:
+            data[c["name"]] = pd.Series([None if v is None else json.loads(v)
+                                         for v in _read_text_column(snap, c["file"])], dtype=object)
+    return pd.DataFrame(data)
+
+
+def _column_slicer(snap: Path, col: dict):
+    """Returns f(a, b) → values of rows [a, b) read through mmap, without loading the column."""
+    name = col["file"]
+    if col["kind"] == "numeric":
+        arr = np.load(snap / f"{name}.npy", mmap_mode="r")
+        return lambda a, b: np.asarray(arr[a:b])
+    offsets = np.load(snap / f"{name}.offsets.npy", mmap_mode="r")
+    mask = np.load(snap / f"{name}.null.npy", mmap_mode="r")
+    blob_path = snap / f"{name}.blob"
+    if blob_path.stat().st_size:
+        with open(blob_path, "rb") as f:
+            blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        blob = b""
+    decode = (lambda v: v) if col["kind"] == "text" else json.loads
+
+    def read(a, b):
+        o = offsets[a:b + 1].tolist()
+        return pd.Series([None if m else decode(blob[o[i]:o[i + 1]].decode("utf-8"))
+                          for i, m in enumerate(mask[a:b].tolist())], dtype=object)
+    return read
+
+
+def iter_chunks(source: Path, columns: List[str], chunk_rows: int, start: int = 0
+                ) -> Iterator[Tuple[int, int, pd.DataFrame]]:
+    """
+    Yields (row offset, total rows, DataFrame of `columns`) chunks of the
+    corpus; only one chunk is materialized at a time. The snapshot is
+    (re)generated first if needed.
+    """
+    source = Path(source)
+    if not CFG.snapshot.get("enabled", True):
+        df = pd.read_excel(source)[columns]      # 无快照时只能整表读取
+        for a in range(start, len(df), chunk_rows):
+            yield a, len(df), df.iloc[a:a + chunk_rows].reset_index(drop=True)
+        return
+    if not is_current(source):
+        write_snapshot(source)
+    snap = snapshot_dir(source)
+    meta = _read_meta(snap)
+    by_name = {c["name"]: c for c in meta["columns"]}
+    missing = [c for c in columns if c not in by_name]
+    if missing:
+        raise KeyError(f"Columns {missing} not found in {source.name}")
+    readers = {c: _column_slicer(snap, by_name[c]) for c in columns}
+    total = meta["rows"]
+    for a in range(start, total, chunk_rows):
+        b = min(a + chunk_rows, total)
+        yield a, total, pd.DataFrame({c: r(a, b) for c, r in readers.items()})
+
+
+def column_names(source: Path) -> List[str]:
+    """Column names of the corpus, from the snapshot meta when possible (no full parse)."""
+    source = Path(source)
+    if CFG.snapshot.get("enabled", True):
+        if not is_current(source):
+            write_snapshot(source)
+        return [c["name"] for c in _read_meta(snapshot_dir(source))["columns"]]
+    return [str(c) for c in pd.read_excel(source, nrows=0).columns]
+
+
+def source_sha256(source: Path) -> str:
+    """sha256 of the spreadsheet, taken from the snapshot meta when it is current."""
+    source = Path(source)
+    if CFG.snapshot.get("enabled", True) and is_current(source):
+        return _read_meta(snapshot_dir(source))["source_sha256"]
+    return _sha256(source)
+
+
+def read_corpus(source: Path) -> pd.DataFrame:
+    """
+    Drop-in replacement for `pd.read_excel(source)`: loads the snapshot when it
+    matches the xlsx, otherwise parses the xlsx and (re)writes the snapshot.
+    """
+    source = Path(source)
+    if not CFG.snapshot.get("enabled", True):
+        return pd.read_excel(source)
+    try:
+        if is_current(source):
+            return load_snapshot(source)
+    except Exception as e:
+        print(f"[snapshot] failed to load snapshot for {source.name}: {e}; re-reading xlsx.")
+    df = pd.read_excel(source)
+    try:
+        write_snapshot(source, df)
+    except Exception as e:
+        print(f"[snapshot] could not write snapshot for {source.name}: {e}")
+    return df
@@ -0,0 +1,139 @@
+# gaokao_rag/store/attributes.py
+"""
+Per-attribute index of a FaissStore (`<index_path>.attrs.npz`), keyed by FAISS label.
+
+Difficulty is a float array indexed by label (NaN = unknown or free label).
+Each multi-valued attribute (year, topic) is kept as (label, value code) pairs
+plus its value vocabulary; the postings (labels sorted by value) are derived
+once per change, so a filter becomes a few `np.searchsorted` slices OR-ed into
+a label bitmap, which FaissStore hands to FAISS as an IDSelectorBitmap.
+"""
+import math
+import os
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+
+from ..filters import MULTI, Filter
+
+
+class AttributeIndex:
+    def __init__(self, difficulty: np.ndarray, pairs: Dict[str, tuple]):
+        self.difficulty = difficulty    # float32[rows]
+        self.pairs = pairs              # name → (vocab str[V], owner int64[nnz], code int64[nnz])
+        self._postings: Dict[str, tuple] = {}
+
+    @classmethod
+    def empty(cls) -> "AttributeIndex":
+        return cls(np.zeros(0, dtype=np.float32),
+                   {name: (np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+                    for name in MULTI})
+
+    # ---- updates ----
+    def _grow(self, rows: int):
+        if rows > len(self.difficulty):
+            grown = np.full(max(rows, len(self.difficulty) * 5 // 4), np.nan, dtype=np.float32)
+            grown[:len(self.difficulty)] = self.difficulty
+            self.difficulty = grown
+
+    def put(self, labels, attrs: Dict[str, object]):
+        """Sets the attributes of `labels` (row j of `attrs` belongs to labels[j]), replacing old values."""
+        labels = np.asarray(labels, dtype=np.int64)
+        self.remove(labels)
+        if not len(labels):
+            return
+        self._grow(int(labels.max()) + 1)
+        self.difficulty[labels] = np.asarray(attrs["difficulty"], dtype=np.float32)
+        for name in MULTI:
+            vocab, owner, code = self.pairs[name]
+            values = [str(v) for row in attrs[name] for v in row]
+            new_owner = np.repeat(labels, [len(row) for row in attrs[name]])
+            vocab = np.union1d(vocab, np.asarray(values, dtype=str)) if values else vocab
+            if len(vocab) != len(self.pairs[name][0]):      # 词表变化：旧编码按新词表重排
+                code = np.searchsorted(vocab, self.pairs[name][0][code]) if len(code) else code
+            new_code = np.searchsorted(vocab, np.asarray(values, dtype=str)) if values else new_owner[:0]
+            self.pairs[name] = (vocab, np.concatenate([owner, new_owner]),
+                                np.concatenate([code, new_code]).astype(np.int64))
+        self._postings.clear()
+
+    def remove(self, labels):
+        labels = np.asarray(labels, dtype=np.int64)
+        labels = labels[labels < len(self.difficulty)]
+        if not len(labels):
+            return
+        self.difficulty[labels] = np.nan
+        for name in MULTI:
+            vocab, owner, code = self.pairs[name]
+            keep = ~np.isin(owner, labels)
+            self.pairs[name] = (vocab, owner[keep], code[keep])
+        self._postings.clear()
+
+    # ---- filtering ----
+    def _posting(self, name: str):
+        if name not in self._postings:
+            vocab, owner, code = self.pairs[name]
+            order = np.lexsort((owner, code))
+            starts = np.searchsorted(code[order], np.arange(len(vocab) + 1))
+            self._postings[name] = (owner[order], starts)
+        return self._postings[name]
+
+    def select(self, f: Filter, rows: int) -> np.ndarray:
+        """Boolean mask over labels [0, rows) of the items that satisfy every clause of `f`."""
+        mask = np.zeros(rows, dtype=bool)
+        n = min(rows, len(self.difficulty))
+        mask[:n] = True
+        for name, value in f:
+            if name == "difficulty":
+                lo, hi = value
+                d = self.difficulty[:n]
+                with np.errstate(invalid="ignore"):
+                    ok = np.ones(n, dtype=bool)
+                    if lo != -math.inf:
+                        ok &= d >= lo
+                    if hi != math.inf:
+                        ok &= d <= hi
+                    ok &= ~np.isnan(d)
+                mask[:n] &= ok
+                continue
+            vocab = self.pairs[name][0]
+            owners, starts = self._posting(name)
+            hit = np.zeros(rows, dtype=bool)
+            for v in value:
+                c = int(np.searchsorted(vocab, str(v)))
+                if c < len(vocab) and vocab[c] == str(v):
+                    ids = owners[starts[c]:starts[c + 1]]
+                    hit[ids[ids < rows]] = True
+            mask &= hit
+        return mask
+
+    # ---- persistence ----
+    @staticmethod
+    def path_for(index_path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_suffix(index_path.suffix + ".attrs.npz")
+
+    def compact(self, rows: int):
+        if rows < len(self.difficulty):
+            self.difficulty = self.difficulty[:rows].copy()
+
+    def write(self, path):
+        """Atomic write (temp file + rename), like IdTable.write."""
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}.npz")
+        arrays = {"difficulty": self.difficulty}
+        for name, (vocab, owner, code) in self.pairs.items():
+            arrays.update({f"{name}_vocab": vocab, f"{name}_owner": owner, f"{name}_code": code})
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, path) -> "AttributeIndex":
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z["difficulty"].astype(np.float32),
+                       {name: (z[f"{name}_vocab"].astype(str), z[f"{name}_owner"], z[f"{name}_code"])
+                        for name in MULTI})
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.difficulty.nbytes + sum(o.nbytes + c.nbytes for _, o, c in self.pairs.values()))
@@ -1,12 +1,12 @@
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Any
+from typing import List, Optional, Tuple, Any
 import numpy as np
 
 class BaseStore(ABC):
     """Abstract base class for vector stores."""
 
     @abstractmethod
-    def build(self, ids: List[str], vecs: np.ndarray):
+    def build(self, ids: List[str], vecs: np.ndarray, attrs: Optional[dict] = None):
         """
         Builds the index from scratch with the given IDs and vectors.
         Any existing data in the store for the same collection might be cleared.
@@ -14,28 +14,33 @@ class BaseStore(ABC):
         Args:
             ids (List[str]): A list of unique string identifiers for the vectors.
             vecs (np.ndarray): A 2D numpy array of float vectors, shape (n, dim).
+            attrs (Optional[dict]): Filterable attributes aligned with ids
+                (see filters.attributes); None stores no attributes.
         """
         pass
 
     @abstractmethod
-    def add(self, ids: List[str], vecs: np.ndarray):
+    def add(self, ids: List[str], vecs: np.ndarray, attrs: Optional[dict] = None):
         """
         Adds new vectors to an existing index.
 
         Args:
             ids (List[str]): A list of unique string identifiers for the new vectors.
             vecs (np.ndarray): A 2D numpy array of new float vectors, shape (m, dim).
+            attrs (Optional[dict]): Filterable attributes aligned with ids.
         """
         pass
 
     @abstractmethod
-    def search(self, vec: np.ndarray, k: int) -> Tuple[List[str], List[float]]:
+    def search(self, vec: np.ndarray, k: int, filters=None) -> Tuple[List[str], List[float]]:
         """
         Searches for the top k most similar vectors to the given query vector.
 
         Args:
             vec (np.ndarray): A 1D numpy array (query vector).
             k (int): The number of nearest neighbors to return.
+            filters: Optional metadata filter (dict or filters.normalize() result);
+                only vectors whose attributes match are considered.
 
         Returns:
             Tuple[List[str], List[float]]: A tuple containing two lists:
@@ -44,9 +49,54 @@ class BaseStore(ABC):
         """
         pass
 
-    # Optional: Add other common methods like delete, update, count, etc.
-    # def delete(self, ids: List[str]):
-    #     pass
+    def search_batch(self, vecs: np.ndarray, k: int, filters=None) -> List[Tuple[List[str], List[float]]]:
+        """
+        Searches several query vectors at once.
+
+        Args:
+            vecs (np.ndarray): A 2D numpy array of query vectors, shape (n, dim).
+            k (int): The number of nearest neighbors to return per query.
+            filters: Optional metadata filter applied to every query (see `search`).
+
+        Returns:
+            List[Tuple[List[str], List[float]]]: One (ids, scores) pair per query row,
+            in input order. The default implementation loops over `search`.
+        """
+        return [self.search(v, k, filters) for v in vecs]
+
+    @abstractmethod
+    def delete(self, ids: List[str]) -> int:
+        """
+        Removes the vectors with the given IDs. Unknown IDs are ignored.
+
+        Args:
+            ids (List[str]): IDs to remove.
+
+        Returns:
+            int: The number of vectors actually removed (best effort for remote stores).
+        """
+        pass
+
+    @abstractmethod
+    def upsert(self, ids: List[str], vecs: np.ndarray, attrs: Optional[dict] = None):
+        """
+        Inserts new vectors or replaces the vectors of IDs that already exist.
+
+        Args:
+            ids (List[str]): A list of unique string identifiers.
+            vecs (np.ndarray): A 2D numpy array of float vectors, shape (m, dim).
+            attrs (Optional[dict]): Filterable attributes aligned with ids;
+                they replace the previous attributes of existing IDs.
+        """
+        pass
+
+    def flush(self):
+        """
+        Makes preceding writes durable/sealed on stores that buffer them
+        (Milvus). Callers that issue several writes call it once at the end.
+        No-op by default.
+        """
+        pass
 
     # def count(self) -> int:
-    #     pass 
\ No newline at end of file
+    #     pass
@@ -1,19 +1,50 @@
 import numpy as np
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import faiss # Ensure faiss-cpu or faiss-gpu is installed
 import os
+import json
+from .attributes import AttributeIndex
 from .base import BaseStore
+from .idtable import IdTable
+from .rawvectors import RawVectors
+from ..filters import normalize as normalize_filters
 from ..cfg import CFG, ROOT # Import ROOT
 from pathlib import Path
 
+# 压缩存储模式 (conf/faiss.yaml quantization.mode)
+QUANT_MODES = ("none", "fp16", "int8", "binary")
+_SQ_FACTORY = {"fp16": "SQfp16", "int8": "SQ8"}
+
+
+def quantized_factory(factory: str, quant: str) -> str:
+    """The index_factory string that stores `factory`'s vectors as fp16 / int8 scalar codes."""
+    if quant not in _SQ_FACTORY:
+        return factory
+    sq = _SQ_FACTORY[quant]
+    head, _, tail = factory.rpartition(",")
+    if factory == "Flat":
+        return sq                           # Flat → SQ8
+    if tail == "Flat":
+        return f"{head},{sq}"               # IVF256,Flat → IVF256,SQ8
+    if "," not in factory and factory.startswith("HNSW"):
+        return f"{factory},{sq}"            # HNSW32 → HNSW32,SQ8
+    print(f"Warning: '{factory}' already compresses its vectors; quantization '{quant}' only adds rescoring.")
+    return factory
+
+
+def _binary_bits(dimension: int) -> int:
+    return (dimension + 7) // 8 * 8
+
 
 class FaissStore(BaseStore):
     def __init__(self,
                  index_path_override: str | None = None,
-                 dimension_override: int | None = None):
+                 dimension_override: int | None = None,
+                 autosave: bool = True):
         """
         index_path_override —— 子类若想用自己的文件路径，在这里传入
         dimension_override  —— 子类若想用自己的向量维度，在这里传入
+        autosave            —— False 时 add/delete/upsert 不落盘，由调用方最后调用一次 save()
         """
         base_cfg = CFG.store                  # conf/faiss.yaml
 
@@ -30,8 +61,35 @@ class FaissStore(BaseStore):
         else:
             self.index_file_path = Path(_index_path_str) # Convert to Path object
 
-        self.id_map_file_path = self.index_file_path.with_suffix(self.index_file_path.suffix + ".map")
-        
+        self.id_map_file_path = self.index_file_path.with_suffix(self.index_file_path.suffix + ".map")   # 旧版文本 map
+        self.id_table_path = self._ids_path(self.index_file_path)
+
+        # ▸ 2. 索引类型 (faiss.index_factory 字符串) 及建图/查询参数
+        self.index_cfg = base_cfg.get("index", {}) or {}
+        self.factory = self.index_cfg.get("factory", "Flat")
+        self.index_params = self.index_cfg.get("params", {}) or {}
+        self.factory_in_use = self.factory
+        # mmap: 索引与 ID 表以只读内存映射加载，多个 worker 共享同一份页缓存
+        self.use_mmap = bool(base_cfg.get("mmap", True))
+        self.autosave = autosave
+        self._mmapped = False
+
+        # ▸ 3. 压缩存储：fp16 / int8 标量量化或二值码 (汉明距离)。首轮从压缩索引多取
+        #      oversample 倍候选，再用 <index_path>.f32 中的全精度向量精确重排
+        self.quant_cfg = base_cfg.get("quantization", {}) or {}
+        self.quant = str(self.quant_cfg.get("mode", "none") or "none")
+        if self.quant not in QUANT_MODES:
+            raise ValueError(f"quantization.mode must be one of {QUANT_MODES}, got '{self.quant}'")
+        self.oversample = max(1, int(self.quant_cfg.get("oversample", 4)))
+        self.quant_in_use = self.quant
+        self.raw_path = self._raw_path(self.index_file_path)
+        self._raw: RawVectors | None = None     # 仅压缩模式下存在
+
+        # ▸ 4. 元数据过滤 (filters.py)：按 label 存放的属性索引 <index_path>.attrs.npz；
+        #      命中条数 ≤ exact_below 时直接对这些向量精确打分，否则交给 FAISS 的 IDSelectorBitmap
+        self.attrs_path = AttributeIndex.path_for(self.index_file_path)
+        self._attrs: AttributeIndex | None = None
+        self.exact_below = int((base_cfg.get("filters", {}) or {}).get("exact_below", 2048))
 
         if dimension_override:
             self.dimension = dimension_override
@@ -39,7 +97,12 @@ class FaissStore(BaseStore):
             self.dimension = CFG.embed_dim
 
         self.index = None
-        self.faiss_ids_map: List[str] = []
+        # IndexIDMap2 的 int64 label ↔ 题目字符串 ID。从磁盘加载时只保留只读的
+        # IdTable；第一次增删时才展开成 faiss_ids_map / id_to_label 两个 dict
+        self._id_table: IdTable | None = None
+        self._label_to_id: Dict[int, str] | None = {}
+        self._id_to_label: Dict[str, int] | None = {}
+        self._next_label = 0
         
         print(f"FaissStore initialized. Index path: {self.index_file_path}, Map path: {self.id_map_file_path}")
         self._load_index_and_map() # Attempt to load on initialization
@@ -50,187 +113,705 @@ class FaissStore(BaseStore):
             os.makedirs(dir_name, exist_ok=True)
             print(f"Created directory: {dir_name}")
 
-    def _load_index_and_map(self):
-        loaded_map = False
-        if os.path.exists(self.id_map_file_path):
+    @staticmethod
+    def _ids_path(index_path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_suffix(index_path.suffix + ".ids")
+
+    @staticmethod
+    def _raw_path(index_path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_suffix(index_path.suffix + ".f32")
+
+    @staticmethod
+    def _meta_path(index_path) -> Path:
+        index_path = Path(index_path)
+        return index_path.with_suffix(index_path.suffix + ".meta.json")
+
+    @staticmethod
+    def _labels_natively(index) -> bool:
+        """Whether `index` stores the store's labels itself (IDMap2 wrapper, or IVF with add_with_ids)."""
+        return isinstance(index, (faiss.IndexIDMap2, faiss.IndexBinaryIDMap2, faiss.IndexIVF))
+
+    @staticmethod
+    def _all_labels(index) -> np.ndarray:
+        if hasattr(index, "id_map"):
+            return faiss.vector_to_array(index.id_map)
+        invlists = index.invlists
+        parts = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+                 for l in range(index.nlist) if invlists.list_size(l)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def _unwrap_ivf(index):
+        """
+        IndexIDMap2(IndexIVF) → IndexIVF holding the labels in its inverted lists.
+        The wrapper assumes that remove_ids compacts the inner positions, which
+        IVF does not do, so its label table goes out of step after the first delete.
+        """
+        inner = faiss.downcast_index(index.index)
+        id_map = faiss.vector_to_array(index.id_map)
+        invlists = inner.invlists
+        for l in range(inner.nlist):
+            n = invlists.list_size(l)
+            if n:
+                ids = faiss.rev_swig_ptr(invlists.get_ids(l), n)
+                ids[:] = id_map[ids]        # 列表中存的是内部位置，原地换成 label
+        return faiss.clone_index(inner)
+
+    def _new_index(self, factory: str | None = None, quant: str | None = None):
+        """
+        Empty labelled index of the configured type; labels are assigned by the store, not by position.
+        IVF indexes take the labels through add_with_ids, everything else is wrapped in IndexIDMap2.
+        """
+        factory = factory or self.factory
+        quant = quant or self.quant
+        self.quant_in_use = quant
+        if quant == "none":
+            self._raw = None
+        elif self._raw is None:
+            self._raw = RawVectors.empty(self.dimension)
+        if quant == "binary":
+            if factory != "Flat":
+                print(f"Warning: binary codes are searched exhaustively; factory '{factory}' is ignored.")
+            self.factory_in_use = "Flat"
+            self._mmapped = False
+            return faiss.IndexBinaryIDMap2(faiss.IndexBinaryFlat(_binary_bits(self.dimension)))
+        # Inner Product as it's common for cosine similarity with normalized embeddings
+        base = faiss.index_factory(self.dimension, quantized_factory(factory, quant), faiss.METRIC_INNER_PRODUCT)
+        hnsw = getattr(faiss.downcast_index(base), "hnsw", None)
+        if hnsw is not None and "efConstruction" in self.index_params:
+            hnsw.efConstruction = int(self.index_params["efConstruction"])
+        self.factory_in_use = factory
+        self._mmapped = False   # 新建的索引总在堆内
+        # IVF 的 remove_ids 不压缩内部位置，不能包 IDMap2 (否则删除后 label 表与向量错位)
+        index = base if isinstance(base, faiss.IndexIVF) else faiss.IndexIDMap2(base)
+        self._apply_search_params(index)
+        return index
+
+    def _apply_search_params(self, index):
+        """Sets efSearch / nprobe where the index type supports them."""
+        if isinstance(index, faiss.IndexBinary):
+            return
+        ps = faiss.ParameterSpace()
+        for name in ("efSearch", "nprobe"):
+            if name in self.index_params:
+                try:
+                    ps.set_index_parameter(index, name, int(self.index_params[name]))
+                except RuntimeError:
+                    pass  # 该类型没有此参数 (例如 Flat 没有 nprobe)
+
+    def needs_training(self) -> bool:
+        """Whether the (configured) index type must be trained before vectors can be added."""
+        if self.index is not None:
+            return not self.index.is_trained
+        if self.quant == "binary":
+            return False
+        return not faiss.index_factory(self.dimension, quantized_factory(self.factory, self.quant),
+                                       faiss.METRIC_INNER_PRODUCT).is_trained
+
+    def _train_if_needed(self, vecs: np.ndarray):
+        """IVF / PQ indexes need a training pass before add(); train on a random sample."""
+        if self.index.is_trained:
+            return
+        n_sample = min(len(vecs), int(self.index_cfg.get("train_sample", 50000)))
+        rng = np.random.default_rng(0)
+        sample = vecs[rng.choice(len(vecs), n_sample, replace=False)] if n_sample < len(vecs) else vecs
+        print(f"Training FAISS index '{quantized_factory(self.factory_in_use, self.quant_in_use)}' on {len(sample)} vectors...")
+        try:
+            self.index.train(np.ascontiguousarray(sample, dtype=np.float32))
+        except RuntimeError as e:
+            print(f"Warning: training '{self.factory_in_use}' failed ({e}). Falling back to 'Flat'.")
+            self.index = self._new_index("Flat")
+
+    def _write_meta(self, index_path):
+        meta = {
+            "factory": self.factory_in_use,
+            "quantization": self.quant_in_use,
+            "metric": "IP",
+            "dimension": self.dimension,
+            "ntotal": int(self.index.ntotal),
+            "params": self.index_params,
+        }
+        with open(self._meta_path(index_path), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+
+    def _read_meta(self, index_path) -> dict:
+        meta_path = self._meta_path(index_path)
+        if not meta_path.exists():
+            return {"factory": "Flat"}   # 旧版索引文件没有 meta，都是 IndexFlatIP
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _restore_index(self, index, index_path):
+        """Post-load: wrap legacy indexes, restore the recorded type and search params."""
+        meta = self._read_meta(index_path)
+        index = self._as_id_mapped(index)
+        self.factory_in_use = meta.get("factory", "Flat")
+        self.quant_in_use = meta.get("quantization", "none")
+        if self.factory_in_use != self.factory:
+            print(f"Warning: index at {index_path} was built as '{self.factory_in_use}', "
+                  f"conf/faiss.yaml asks for '{self.factory}'. Rebuild (ragmath import) to switch.")
+        if self.quant_in_use != self.quant:
+            print(f"Warning: index at {index_path} uses quantization '{self.quant_in_use}', "
+                  f"conf/faiss.yaml asks for '{self.quant}'. Rebuild (ragmath import) to switch.")
+        self._apply_search_params(index)
+        return index
+
+    @property
+    def faiss_ids_map(self) -> Dict[int, str]:
+        self._materialize_id_map()
+        return self._label_to_id
+
+    @property
+    def id_to_label(self) -> Dict[str, int]:
+        self._materialize_id_map()
+        return self._id_to_label
+
+    def _materialize_id_map(self):
+        if self._label_to_id is None:
+            self._set_id_map(list(self._id_table.items()))
+
+    def _set_id_map(self, pairs: List[Tuple[int, str]]):
+        self._id_table = None
+        self._label_to_id = dict(pairs)
+        self._id_to_label = {item_id: label for label, item_id in self._label_to_id.items()}
+        self._next_label = max(self._label_to_id, default=-1) + 1
+
+    def _set_id_table(self, table: IdTable):
+        self._id_table = table
+        self._label_to_id = self._id_to_label = None
+        self._next_label = table.max_label + 1
+
+    def _id_count(self) -> int:
+        return len(self._id_table) if self._label_to_id is None else len(self._label_to_id)
+
+    def _current_id_table(self) -> IdTable:
+        return self._id_table if self._label_to_id is None else IdTable.from_pairs(self._label_to_id.items())
+
+    def _lookup_ids(self, labels) -> List[str | None]:
+        if self._label_to_id is None:
+            return self._id_table.lookup(labels)
+        return [self._label_to_id.get(int(l)) for l in labels]
+
+    def _read_id_table(self, index_path) -> IdTable | None:
+        """Binary `<index>.ids`; a legacy text `<index>.map` is converted on first load."""
+        table_path = self._ids_path(index_path)
+        if table_path.exists():
+            return IdTable.open(table_path, use_mmap=self.use_mmap)
+        map_path = Path(index_path).with_suffix(Path(index_path).suffix + ".map")
+        if not map_path.exists():
+            return None
+        table = IdTable.from_pairs(self._read_map_file(map_path))
+        try:
+            table.write(table_path)
+            print(f"Converted text ID map {map_path} → {table_path} ({len(table)} entries).")
+        except OSError as e:
+            print(f"Warning: could not write binary ID table {table_path}: {e}")
+        return table
+
+    def _read_index(self, index_path):
+        """Reads (memory-maps when enabled) a FAISS index file and restores its type / params."""
+        binary = self._read_meta(index_path).get("quantization") == "binary"
+        reader = faiss.read_index_binary if binary else faiss.read_index
+        raw, mmapped = None, False
+        if self.use_mmap:
             try:
-                with open(self.id_map_file_path, 'r', encoding='utf-8') as f:
-                    self.faiss_ids_map = [line.strip() for line in f.readlines() if line.strip()]
-                print(f"FAISS ID map loaded from {self.id_map_file_path} with {len(self.faiss_ids_map)} entries.")
-                loaded_map = True
-            except Exception as e:
-                print(f"Error loading FAISS ID map from {self.id_map_file_path}: {e}. ID map will be empty/rebuilt.")
-                self.faiss_ids_map = []
+                flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+                raw, mmapped = reader(str(index_path), flags), True
+            except RuntimeError as e:
+                print(f"Warning: could not mmap {index_path} ({e}); reading it into memory.")
+        if raw is None:
+            raw = reader(str(index_path))
+        # 旧版非 IDMap2 索引会被转换成新的堆内索引
+        self._mmapped = mmapped and self._labels_natively(raw)
+        return self._restore_index(raw, index_path)
+
+    def _read_raw(self, index_path) -> RawVectors | None:
+        """Full-precision side file of a quantized index (None for uncompressed indexes)."""
+        if self.quant_in_use == "none":
+            return None
+        raw_path = self._raw_path(index_path)
+        if not raw_path.exists():
+            print(f"Warning: {raw_path} not found; '{self.quant_in_use}' results will not be rescored.")
+            return None
+        return RawVectors.open(raw_path, use_mmap=self.use_mmap)
+
+    @staticmethod
+    def _read_attrs(index_path) -> AttributeIndex | None:
+        """Per-attribute filter index (None for indexes built without attributes)."""
+        attrs_path = AttributeIndex.path_for(index_path)
+        if not attrs_path.exists():
+            return None
+        try:
+            return AttributeIndex.open(attrs_path)
+        except Exception as e:
+            print(f"Warning: could not read attribute index {attrs_path}: {e}. Filtered searches will match nothing.")
+            return None
+
+    def _ensure_writable(self):
+        """A memory-mapped index is read-only; copy it onto the heap before the first mutation."""
+        if self._mmapped and self.index is not None:
+            if isinstance(self.index, faiss.IndexBinary):
+                self.index = faiss.deserialize_index_binary(faiss.serialize_index_binary(self.index))
+            else:
+                self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+            self._apply_search_params(self.index)
+            self._mmapped = False
+        if isinstance(self.index, faiss.IndexIDMap2) and isinstance(faiss.downcast_index(self.index.index), faiss.IndexIVF):
+            # 旧版本建的 IVF 索引包了 IDMap2：第一次增删前换成原生带 label 的 IVF
+            print("Converting IndexIDMap2-wrapped IVF index to a natively labelled IVF index...")
+            self.index = self._unwrap_ivf(self.index)
+            self._apply_search_params(self.index)
+        if self._raw is not None:
+            self._raw.ensure_writable()
+
+    @staticmethod
+    def _read_map_file(map_path) -> List[Tuple[int, str]]:
+        """Reads `label\tid` lines; legacy one-id-per-line files map to positional labels."""
+        pairs = []
+        with open(map_path, 'r', encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f if line.strip()]
+        for pos, line in enumerate(lines):
+            if '\t' in line:
+                label, item_id = line.split('\t', 1)
+                pairs.append((int(label), item_id.strip()))
+            else:
+                pairs.append((pos, line.strip()))
+        return pairs
+
+    @staticmethod
+    def _write_index_atomic(index, index_path):
+        # 先写临时文件再 rename：其他进程正在 mmap 的旧文件不受影响
+        index_path = Path(index_path)
+        tmp = index_path.with_name(f"{index_path.name}.tmp-{os.getpid()}")
+        if isinstance(index, faiss.IndexBinary):
+            faiss.write_index_binary(index, str(tmp))
+        else:
+            faiss.write_index(index, str(tmp))
+        os.replace(tmp, index_path)
+
+    def _as_id_mapped(self, index):
+        """Upgrades a legacy positional index (plain IndexFlatIP) to IndexIDMap2 with labels 0..n-1."""
+        if self._labels_natively(index):
+            return index
+        print(f"Converting legacy positional FAISS index ({index.ntotal} vectors) to IndexIDMap2...")
+        vecs = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), dtype=np.float32)
+        mapped = faiss.IndexIDMap2(faiss.IndexFlatIP(index.d))
+        if index.ntotal:
+            mapped.add_with_ids(vecs, np.arange(index.ntotal, dtype=np.int64))
+        return mapped
+
+    def _load_index_and_map(self):
+        table = None
+        try:
+            table = self._read_id_table(self.index_file_path)
+            if table is not None:
+                print(f"FAISS ID table loaded from {self.id_table_path} with {len(table)} entries.")
+            else:
+                print(f"FAISS ID table not found at {self.id_table_path}.")
+        except Exception as e:
+            print(f"Error loading FAISS ID table for {self.index_file_path}: {e}. ID map will be empty/rebuilt.")
+        if table is not None:
+            self._set_id_table(table)
         else:
-            print(f"FAISS ID map file not found at {self.id_map_file_path}.")
-            self.faiss_ids_map = []
+            self._set_id_map([])
 
         if os.path.exists(self.index_file_path):
-            print(f"Loading FAISS index from {self.index_file_path}...")
+            print(f"Loading FAISS index from {self.index_file_path}{' (mmap)' if self.use_mmap else ''}...")
             try:
-                self.index = faiss.read_index(str(self.index_file_path))
+                self.index = self._read_index(self.index_file_path)
+                self._raw = self._read_raw(self.index_file_path)
+                self._attrs = self._read_attrs(self.index_file_path)
                 print(f"FAISS index loaded. Contains {self.index.ntotal} vectors.")
-                if self.index.ntotal != len(self.faiss_ids_map) and loaded_map: # Only warn if map was successfully loaded
-                    print(f"Warning: FAISS index ({self.index.ntotal}) and loaded ID map ({len(self.faiss_ids_map)}) size mismatch.")
-                elif not loaded_map and self.index.ntotal > 0:
+                if self.index.ntotal != self._id_count() and table is not None: # Only warn if map was successfully loaded
+                    print(f"Warning: FAISS index ({self.index.ntotal}) and loaded ID map ({self._id_count()}) size mismatch.")
+                elif table is None and self.index.ntotal > 0:
                      print(f"Warning: Index loaded with {self.index.ntotal} vectors, but no ID map was found/loaded. IDs will be inconsistent until rebuild/load.")
-                     self.faiss_ids_map = [f"temp_id_{i}" for i in range(self.index.ntotal)] # Placeholder IDs
+                     labels = self._all_labels(self.index)
+                     self._set_id_map([(int(l), f"temp_id_{l}") for l in labels]) # Placeholder IDs
             except Exception as e:
                 print(f"Error loading FAISS index from {self.index_file_path}: {e}. Index will be None/rebuilt.")
                 self.index = None
-                self.faiss_ids_map = [] # Reset map if index load fails
+                self._raw = None
+                self._attrs = None
+                self._set_id_map([]) # Reset map if index load fails
         else:
             print(f"FAISS index file not found at {self.index_file_path}. A new index will be created upon build() or add().")
             self.index = None
-            self.faiss_ids_map = []
+            self._set_id_map([])
 
     def _save_index_and_map(self):
         if self.index is not None:
             self._ensure_dir_exists(self.index_file_path)
             print(f"Saving FAISS index to {self.index_file_path} with {self.index.ntotal} vectors...")
             try:
-                faiss.write_index(self.index, str(self.index_file_path))
+                self._write_index_atomic(self.index, self.index_file_path)
                 print("FAISS index saved successfully.")
                 
-                # Save the ID map
-                with open(self.id_map_file_path, 'w', encoding='utf-8') as f:
-                    for item_id in self.faiss_ids_map:
-                        f.write(f"{item_id}\n")
-                print(f"FAISS ID map saved to {self.id_map_file_path} with {len(self.faiss_ids_map)} entries.")
+                # Save the ID table and index type
+                self._current_id_table().write(self.id_table_path)
+                self._write_meta(self.index_file_path)
+                self._write_raw(self.index_file_path)
+                self._write_attrs(self.index_file_path)
+                if self.id_map_file_path.exists():
+                    os.remove(self.id_map_file_path)   # 旧版文本 map 已被二进制 ID 表取代
+                print(f"FAISS ID table saved to {self.id_table_path} with {self._id_count()} entries.")
             except Exception as e:
                 print(f"Error saving FAISS index or ID map: {e}")
         else:
             print("No FAISS index to save (index is None).")
 
-    def build(self, ids: List[str], vecs: np.ndarray):
+    def _write_raw(self, index_path):
+        raw_path = self._raw_path(index_path)
+        if self._raw is not None:
+            self._raw.compact(self._next_label)
+            self._raw.write(raw_path)
+        elif raw_path.exists():
+            os.remove(raw_path)     # 换回未压缩索引后，旧的全精度副本已无用
+
+    def _write_attrs(self, index_path):
+        attrs_path = AttributeIndex.path_for(index_path)
+        if self._attrs is not None:
+            self._attrs.compact(self._next_label)
+            self._attrs.write(attrs_path)
+        elif attrs_path.exists():
+            os.remove(attrs_path)
+
+    def save(self):
+        self._save_index_and_map()
+
+    def _check_input(self, ids: List[str], vecs: np.ndarray):
         if vecs.ndim != 2 or vecs.shape[1] != self.dimension:
             raise ValueError(f"Input vectors must be 2D with dimension {self.dimension}, got {vecs.shape}")
         if len(ids) != vecs.shape[0]:
             raise ValueError(f"Number of IDs ({len(ids)}) must match number of vectors ({vecs.shape[0]})")
 
-        print(f"Building new FAISS index with {vecs.shape[0]} vectors.")
-        # Using IndexFlatIP (Inner Product) as it's common for cosine similarity with normalized embeddings
-        self.index = faiss.IndexFlatIP(self.dimension) 
-        self.faiss_ids_map = [] # Reset map for a fresh build
-        self.add(ids, vecs) # add will handle saving
+    def build(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
+        self._check_input(ids, vecs)
+
+        print(f"Building new FAISS index '{self.factory}' (quantization: {self.quant}) with {vecs.shape[0]} vectors.")
+        self._raw = None
+        self._attrs = None
+        self.index = self._new_index()
+        self._set_id_map([]) # Reset map for a fresh build
+        self._train_if_needed(vecs)
+        self.add(ids, vecs, attrs) # add will handle saving
+
+    def _codes(self, vecs: np.ndarray) -> np.ndarray:
+        """What the FAISS index stores / is queried with: float32 rows, or sign bits for binary codes."""
+        vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+        if self.quant_in_use == "binary":
+            return np.packbits(vecs > 0, axis=1)
+        return vecs
+
+    def _rescore(self, queries: np.ndarray, labels: np.ndarray, distances: np.ndarray, k: int):
+        """Exact inner products of the over-fetched candidates from the full-precision side file; keeps the top k."""
+        if self._raw is None:
+            if self.quant_in_use == "binary":
+                # 没有全精度副本时，用汉明距离估计余弦相似度
+                distances = 1.0 - 2.0 * distances.astype(np.float32) / _binary_bits(self.dimension)
+            return distances[:, :k], labels[:, :k]
+        out_d = np.full((len(labels), k), -np.inf, dtype=np.float32)
+        out_l = np.full((len(labels), k), -1, dtype=np.int64)
+        for r, (q, row) in enumerate(zip(np.asarray(queries, dtype=np.float32), labels)):
+            scores = self._raw.get(row) @ q     # 只读取候选行，mmap 只换入这些页
+            scores[row < 0] = -np.inf
+            order = np.argsort(-scores, kind="stable")[:k]
+            out_d[r, :len(order)] = scores[order]
+            out_l[r, :len(order)] = row[order]
+        return out_d, out_l
+
+    def _add_no_save(self, ids: List[str], vecs: np.ndarray, labels: List[int] | None = None,
+                     attrs: dict | None = None):
+        self._ensure_writable()
+        if labels is None:
+            labels = list(range(self._next_label, self._next_label + len(ids)))
+        self.index.add_with_ids(self._codes(vecs), np.asarray(labels, dtype=np.int64))
+        if self._raw is not None:
+            self._raw.put(labels, np.asarray(vecs, dtype=np.float32))
+        if attrs is not None:
+            if self._attrs is None:
+                self._attrs = AttributeIndex.empty()
+            self._attrs.put(labels, attrs)
+        for label, item_id in zip(labels, ids):
+            self.faiss_ids_map[label] = item_id
+            self.id_to_label[item_id] = label
+        self._next_label = max(self._next_label, max(labels, default=-1) + 1)
+
+    def _remove_no_save(self, ids: List[str], keep_attrs: bool = False) -> int:
+        labels = [self.id_to_label[i] for i in ids if i in self.id_to_label]
+        if not labels:
+            return 0
+        self._ensure_writable()
+        try:
+            removed = self.index.remove_ids(np.asarray(labels, dtype=np.int64))
+        except RuntimeError:
+            # HNSW 不支持删除：用剩余向量重建图 (IVF 原生带 label，remove_ids 正确)
+            removed = self._rebuild_without(labels)
+        for label in labels:
+            self.id_to_label.pop(self.faiss_ids_map.pop(label), None)
+        if self._attrs is not None and not keep_attrs:
+            self._attrs.remove(labels)
+        return int(removed)
+
+    def _rebuild_without(self, labels: List[int]) -> int:
+        drop = set(labels)
+        keep = np.array([l for l in self._all_labels(self.index) if l not in drop], dtype=np.int64)
+        print(f"'{self.factory_in_use}' does not support removal; rebuilding with {len(keep)} vectors...")
+        if not len(keep):
+            vecs = None
+        elif self._raw is not None:
+            vecs = self._raw.get(keep)      # 压缩索引的 reconstruct 有损，用全精度副本
+        else:
+            vecs = np.stack([self.index.reconstruct(int(l)) for l in keep])
+        before = self.index.ntotal
+        self.index = self._new_index(self.factory_in_use, self.quant_in_use)
+        if vecs is not None:
+            self._train_if_needed(vecs)
+            self.index.add_with_ids(self._codes(vecs), keep)
+        return before - self.index.ntotal
 
-    def add(self, ids: List[str], vecs: np.ndarray):
+    def add(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
         if self.index is None:
-            print("FAISS index not initialized. Creating a default IndexFlatIP for adding data.")
-            self.index = faiss.IndexFlatIP(self.dimension)
-            self.faiss_ids_map = [] # Ensure map is also new
+            print(f"FAISS index not initialized. Creating a new '{self.factory}' index for adding data.")
+            self.index = self._new_index()
+            self._set_id_map([]) # Ensure map is also new
 
-        if vecs.ndim != 2 or vecs.shape[1] != self.dimension:
-            raise ValueError(f"Input vectors must be 2D with dimension {self.dimension}, got {vecs.shape}")
-        if len(ids) != vecs.shape[0]:
-            raise ValueError(f"Number of IDs ({len(ids)}) must match number of vectors ({vecs.shape[0]})")
+        self._check_input(ids, vecs)
+        self._train_if_needed(vecs)
 
         print(f"Adding {vecs.shape[0]} vectors to FAISS index...")
-        self.index.add(vecs.astype(np.float32))
-        self.faiss_ids_map.extend(ids)
-        self._save_index_and_map()
+        self._add_no_save(ids, vecs, attrs=attrs)
+        if self.autosave:
+            self._save_index_and_map()
+        print(f"FAISS index now contains {self.index.ntotal} vectors. ID map size: {len(self.faiss_ids_map)}.")
+
+    def delete(self, ids: List[str]) -> int:
+        if self.index is None or not ids:
+            return 0
+        removed = self._remove_no_save(ids)
+        print(f"Removed {removed} vectors from FAISS index.")
+        if removed and self.autosave:
+            self._save_index_and_map()
+        return removed
+
+    def upsert(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
+        if self.index is None:
+            self.index = self._new_index()
+            self._set_id_map([])
+        self._check_input(ids, vecs)
+        if not ids:
+            return
+        self._train_if_needed(vecs)
+        # 已存在的 ID 复用原 label，新 ID 分配新 label；不带 attrs 时沿用原 label 上的属性
+        labels = [self.id_to_label.get(i) for i in ids]
+        self._remove_no_save([i for i, l in zip(ids, labels) if l is not None], keep_attrs=attrs is None)
+        nxt = self._next_label
+        for j, l in enumerate(labels):
+            if l is None:
+                labels[j] = nxt
+                nxt += 1
+        print(f"Upserting {len(ids)} vectors into FAISS index...")
+        self._add_no_save(ids, vecs, labels, attrs)
+        if self.autosave:
+            self._save_index_and_map()
         print(f"FAISS index now contains {self.index.ntotal} vectors. ID map size: {len(self.faiss_ids_map)}.")
 
-    def search(self, vec: np.ndarray, k: int) -> Tuple[List[str], List[float]]:
+    def search(self, vec: np.ndarray, k: int, filters=None) -> Tuple[List[str], List[float]]:
+        if vec.ndim == 2 and vec.shape[0] != 1:
+            raise ValueError(f"Query vector must be 1D or a single 2D vector, got shape {vec.shape}. Use search_batch() for several queries.")
+        results = self.search_batch(vec.reshape(1, -1), k, filters)
+        return results[0] if results else ([], [])
+
+    def _filter_labels(self, f) -> np.ndarray:
+        """Labels of the indexed items that satisfy filter `f` (see filters.py)."""
+        if self._attrs is None:
+            print("Warning: this FAISS index has no attribute index; filtered searches match nothing. "
+                  "Rebuild (ragmath import) or run ragmath sync.")
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self._attrs.select(f, self._next_label)).astype(np.int64)
+
+    def _selector_params(self, labels: np.ndarray):
+        """SearchParameters restricting the search to `labels` through an IDSelectorBitmap."""
+        mask = np.zeros(self._next_label, dtype=bool)
+        mask[labels] = True
+        bitmap = np.packbits(mask, bitorder="little")
+        sel = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+        sel.referenced_objects = [bitmap]   # SWIG 只拿到指针：让位图随 sel 存活
+        base = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap2) else self.index
+        if isinstance(base, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=base.nprobe)
+        elif isinstance(base, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=sel, efSearch=base.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=sel)
+        params.referenced_objects = [sel]
+        return params
+
+    def _search_exact(self, vecs: np.ndarray, labels: np.ndarray, k: int):
+        """Exact inner products against only the `labels` vectors; None if they cannot be read back."""
+        if self._raw is not None:
+            cand = self._raw.get(labels)
+        elif isinstance(self.index, faiss.IndexBinary):
+            return None
+        else:
+            try:
+                cand = self.index.reconstruct_batch(labels)
+            except RuntimeError:
+                return None     # 例如 IVF 没有 direct map
+        scores = np.asarray(vecs, dtype=np.float32) @ cand.T
+        k = min(k, len(labels))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top_scores, order, axis=1), labels[np.take_along_axis(top, order, axis=1)]
+
+    def search_batch(self, vecs: np.ndarray, k: int, filters=None) -> List[Tuple[List[str], List[float]]]:
+        if vecs.ndim == 1:
+            vecs = vecs.reshape(1, -1)
+        if vecs.ndim != 2:
+            raise ValueError(f"Query vectors must be 2D (n, dim), got shape {vecs.shape}")
+        n_queries = vecs.shape[0]
+
         if self.index is None or self.index.ntotal == 0:
             print("FAISS index is not initialized or is empty. Cannot search.")
-            return [], []
+            return [([], []) for _ in range(n_queries)]
         
-        if not self.faiss_ids_map:
+        n_ids = self._id_count()
+        if not n_ids:
             print("Warning: FAISS ID map is empty. Search results will lack original IDs.")
             # Fallback or error based on desired behavior
-        elif self.index.ntotal != len(self.faiss_ids_map):
-            print(f"Warning: Mismatch between index size ({self.index.ntotal}) and ID map size ({len(self.faiss_ids_map)}). Search results might be incorrect or incomplete.")
-
-        if vec.ndim == 1:
-            query_vecs = np.array([vec], dtype=np.float32)
-        elif vec.ndim == 2 and vec.shape[0] == 1:
-            query_vecs = vec.astype(np.float32)
-        else:
-            raise ValueError(f"Query vector must be 1D or a single 2D vector, got shape {vec.shape}")
+        elif self.index.ntotal != n_ids:
+            print(f"Warning: Mismatch between index size ({self.index.ntotal}) and ID map size ({n_ids}). Search results might be incorrect or incomplete.")
 
         effective_k = min(k, self.index.ntotal)
         if effective_k == 0:
-            return [], []
+            return [([], []) for _ in range(n_queries)]
 
-        # print(f"Searching in FAISS for {effective_k} nearest neighbors...")
-        distances, faiss_indices = self.index.search(query_vecs, effective_k)
-        
-        result_ids = []
-        result_distances = []
-        
-        if not self.faiss_ids_map: # If map is empty, can't return string IDs
-            print("Cannot map FAISS indices to string IDs because ID map is empty.")
-            return [str(fi) for fi in faiss_indices[0] if fi >=0], distances[0].tolist()
+        # 元数据过滤：只对可能命中的向量打分
+        f = normalize_filters(filters)
+        params, found = None, None
+        if f is not None:
+            allowed = self._filter_labels(f)
+            if not len(allowed):
+                return [([], []) for _ in range(n_queries)]
+            if len(allowed) <= self.exact_below:
+                found = self._search_exact(vecs, allowed, effective_k)
+            if found is None and len(allowed) < self._id_count():
+                params = self._selector_params(allowed)
 
-
-        for i, faiss_idx in enumerate(faiss_indices[0]):
-            if 0 <= faiss_idx < len(self.faiss_ids_map):
-                result_ids.append(self.faiss_ids_map[faiss_idx])
-                result_distances.append(float(distances[0][i]))
-            else:
-                # This case should ideally not happen if k <= ntotal and map is correct
-                print(f"Warning: Invalid FAISS index {faiss_idx} encountered during search result mapping (ID map size: {len(self.faiss_ids_map)}).")
+        if found is not None:
+            distances, faiss_labels = found
+        else:
+            # 一次调用完成所有查询的检索；压缩索引先多取候选，再精确重排
+            fetch = effective_k
+            if self.quant_in_use != "none":
+                fetch = min(self.index.ntotal, effective_k * self.oversample)
+            distances, faiss_labels = self.index.search(self._codes(vecs), fetch, params=params)
+            if self.quant_in_use != "none":
+                distances, faiss_labels = self._rescore(vecs, faiss_labels, distances, effective_k)
+        effective_k = faiss_labels.shape[1]
         
-        return result_ids, result_distances
+        if not n_ids: # If map is empty, can't return string IDs
+            print("Cannot map FAISS labels to string IDs because ID map is empty.")
+            return [([str(fi) for fi in row if fi >= 0], dist.tolist())
+                    for row, dist in zip(faiss_labels, distances)]
+
+        # 一次性把所有 label 映射成字符串 ID
+        mapped = self._lookup_ids(faiss_labels.reshape(-1))
+        results = []
+        for r, (row_labels, row_dist) in enumerate(zip(faiss_labels, distances)):
+            result_ids = []
+            result_distances = []
+            for i, label in enumerate(row_labels):
+                item_id = mapped[r * effective_k + i]
+                if item_id is not None:
+                    result_ids.append(item_id)
+                    result_distances.append(float(row_dist[i]))
+                elif label >= 0:
+                    # This case should ideally not happen if the map is consistent with the index
+                    print(f"Warning: Unknown FAISS label {label} encountered during search result mapping (ID map size: {n_ids}).")
+            results.append((result_ids, result_distances))
+        return results
 
     def count(self) -> int:
         if self.index:
             return self.index.ntotal
         return 0
 
+    def memory_report(self) -> dict:
+        """Size of the (compressed) index and its rescoring side file vs. an uncompressed Flat index."""
+        n = self.count()
+        flat = n * (self.dimension * 4 + 8)     # IndexIDMap2(IndexFlatIP)：向量 + int64 label
+        index_bytes = 0
+        if self.index is not None:
+            ser = faiss.serialize_index_binary if isinstance(self.index, faiss.IndexBinary) else faiss.serialize_index
+            index_bytes = int(ser(self.index).size)
+        return {
+            "factory": self.factory_in_use,
+            "quantization": self.quant_in_use,
+            "vectors": n,
+            "flat_fp32_bytes": flat,
+            "index_bytes": index_bytes,
+            "saved_bytes": flat - index_bytes,
+            "ratio": index_bytes / flat if flat else 0.0,
+            # 全精度副本通过 mmap 读取，常驻内存的只有精排时访问过的页
+            "rescore_file_bytes": self._raw.nbytes if self._raw is not None else 0,
+            "attribute_index_bytes": self._attrs.nbytes if self._attrs is not None else 0,
+        }
+
     def dump(self, dump_base_path_str: str):
         """Dumps the current index and its ID map to the specified base path."""
-        if self.index is None or not self.faiss_ids_map:
+        if self.index is None or not self._id_count():
             print("Nothing to dump: FAISS index is None or ID map is empty.")
             return
 
         dump_index_file = Path(dump_base_path_str)
-        dump_map_file = dump_index_file.with_suffix(dump_index_file.suffix + ".map")
+        dump_ids_file = self._ids_path(dump_index_file)
         
         self._ensure_dir_exists(dump_index_file)
-        print(f"Dumping FAISS index to {dump_index_file} ({self.index.ntotal} vectors) and map to {dump_map_file} ({len(self.faiss_ids_map)} IDs)...")
+        print(f"Dumping FAISS index to {dump_index_file} ({self.index.ntotal} vectors) and ID table to {dump_ids_file} ({self._id_count()} IDs)...")
         try:
-            faiss.write_index(self.index, str(dump_index_file))
-            with open(dump_map_file, 'w', encoding='utf-8') as f:
-                for item_id in self.faiss_ids_map:
-                    f.write(f"{item_id}\n")
+            self._write_index_atomic(self.index, dump_index_file)
+            self._current_id_table().write(dump_ids_file)
+            self._write_meta(dump_index_file)
+            self._write_raw(dump_index_file)
+            self._write_attrs(dump_index_file)
             print("Dump successful.")
         except Exception as e:
             print(f"Error during FAISS dump: {e}")
 
     def load(self, load_base_path_str: str) -> bool:
-        """Loads an index and its ID map from the specified base path, replacing the current one."""
+        """Loads an index and its ID table (or legacy .map) from the specified base path, replacing the current one."""
         load_index_file = Path(load_base_path_str)
-        load_map_file = load_index_file.with_suffix(load_index_file.suffix + ".map")
 
-        print(f"Attempting to load FAISS index from {load_index_file} and map from {load_map_file}...")
+        print(f"Attempting to load FAISS index from {load_index_file} and its ID table...")
         
-        temp_ids_map = []
-        if os.path.exists(load_map_file):
-            try:
-                with open(load_map_file, 'r', encoding='utf-8') as f:
-                    temp_ids_map = [line.strip() for line in f.readlines() if line.strip()]
-                print(f"Successfully read ID map file with {len(temp_ids_map)} entries.")
-            except Exception as e:
-                print(f"Error reading ID map file {load_map_file}: {e}. Cannot load.")
-                return False # Indicate failure
-        else:
-            print(f"ID map file {load_map_file} not found. Cannot load.")
+        try:
+            temp_table = self._read_id_table(load_index_file)
+        except Exception as e:
+            print(f"Error reading ID table for {load_index_file}: {e}. Cannot load.")
+            return False # Indicate failure
+        if temp_table is None:
+            print(f"Neither {self._ids_path(load_index_file)} nor a legacy .map file was found. Cannot load.")
             return False
+        print(f"Successfully read ID table with {len(temp_table)} entries.")
 
         if os.path.exists(load_index_file):
             try:
-                temp_index = faiss.read_index(str(load_index_file))
+                temp_index = self._read_index(load_index_file)
                 print(f"Successfully read FAISS index file with {temp_index.ntotal} vectors.")
                 
-                if temp_index.ntotal != len(temp_ids_map):
+                if temp_index.ntotal != len(temp_table):
                     print(f"Warning: Loaded index vector count ({temp_index.ntotal}) "
-                          f"does not match ID map entry count ({len(temp_ids_map)}). "
+                          f"does not match ID map entry count ({len(temp_table)}). "
                           "Proceeding with load, but there might be inconsistencies.")
 
                 self.index = temp_index
-                self.faiss_ids_map = temp_ids_map
+                self._raw = self._read_raw(load_index_file)
+                self._attrs = self._read_attrs(load_index_file)
+                self._set_id_table(temp_table)
                 # Update internal paths to reflect that we've loaded from this new source
                 # Or decide if load() should also update self.index_file_path etc.
                 # For now, it just loads into memory. The main configured paths remain.
@@ -241,4 +822,61 @@ class FaissStore(BaseStore):
                 return False
         else:
             print(f"FAISS index file {load_index_file} not found. Cannot load.")
-            return False 
\ No newline at end of file
+            return False
+
+
+def convert_map(index_path) -> Path | None:
+    """Converts `<index>.map` (text) next to `index_path` into the binary `<index>.ids` table."""
+    index_path = Path(index_path)
+    map_path = index_path.with_suffix(index_path.suffix + ".map")
+    if not map_path.exists():
+        print(f"No text ID map at {map_path}; nothing to convert.")
+        return None
+    table = IdTable.from_pairs(FaissStore._read_map_file(map_path))
+    ids_path = FaissStore._ids_path(index_path)
+    table.write(ids_path)
+    print(f"Converted {map_path} → {ids_path} ({len(table)} entries).")
+    return ids_path
+
+
+def quantization_report(vecs: np.ndarray, k: int = 10, sample: int = 200,
+                        factory: str = "Flat", oversample: int | None = None,
+                        modes=QUANT_MODES) -> List[dict]:
+    """
+    Builds throwaway indexes of `vecs` for every quantization mode and compares
+    them with exact inner-product search: memory, recall@k of the compressed
+    first pass alone, and recall@k after exact rescoring of the over-fetched
+    candidates. Queries are a random sample of the vectors themselves.
+    """
+    import tempfile
+    import time
+
+    vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+    ids = [str(i) for i in range(len(vecs))]
+    rng = np.random.default_rng(0)
+    queries = vecs[rng.choice(len(vecs), min(sample, len(vecs)), replace=False)]
+    k = min(k, len(vecs))
+    exact = np.argsort(-(queries @ vecs.T), axis=1, kind="stable")[:, :k]
+    truth = [set(map(str, row)) for row in exact.tolist()]
+
+    def recall(results) -> float:
+        return float(np.mean([len(t & set(r_ids)) / k for t, (r_ids, _) in zip(truth, results)]))
+
+    report = []
+    with tempfile.TemporaryDirectory(prefix="ragmath-quant-") as tmp:
+        for mode in modes:
+            store = FaissStore(index_path_override=str(Path(tmp) / f"{mode}.bin"),
+                               dimension_override=vecs.shape[1], autosave=False)
+            store.factory, store.quant = factory, mode
+            store.oversample = oversample or store.oversample
+            store.build(ids, vecs)
+            wanted = store.oversample
+            store.oversample = 1        # 只取 k 个候选：即压缩索引首轮本身的召回
+            first_pass = recall(store.search_batch(queries, k))
+            store.oversample = wanted
+            t0 = time.perf_counter()
+            rescored = recall(store.search_batch(queries, k))
+            ms = (time.perf_counter() - t0) * 1000 / len(queries)
+            report.append({**store.memory_report(), "oversample": wanted, f"recall@{k}_first_pass": first_pass,
+                           f"recall@{k}": rescored, "search_ms_per_query": ms})
+    return report
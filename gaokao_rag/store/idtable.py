@@ -0,0 +1,86 @@
+# gaokao_rag/store/idtable.py
+"""
+Compact, memory-mappable label → item-id table for FaissStore.
+
+Replaces the text `.map` file. One binary file holds a 24-byte header
+(magic, row count, blob size), the int64 labels in ascending order, int64
+offsets into the blob and the UTF-8 blob of item ids. Opened with mmap, every
+worker shares the same page-cached copy and nothing is parsed at startup;
+search results are resolved with one `np.searchsorted` per batch.
+"""
+import mmap
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"GKIDTBL1"
+_HEADER = 24
+
+
+class IdTable:
+    def __init__(self, labels: np.ndarray, offsets: np.ndarray, blob, _buf=None):
+        self.labels = labels        # int64[n]，升序
+        self.offsets = offsets      # int64[n + 1]
+        self.blob = blob            # bytes 或 mmap 切片
+        self._buf = _buf            # 保持 mmap 存活
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[int, str]]) -> "IdTable":
+        pairs = sorted((int(l), str(i)) for l, i in pairs)
+        encoded = [i.encode("utf-8") for _, i in pairs]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.array([l for l, _ in pairs], dtype=np.int64), offsets, b"".join(encoded))
+
+    @classmethod
+    def open(cls, path, use_mmap: bool = True) -> "IdTable":
+        with open(path, "rb") as f:
+            if use_mmap:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        if bytes(buf[:8]) != MAGIC:
+            raise ValueError(f"{path} is not an id table (bad magic)")
+        n, blob_len = np.frombuffer(buf, dtype=np.int64, count=2, offset=8).tolist()
+        labels = np.frombuffer(buf, dtype=np.int64, count=n, offset=_HEADER)
+        offsets = np.frombuffer(buf, dtype=np.int64, count=n + 1, offset=_HEADER + 8 * n)
+        start = _HEADER + 8 * (2 * n + 1)
+        blob = memoryview(buf)[start:start + blob_len]
+        return cls(labels, offsets, blob, _buf=buf)
+
+    def write(self, path):
+        """Atomic write (temp file + rename) so readers never map a half-written table."""
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array([len(self.labels), len(self.blob)], dtype=np.int64).tobytes())
+            f.write(np.ascontiguousarray(self.labels, dtype=np.int64).tobytes())
+            f.write(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+            f.write(self.blob)
+        os.replace(tmp, path)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def max_label(self) -> int:
+        return int(self.labels[-1]) if len(self.labels) else -1
+
+    def _id_at(self, pos: int) -> str:
+        return bytes(self.blob[self.offsets[pos]:self.offsets[pos + 1]]).decode("utf-8")
+
+    def lookup(self, labels) -> List[Optional[str]]:
+        """Item ids for `labels` (None for labels not in the table, e.g. FAISS's -1)."""
+        q = np.asarray(labels, dtype=np.int64).reshape(-1)
+        if not len(self.labels):
+            return [None] * len(q)
+        pos = np.minimum(np.searchsorted(self.labels, q), len(self.labels) - 1)
+        found = self.labels[pos] == q
+        return [self._id_at(p) if ok else None for p, ok in zip(pos.tolist(), found.tolist())]
+
+    def items(self) -> Iterator[Tuple[int, str]]:
+        for pos, label in enumerate(self.labels.tolist()):
+            yield label, self._id_at(pos)
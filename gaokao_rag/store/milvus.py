@@ -1,23 +1,44 @@
 from pymilvus import connections, FieldSchema, CollectionSchema, DataType, Collection, utility
 from .base import BaseStore
 from ..cfg import CFG
+from ..filters import MULTI, UNKNOWN_DIFFICULTY, milvus_expr, normalize as normalize_filters, subset
+import itertools
+import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from typing import List, Tuple
 
+# 过滤用标量字段 (filters.py)：ARRAY 字段的容量 / 单个取值的最大长度
+_ARRAY_CAPACITY = 64
+_TOPIC_MAX_LENGTH = 256
+
 class MilvusStore(BaseStore):
     def __init__(self):
         self.param = CFG.store
         self.collection_name = self.param['collection']
         self.alias = self.param.get('alias', 'default') # Use alias from config or default
 
-        # Connect to Milvus
+        # 写入 / 查询吞吐相关配置 (conf/milvus.yaml)
+        insert_cfg = self.param.get('insert', {}) or {}
+        self.batch_size = max(1, int(insert_cfg.get('batch_size', 5000)))
+        self.max_in_flight = max(1, int(insert_cfg.get('max_in_flight', 4)))
+        self.flush_each_write = insert_cfg.get('flush', 'end') == 'each'
+        self.consistency_level = self.param.get('consistency_level', 'Strong')
+        self.pool_size = max(1, int(self.param.get('pool_size', 1)))
+
+        # Connect to Milvus：pool_size 个连接 (alias, alias_pool1, …)，写入分块与并发查询轮流使用
+        self.aliases = [self.alias] + [f"{self.alias}_pool{i}" for i in range(1, self.pool_size)]
         try:
-            print(f"Connecting to Milvus: host={self.param['host']}, port={self.param['port']}, alias={self.alias}")
-            connections.connect(
-                alias=self.alias,
-                host=self.param['host'],
-                port=str(self.param['port'])
-            )
+            print(f"Connecting to Milvus: host={self.param['host']}, port={self.param['port']}, "
+                  f"alias={self.alias}, pool_size={self.pool_size}")
+            for alias in self.aliases:
+                connections.connect(
+                    alias=alias,
+                    host=self.param['host'],
+                    port=str(self.param['port'])
+                )
             print(f"Successfully connected to Milvus with alias '{self.alias}'.")
         except Exception as e:
             print(f"Error connecting to Milvus: {e}")
@@ -30,102 +51,235 @@ class MilvusStore(BaseStore):
         else:
             print(f"Collection '{self.collection_name}' does not exist. Creating...")
             self.col = self._create_collection(self.param)
+        # 早于元数据过滤创建的集合没有标量字段：照常写入向量，过滤查询则无结果
+        self.has_attrs = {f.name for f in self.col.schema.fields} >= {"difficulty", *MULTI}
+        if not self.has_attrs:
+            print(f"Warning: collection '{self.collection_name}' has no filter fields (difficulty/year/topic); "
+                  "drop it and re-import to enable filtered search.")
         
         # Load collection before search, can be done once at init if data doesn't change often
         # Or, ensure it's loaded before each search if that's more appropriate.
         print(f"Loading collection '{self.collection_name}' into memory...")
         self.col.load()
         print(f"Collection '{self.collection_name}' loaded.")
+        self._cols = [self.col] + [Collection(self.collection_name, using=a) for a in self.aliases[1:]]
+        self._col_cycle = itertools.cycle(self._cols)
+        self._cycle_lock = threading.Lock()
+
+    def _next_col(self) -> Collection:
+        """Round-robin over the pooled connections."""
+        with self._cycle_lock:
+            return next(self._col_cycle)
+
+    @staticmethod
+    def _build_params(p) -> dict:
+        index_type = p.get('index_type', 'HNSW')
+        if index_type == 'HNSW':
+            return {"M": p['params']['M'], "efConstruction": p['params']['efConstruction']}
+        if index_type == 'IVF_PQ':
+            return {"nlist": p['params']['nlist'], "m": p['params']['m']}
+        return {"nlist": p['params']['nlist']}
+
+    @staticmethod
+    def _search_params(p) -> dict:
+        if p.get('index_type', 'HNSW') == 'HNSW':
+            return {"ef": p['params']['efSearch']}
+        return {"nprobe": p['params']['nprobe']}
 
     def _create_collection(self, p):
         fields = [
             FieldSchema(name="id", dtype=DataType.VARCHAR, is_primary=True, max_length=64, description="Primary key ID"),
-            FieldSchema(name="vec", dtype=DataType.FLOAT_VECTOR, dim=CFG.embed_dim, description="Float vector embedding")
+            FieldSchema(name="vec", dtype=DataType.FLOAT_VECTOR, dim=CFG.embed_dim, description="Float vector embedding"),
+            FieldSchema(name="difficulty", dtype=DataType.FLOAT, description=f"Difficulty ({UNKNOWN_DIFFICULTY} = unknown)"),
+            FieldSchema(name="year", dtype=DataType.ARRAY, element_type=DataType.INT64,
+                        max_capacity=_ARRAY_CAPACITY, description="Exam years"),
+            FieldSchema(name="topic", dtype=DataType.ARRAY, element_type=DataType.VARCHAR,
+                        max_capacity=_ARRAY_CAPACITY, max_length=_TOPIC_MAX_LENGTH,
+                        description="Knowledge points (names and ids)"),
         ]
         schema = CollectionSchema(fields, description=f"Collection for {self.collection_name}")
         print(f"Creating collection '{self.collection_name}' with schema: {fields}")
         col = Collection(self.collection_name, schema=schema, using=self.alias)
-        
+        self._create_indexes(col, p)
+        return col
+
+    def _create_indexes(self, col, p):
         index_params = {
             "metric_type": "IP",  # Inner Product for similarity
-            "index_type": "HNSW",
-            "params": {"M": p['params']['M'], "efConstruction": p['params']['efConstruction']}
+            "index_type": p.get('index_type', 'HNSW'),
+            "params": self._build_params(p)
         }
         print(f"Creating index for 'vec' field with params: {index_params}")
         col.create_index(field_name="vec", index_params=index_params)
         print("Index created.")
-        return col
+        # 标量倒排索引：过滤表达式先在这些索引上求出候选集合，再做向量检索
+        for field in ("difficulty", *MULTI):
+            try:
+                col.create_index(field_name=field, index_params={"index_type": "INVERTED"})
+            except Exception as e:
+                print(f"Warning: could not create scalar index on '{field}': {e}")
+
+    def _entities(self, ids: List[str], vecs: np.ndarray, attrs: dict | None) -> list:
+        """Column-wise insert data; rows without attributes get 'unknown' values."""
+        data = [ids, vecs.tolist()]
+        if not self.has_attrs:
+            return data
+        if attrs is None:
+            return data + [[UNKNOWN_DIFFICULTY] * len(ids), [[] for _ in ids], [[] for _ in ids]]
+        diff = np.nan_to_num(np.asarray(attrs["difficulty"], dtype=np.float64), nan=UNKNOWN_DIFFICULTY)
+        return data + [diff.tolist(),
+                       [list(map(int, row))[:_ARRAY_CAPACITY] for row in attrs["year"]],
+                       [[str(t)[:_TOPIC_MAX_LENGTH] for t in row][:_ARRAY_CAPACITY] for row in attrs["topic"]]]
 
-    def build(self, ids: List[str], vecs: np.ndarray):
+    def _write(self, op: str, ids: List[str], vecs: np.ndarray, attrs: dict | None) -> int:
+        """
+        insert / upsert in chunks of `insert.batch_size` rows, with at most
+        `insert.max_in_flight` requests outstanding (round-robin over the
+        connection pool). Rows are converted to lists one chunk at a time, in
+        the worker threads, so a large matrix is never copied as a whole.
+        """
+        def send(col, a, b):
+            data = self._entities(ids[a:b], vecs[a:b], subset(attrs, range(a, b)))
+            return getattr(col, op)(data)
+
+        n, pending = len(ids), deque()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix=f"milvus-{op}") as ex:
+            for a in range(0, n, self.batch_size):
+                if len(pending) >= self.max_in_flight:
+                    pending.popleft().result()      # 背压：等最早的请求完成
+                pending.append(ex.submit(send, self._next_col(), a, min(a + self.batch_size, n)))
+            while pending:
+                pending.popleft().result()
+        return (n + self.batch_size - 1) // self.batch_size
+
+    def flush(self):
+        """Seals the growing segments; build() calls it once at the end, batch writers (sync, ingest) after their last write."""
+        print(f"Flushing collection '{self.collection_name}'...")
+        self.col.flush()
+        print("Flush complete.")
+
+    def _after_write(self):
+        if self.flush_each_write:
+            self.flush()
+
+    def build(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
         # For Milvus, build is often part of initial creation or a large batch insert.
         # If collection exists and has data, we might want to clear it first for a true 'build'.
         if utility.has_collection(self.collection_name, using=self.alias):
             # Check if there's data. If so, decide on dropping or simply adding.
             # For a true `build` from scratch, one might drop and recreate.
-            # self.col.drop_index() # if needed
-            # self.col.release() # if needed
             # utility.drop_collection(self.collection_name, using=self.alias) # if needed
             # self.col = self._create_collection(self.param)
             print(f"Collection '{self.collection_name}' exists. Adding data to it.")
-        
-        print(f"Building index by adding {len(ids)} vectors.")
-        self.add(ids, vecs) # Milvus HNSW index is built incrementally
+        if not ids or vecs.size == 0:
+            print("No data provided to build.")
+            return
+
+        # index_after_load：先删索引再批量写入，写完 flush 后一次性建索引，比边写边建快
+        index_after_load = bool(self.param.get('index_after_load', False))
+        if index_after_load:
+            print("index_after_load: releasing the collection and dropping its indexes for the bulk load...")
+            self.col.release()
+            for index in list(self.col.indexes):
+                index.drop()
 
-    def add(self, ids: List[str], vecs: np.ndarray):
+        print(f"Building index by inserting {len(ids)} vectors "
+              f"({self.batch_size} per request, ≤{self.max_in_flight} in flight).")
+        try:
+            chunks = self._write("insert", ids, vecs, attrs)
+            print(f"Inserted {len(ids)} entities in {chunks} requests.")
+            self.flush()    # 整个 build 只 flush 一次
+        except Exception as e:
+            print(f"Error during Milvus insert/flush: {e}")
+            raise
+        if index_after_load:
+            self._create_indexes(self.col, self.param)
+            print(f"Loading collection '{self.collection_name}' into memory...")
+            self.col.load()
+
+    def add(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
         if not ids or vecs.size == 0:
             print("No data provided to add.")
             return
         
-        data = [ids, vecs.tolist()] # Milvus expects list of lists for insert
         print(f"Inserting {len(ids)} entities into '{self.collection_name}'...")
         try:
-            mr = self.col.insert(data)
-            print(f"Insertion result: {mr}")
-            print("Flushing collection to ensure data persistence...")
-            self.col.flush()
-            print("Flush complete.")
+            chunks = self._write("insert", ids, vecs, attrs) # Milvus expects list of lists for insert
+            print(f"Inserted {len(ids)} entities in {chunks} requests.")
+            self._after_write()
         except Exception as e:
             print(f"Error during Milvus insert/flush: {e}")
             raise
 
-    def search(self, vec: np.ndarray, k: int) -> Tuple[List[str], List[float]]:
-        if vec.ndim == 1:
-            search_vecs = [vec.tolist()] # Search expects a list of vectors
-        else:
-            search_vecs = vec.tolist()
+    @staticmethod
+    def _ids_expr(ids: List[str]) -> str:
+        return f"id in {json.dumps([str(i) for i in ids], ensure_ascii=False)}"
+
+    def delete(self, ids: List[str]) -> int:
+        if not ids:
+            return 0
+        print(f"Deleting {len(ids)} entities from '{self.collection_name}' by primary key...")
+        deleted = 0
+        try:
+            for a in range(0, len(ids), self.batch_size):
+                mr = self.col.delete(self._ids_expr(ids[a:a + self.batch_size]))
+                deleted += int(getattr(mr, 'delete_count', min(self.batch_size, len(ids) - a)))
+            self._after_write()
+        except Exception as e:
+            print(f"Error during Milvus delete: {e}")
+            raise
+        return deleted
+
+    def upsert(self, ids: List[str], vecs: np.ndarray, attrs: dict | None = None):
+        if not ids or vecs.size == 0:
+            print("No data provided to upsert.")
+            return
+        print(f"Upserting {len(ids)} entities into '{self.collection_name}'...")
+        try:
+            chunks = self._write("upsert", ids, vecs, attrs)
+            print(f"Upserted {len(ids)} entities in {chunks} requests.")
+            self._after_write()
+        except Exception as e:
+            print(f"Error during Milvus upsert: {e}")
+            raise
+
+    def search(self, vec: np.ndarray, k: int, filters=None) -> Tuple[List[str], List[float]]:
+        results = self.search_batch(vec.reshape(1, -1) if vec.ndim == 1 else vec, k, filters)
+        return results[0] if results else ([], [])
+
+    def search_batch(self, vecs: np.ndarray, k: int, filters=None) -> List[Tuple[List[str], List[float]]]:
+        if vecs.ndim == 1:
+            vecs = vecs.reshape(1, -1)
+        f = normalize_filters(filters)
+        if f is not None and not self.has_attrs:
+            print(f"Warning: collection '{self.collection_name}' has no filter fields; filtered search matches nothing.")
+            return [([], []) for _ in range(len(vecs))]
+        search_vecs = vecs.tolist() # Search expects a list of vectors
 
         search_params = {
             "metric_type": "IP",
-            "params": {"ef": CFG.store['params']['efSearch']}
+            "params": self._search_params(self.param)
         }
-        # print(f"Searching with vector: {search_vecs[0][:5]}... (first 5 dims), k={k}, params={search_params}")
         
         # Ensure collection is loaded (might be redundant if loaded at init and stays loaded)
         # self.col.load() 
         
-        results = self.col.search(
+        results = self._next_col().search(
             data=search_vecs,
             anns_field="vec",
             param=search_params,
             limit=k,
-            expr=None, # No filtering expression for now
+            expr=milvus_expr(f), # 元数据过滤在 Milvus 端完成，只检索满足条件的实体
             output_fields=['id'], # Request 'id' to be returned
-            consistency_level="Strong" # Or other levels like "Bounded", "Eventually"
+            consistency_level=self.consistency_level # conf/milvus.yaml：Strong / Bounded / Session / Eventually
         )
         
-        # print(f"Search raw results: {results}")
-        
-        # Process results for a single query vector input
         # Milvus search returns a list of hit lists, one for each query vector.
-        if not results or not results[0]:
-            return [], []
-
-        hit_list = results[0]
-        result_ids = [hit.id for hit in hit_list]
-        result_distances = [hit.distance for hit in hit_list]
-        
-        # print(f"Search found IDs: {result_ids}, Distances: {result_distances}")
-        return result_ids, result_distances
+        out = []
+        for i in range(len(search_vecs)):
+            hit_list = results[i] if results and i < len(results) else []
+            out.append(([hit.id for hit in hit_list], [hit.distance for hit in hit_list]))
+        return out
 
     def count(self):
         """Returns the number of entities in the collection."""
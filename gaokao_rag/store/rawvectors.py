@@ -0,0 +1,86 @@
+# gaokao_rag/store/rawvectors.py
+"""
+Full-precision side file for quantized FaissStore indexes (`<index_path>.f32`).
+
+Row `label` holds the float32 vector stored under that FAISS label, so the
+candidates of a compressed first pass can be rescored exactly. The file is a
+24-byte header (magic, rows, dim) followed by the row-major matrix; opened with
+mmap, only the rows that are actually rescored are paged in. Labels freed by
+deletes stay as zero rows until the next rebuild.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"GKVECS01"
+_HEADER = 24
+
+
+class RawVectors:
+    def __init__(self, data: np.ndarray, mapped: bool = False):
+        self.data = data            # float32[rows, dim]，np.memmap 或堆内数组
+        self.mapped = mapped
+
+    @classmethod
+    def empty(cls, dim: int) -> "RawVectors":
+        return cls(np.zeros((0, dim), dtype=np.float32))
+
+    @classmethod
+    def open(cls, path, use_mmap: bool = True) -> "RawVectors":
+        with open(path, "rb") as f:
+            header = f.read(_HEADER)
+        if header[:8] != MAGIC:
+            raise ValueError(f"{path} is not a raw vector file (bad magic)")
+        rows, dim = np.frombuffer(header, dtype=np.int64, count=2, offset=8).tolist()
+        if use_mmap and rows:
+            data = np.memmap(path, dtype=np.float32, mode="r", offset=_HEADER, shape=(rows, dim))
+            return cls(data, mapped=True)
+        data = np.fromfile(path, dtype=np.float32, offset=_HEADER, count=rows * dim).reshape(rows, dim)
+        return cls(data)
+
+    def write(self, path):
+        """Atomic write (temp file + rename), like IdTable.write."""
+        path = Path(path)
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(np.array(self.data.shape, dtype=np.int64).tobytes())
+            f.write(np.ascontiguousarray(self.data, dtype=np.float32).tobytes())
+        os.replace(tmp, path)
+
+    def ensure_writable(self):
+        if self.mapped:
+            self.data = np.array(self.data)
+            self.mapped = False
+
+    def put(self, labels, vecs: np.ndarray):
+        """Stores `vecs[i]` at row `labels[i]`, growing the matrix as needed."""
+        self.ensure_writable()
+        labels = np.asarray(labels, dtype=np.int64)
+        if not len(labels):
+            return
+        need = int(labels.max()) + 1
+        if need > len(self.data):
+            grown = np.zeros((max(need, len(self.data) * 5 // 4), self.data.shape[1]), dtype=np.float32)
+            grown[:len(self.data)] = self.data
+            self.data = grown
+        self.data[labels] = vecs
+
+    def get(self, labels) -> np.ndarray:
+        """Rows for `labels` (any shape); labels outside the file (e.g. FAISS's -1) give zero rows."""
+        labels = np.asarray(labels, dtype=np.int64)
+        ok = (labels >= 0) & (labels < len(self.data))
+        out = np.zeros(labels.shape + (self.data.shape[1],), dtype=np.float32)
+        out[ok] = self.data[labels[ok]]
+        return out
+
+    def compact(self, rows: int):
+        """Drops trailing rows beyond `rows` (the next free label) before saving."""
+        if rows < len(self.data):
+            self.ensure_writable()
+            self.data = self.data[:rows].copy()
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.data.size) * 4
@@ -3,60 +3,67 @@ from pathlib import Path
 import numpy as np, pandas as pd, json
 from tqdm import tqdm
 from .cfg import CFG, ROOT
-from .hub import get_model
 from .formula import split
+from .embed import text_dim
+from .parallel_encode import encode_corpus
+from .runtime import RUNTIME
 
 # ---------------- 数据和模型 ----------------
-DATA_FILE = ROOT / "data/df_gk_math.xlsx"
-DF = pd.read_excel(DATA_FILE).set_index("id")
-DF.index = DF.index.astype(str)
-
-_text = get_model("text")
-TEXT_DIM = _text.get_sentence_embedding_dimension()
+# 与 retriever 共用同一份 DataFrame 和 text 模型，首次使用时才加载
+from . import retriever  # noqa: F401  (registers the "df" runtime component)
+DATA_FILE = retriever.DATA_FILE_PATH
 
 def encode_text_only(txt: str):
     rep, _ = split(txt)                 # 去掉公式占位符
-    return _text.encode(rep, normalize_embeddings=True).astype('float32')
+    return RUNTIME.get("text_model").encode(rep, normalize_embeddings=True).astype('float32')
 
 # ---------------- 选后端 ----------------
-if CFG.store_name == "milvus":
-    from .store import milvus as store_module
-    class MilvusText(store_module.MilvusStore):
-        def __init__(self):
-            super().__init__()
-            self.dimension = TEXT_DIM            # ★ 改维度
-        def _create(self, p):
-            p = dict(p)
-            p["collection"] += "_text"  # 独立集合
-            return super()._create(p)
-    STORE = MilvusText()
-else:
+def _create_text_store():
+    dim = text_dim()
+    if CFG.store_name == "milvus":
+        from .store import milvus as store_module
+        class MilvusText(store_module.MilvusStore):
+            def __init__(self):
+                super().__init__()
+                self.dimension = dim                 # ★ 改维度
+            def _create(self, p):
+                p = dict(p)
+                p["collection"] += "_text"  # 独立集合
+                return super()._create(p)
+        return MilvusText()
+
     # text_only.py 选后端里的 else 分支
     from .store import faiss as store_module
     class FaissText(store_module.FaissStore):
         """Text-only (896-dim) FAISS store — 独立文件 faiss_text.bin"""
         def __init__(self):
-            
             # ① 构造一个专属的 param，指向 faiss_text.bin
             path = ROOT / "models/faiss_text.bin"
-            super().__init__(index_path_override=str(path), dimension_override=TEXT_DIM)
+            super().__init__(index_path_override=str(path), dimension_override=dim)
+    return FaissText()
+
+RUNTIME.register("text_store", _create_text_store)
 
+_LAZY = {"DF": "df", "STORE": "text_store"}
 
-    STORE = FaissText()
+def __getattr__(name):
+    if name in _LAZY:
+        return RUNTIME.get(_LAZY[name])
+    if name == "TEXT_DIM":
+        return text_dim()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # ---------------- 构建索引 ----------------
-def build_text_index():
-    ids, vecs = [], []
-    for _id, row in tqdm(DF.iterrows(), total=len(DF), desc="encode(text)"):
-        if pd.isna(row.stem): continue
-        ids.append(str(_id))
-        vecs.append(encode_text_only(str(row.stem)))
-    STORE.build(ids, np.stack(vecs).astype('float32'))
-    print(f"[text-only] index built: {len(ids)} vectors, dim={TEXT_DIM}")
+def build_text_index(workers: int | None = None):
+    stems = RUNTIME.get("df")['stem'].dropna()
+    ids = [str(_id) for _id in stems.index]
+    vecs = encode_corpus([str(s) for s in stems], with_math=False, workers=workers)
+    RUNTIME.get("text_store").build(ids, vecs)
+    print(f"[text-only] index built: {len(ids)} vectors, dim={text_dim()}")
 
 # ---------------- 查询 --------------------
 def query_text_only(stem: str, k: int = 10):
     qv = encode_text_only(stem)
-    cand_ids, _ = STORE.search(qv, k)
+    cand_ids, _ = RUNTIME.get("text_store").search(qv, k)
     if not cand_ids: return []
-    return json.loads(DF.loc[cand_ids].to_json(orient="records", force_ascii=False))
\ No newline at end of file
+    return json.loads(RUNTIME.get("df").loc[cand_ids].to_json(orient="records", force_ascii=False))
\ No newline at end of file
@@ -0,0 +1,143 @@
+# gaokao_rag/versions.py
+"""
+Versioned FAISS index directories with an atomically swapped CURRENT pointer.
+
+build_index / sync_index write a complete index (index file, ID table, meta
+and manifest) into a staging directory, validate it, rename it to the next
+version (`v000001`, `v000002`, ...) and only then replace `CURRENT` via
+os.replace. Serving processes compare CURRENT on each query and open the new
+version (mmap, near instant); queries already running keep the store object
+they started with, and mapped files stay readable even after pruning.
+"""
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import List, Tuple
+
+from .cfg import CFG, ROOT
+
+_VERSION = re.compile(r"^v(\d{6,})$")
+INDEX_FILE = "faiss_index.bin"
+MANIFEST_FILE = "manifest.json"
+
+_pointer_cache: Tuple[tuple, str | None] = ((), None)
+
+
+def _cfg() -> dict:
+    return CFG.store.get("versions", {}) or {}
+
+
+def enabled() -> bool:
+    return CFG.store_name == "faiss" and bool(_cfg().get("enabled", True))
+
+
+def versions_dir() -> Path:
+    base = _cfg().get("dir", "models/index_versions")
+    return Path(base) if os.path.isabs(base) else ROOT / base
+
+
+def _pointer_path() -> Path:
+    return versions_dir() / "CURRENT"
+
+
+def version_path(name: str) -> Path:
+    return versions_dir() / name
+
+
+def index_path(name: str) -> Path:
+    return version_path(name) / INDEX_FILE
+
+
+def list_versions() -> List[str]:
+    d = versions_dir()
+    if not d.exists():
+        return []
+    return sorted((p.name for p in d.iterdir() if p.is_dir() and _VERSION.match(p.name)),
+                  key=lambda n: int(_VERSION.match(n).group(1)))
+
+
+def current_version() -> str | None:
+    """Published version name; re-read only when the pointer file changed."""
+    global _pointer_cache
+    try:
+        st = _pointer_path().stat()
+    except OSError:
+        return None
+    stamp = (st.st_ino, st.st_mtime_ns)     # os.replace 总会换一个 inode
+    if stamp != _pointer_cache[0]:
+        name = _pointer_path().read_text(encoding="utf-8").strip() or None
+        _pointer_cache = (stamp, name)
+    return _pointer_cache[1]
+
+
+def new_staging_dir() -> Path:
+    d = versions_dir() / f".staging-{os.getpid()}-{os.urandom(4).hex()}"
+    d.mkdir(parents=True)
+    return d
+
+
+def discard(staging: Path):
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def _next_name() -> str:
+    existing = list_versions()
+    n = int(_VERSION.match(existing[-1]).group(1)) + 1 if existing else 1
+    return f"v{n:06d}"
+
+
+def set_current(name: str):
+    if not version_path(name).is_dir():
+        raise FileNotFoundError(f"Index version '{name}' does not exist in {versions_dir()}")
+    tmp = _pointer_path().with_name(f"CURRENT.tmp-{os.getpid()}")
+    tmp.write_text(name, encoding="utf-8")
+    os.replace(tmp, _pointer_path())
+    print(f"[versions] CURRENT → {name}")
+
+
+def publish(staging: Path) -> str:
+    """Renames a validated staging directory to the next version and points CURRENT at it."""
+    for _ in range(5):
+        name = _next_name()
+        try:
+            os.rename(staging, version_path(name))
+            break
+        except OSError:
+            if not version_path(name).exists():
+                raise   # 不是“同名版本已被另一进程发布”的冲突
+    else:
+        raise RuntimeError(f"Could not allocate a version name in {versions_dir()}")
+    set_current(name)
+    prune()
+    return name
+
+
+def rollback(to: str | None = None) -> str:
+    """Points CURRENT at `to`, or at the version published before the current one."""
+    if to is None:
+        names, cur = list_versions(), current_version()
+        older = [n for n in names if cur is None or int(n[1:]) < int(cur[1:])]
+        if not older:
+            raise RuntimeError(f"No version older than {cur} to roll back to.")
+        to = older[-1]
+    set_current(to)
+    return to
+
+
+def prune(keep: int | None = None) -> List[str]:
+    """Deletes all but the newest `keep` versions (never the current one)."""
+    keep = int(_cfg().get("keep", 3) if keep is None else keep)
+    cur = current_version()
+    names = list_versions()
+    doomed = [n for n in names[:max(len(names) - keep, 0)] if n != cur]
+    for n in doomed:
+        shutil.rmtree(version_path(n), ignore_errors=True)
+    if doomed:
+        print(f"[versions] pruned {', '.join(doomed)}")
+    return doomed
+
+
+def status() -> dict:
+    return {"enabled": enabled(), "dir": str(versions_dir()),
+            "current": current_version(), "versions": list_versions()}
@@ -0,0 +1,43 @@
+# tests/conftest.py
+"""
+Shared fixtures. Nothing here needs torch or the real models: FAISS stores are
+built from random unit vectors, and the retriever tests use the numpy stand-in
+encoders of gaokao_rag.bench.
+"""
+import copy
+
+import numpy as np
+import pytest
+
+from gaokao_rag.cfg import CFG
+
+DIM = 32
+
+
+def unit_vectors(n: int, dim: int = DIM, seed: int = 0) -> np.ndarray:
+    v = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def store_conf(monkeypatch, tmp_path):
+    """conf/faiss.yaml for one test, with the index under tmp_path; returns the (mutable) dict."""
+    conf = copy.deepcopy(CFG.store)
+    conf["index_path"] = str(tmp_path / "faiss_index.bin")
+    conf["versions"] = {**(conf.get("versions") or {}), "dir": str(tmp_path / "versions")}
+    monkeypatch.setattr(CFG, "store", conf)
+    return conf
+
+
+@pytest.fixture
+def make_store(store_conf):
+    """make_store(factory, quant="none", **store_kwargs) → FaissStore on the test's index path."""
+    from gaokao_rag.store.faiss import FaissStore
+
+    def make(factory: str = "Flat", quant: str = "none", **kwargs):
+        store_conf["index"] = {**(store_conf.get("index") or {}), "factory": factory,
+                               "params": {"efConstruction": 64, "efSearch": 128, "nprobe": 16}}
+        store_conf["quantization"] = {"mode": quant, "oversample": 4}
+        return FaissStore(dimension_override=DIM, **kwargs)
+
+    return make
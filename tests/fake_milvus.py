@@ -0,0 +1,157 @@
+# tests/fake_milvus.py
+"""
+In-memory stand-in for the parts of pymilvus that MilvusStore uses
+(connections, utility, Collection). Collections of the same name share one
+`Server` entry, as the pooled connections of a real server would. Every call
+is appended to `Server.log`. Inserts sleep briefly, so the tests can see how
+many requests overlap (`Server.max_in_flight`). Search is exact inner product,
+and `expr` is evaluated for the forms that filters.milvus_expr and
+MilvusStore._ids_expr produce.
+"""
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+_CLAUSE = re.compile(r"^(?:(\w+) (>=|<=|!=) (\S+)|array_contains_any\((\w+), (.*)\)|(\w+) in (\[.*\]))$")
+
+
+def _matches(row: dict, expr: str | None) -> bool:
+    for clause in (expr.split(" and ") if expr else ()):
+        m = _CLAUSE.match(clause.strip())
+        if m is None:
+            raise ValueError(f"fake Milvus cannot evaluate '{clause}'")
+        field, op, value, arr_field, arr_values, in_field, in_values = m.groups()
+        if field:
+            v, x = row[field], float(value)
+            if not {">=": v >= x, "<=": v <= x, "!=": v != x}[op]:
+                return False
+        elif arr_field:
+            if not set(row[arr_field]) & set(json.loads(arr_values)):
+                return False
+        elif row[in_field] not in json.loads(in_values):
+            return False
+    return True
+
+
+class Server:
+    collections: dict = {}
+    log: list = []
+    in_flight = 0
+    max_in_flight = 0
+    insert_delay = 0.01
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls):
+        cls.collections, cls.log = {}, []
+        cls.in_flight = cls.max_in_flight = 0
+
+    @classmethod
+    def record(cls, *event):
+        with cls.lock:
+            cls.log.append(event)
+
+
+class _Connections:
+    def connect(self, alias="default", host=None, port=None, **_):
+        Server.record("connect", alias)
+
+
+class _Utility:
+    def has_collection(self, name, using="default"):
+        return name in Server.collections
+
+    def drop_collection(self, name, using="default"):
+        Server.collections.pop(name, None)
+
+
+class _Index:
+    def __init__(self, state, field):
+        self.state, self.field_name = state, field
+
+    def drop(self):
+        Server.record("drop_index", self.field_name)
+        self.state["indexes"].pop(self.field_name, None)
+
+
+class Collection:
+    def __init__(self, name, schema=None, using="default", **_):
+        if schema is not None:
+            Server.collections[name] = {"schema": schema, "rows": {}, "indexes": {}}
+        self.name, self.using = name, using
+        self.state = Server.collections[name]
+
+    @property
+    def schema(self):
+        return self.state["schema"]
+
+    @property
+    def indexes(self):
+        return [_Index(self.state, f) for f in self.state["indexes"]]
+
+    @property
+    def num_entities(self):
+        return len(self.state["rows"])
+
+    def create_index(self, field_name, index_params=None, **_):
+        Server.record("create_index", field_name)
+        self.state["indexes"][field_name] = index_params
+
+    def load(self):
+        Server.record("load")
+
+    def release(self):
+        Server.record("release")
+
+    def flush(self):
+        Server.record("flush")
+
+    def _write(self, op, data):
+        with Server.lock:
+            Server.in_flight += 1
+            Server.max_in_flight = max(Server.max_in_flight, Server.in_flight)
+        try:
+            time.sleep(Server.insert_delay)
+            names = [f.name for f in self.schema.fields]
+            for values in zip(*data):
+                row = dict(zip(names, values))
+                self.state["rows"][row["id"]] = row
+        finally:
+            with Server.lock:
+                Server.in_flight -= 1
+        Server.record(op, len(data[0]), self.using)
+        return SimpleNamespace(insert_count=len(data[0]))
+
+    def insert(self, data):
+        return self._write("insert", data)
+
+    def upsert(self, data):
+        return self._write("upsert", data)
+
+    def delete(self, expr):
+        gone = [k for k, row in self.state["rows"].items() if _matches(row, expr)]
+        for k in gone:
+            del self.state["rows"][k]
+        Server.record("delete", len(gone))
+        return SimpleNamespace(delete_count=len(gone))
+
+    def search(self, data, anns_field, param, limit, expr=None, output_fields=None, consistency_level=None):
+        Server.record("search", expr, consistency_level)
+        rows = [r for r in self.state["rows"].values() if _matches(r, expr)]
+        if not rows:
+            return [[] for _ in data]
+        mat = np.asarray([r[anns_field] for r in rows], dtype=np.float32)
+        out = []
+        for q in np.asarray(data, dtype=np.float32):
+            scores = mat @ q
+            order = np.argsort(-scores, kind="stable")[:limit]
+            out.append([SimpleNamespace(id=rows[i]["id"], distance=float(scores[i])) for i in order])
+        return out
+
+
+connections = _Connections()
+utility = _Utility()
@@ -0,0 +1,36 @@
+# tests/test_api_admin.py
+"""Admin endpoints refuse requests without the admin token."""
+import pytest
+
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+from gaokao_rag import api
+
+ADMIN = [("post", "/import"), ("post", "/sync"), ("post", "/warmup"), ("post", "/models/unload")]
+
+
+@pytest.fixture
+def client():
+    return TestClient(api.app)
+
+
+@pytest.mark.parametrize("method,path", ADMIN)
+def test_admin_endpoints_are_closed_without_a_configured_token(client, monkeypatch, method, path):
+    monkeypatch.delenv("GAOKAO_ADMIN_TOKEN", raising=False)
+    monkeypatch.setitem(api.CFG.base, "profiling", {"admin_token": ""})
+    assert getattr(client, method)(path, headers={"X-Admin-Token": ""}).status_code == 403
+
+
+@pytest.mark.parametrize("method,path", ADMIN)
+def test_admin_endpoints_need_the_right_token(client, monkeypatch, method, path):
+    monkeypatch.setenv("GAOKAO_ADMIN_TOKEN", "s3cret")
+    assert getattr(client, method)(path).status_code == 403
+    assert getattr(client, method)(path, headers={"X-Admin-Token": "wrong"}).status_code == 403
+
+
+def test_unload_with_token(client, monkeypatch):
+    monkeypatch.setenv("GAOKAO_ADMIN_TOKEN", "s3cret")
+    resp = client.post("/models/unload", headers={"X-Admin-Token": "s3cret"})
+    assert resp.status_code == 200
+    assert "unloaded" in resp.json()
@@ -0,0 +1,12 @@
+# tests/test_bench.py
+"""ragmath bench runs end to end with the stand-in models and leaves nothing behind."""
+from gaokao_rag import bench
+
+
+def test_bench_smoke(tmp_path):
+    work = tmp_path / "bench"
+    report = bench.run(size=200, queries=10, k=5, http=False, workdir=str(work))
+    assert report["build_index"]["factory"] == "Flat"
+    assert report["recall"]["recall_at_k"] == 1.0
+    assert set(report["query"]["latency_ms"]) >= {"encode", "search", "rerank", "scoring", "total"}
+    assert not work.exists()
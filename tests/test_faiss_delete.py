@@ -0,0 +1,93 @@
+# tests/test_faiss_delete.py
+"""Delete / upsert keep labels and vectors in step for every index type."""
+import pytest
+
+from conftest import unit_vectors
+
+# nprobe = nlist: IVF 检索是穷举的，自查询必须命中自己
+FACTORIES = ["Flat", "HNSW16", "IVF16,Flat", "IVF16,PQ8x4"]
+N = 2000
+
+
+def _self_hits(store, ids, vecs, k=1):
+    results = store.search_batch(vecs, k)
+    return sum(item_id in found for item_id, (found, _) in zip(ids, results))
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+def test_delete_then_search(make_store, factory):
+    ids = [f"id{i}" for i in range(N)]
+    vecs = unit_vectors(N)
+    store = make_store(factory)
+    store.build(ids, vecs)
+
+    assert store.delete(["id3", "id4"]) == 2
+    assert store.count() == N - 2
+    keep = [i for i in range(N) if i not in (3, 4)]
+    kept_ids = [ids[i] for i in keep]
+    # PQ 是有损压缩，只要求自身在前 10 个里
+    k = 10 if "PQ" in factory else 1
+    assert _self_hits(store, kept_ids, vecs[keep], k) >= 0.99 * len(keep)
+    found, _ = store.search(vecs[3], 10)
+    assert "id3" not in found
+
+    # 再次增删 (旧实现在 IVF 上此处触发 FAISS 断言而崩溃)
+    store.upsert(["id3", "id5"], vecs[[3, 5]])
+    store.delete(["id6"])
+    assert store.count() == N - 2
+    assert "id3" in store.search(vecs[3], k)[0]
+    assert "id6" not in store.search(vecs[6], 10)[0]
+
+
+@pytest.mark.parametrize("factory", FACTORIES)
+def test_delete_survives_reload(make_store, factory):
+    ids = [f"id{i}" for i in range(N)]
+    vecs = unit_vectors(N, seed=1)
+    make_store(factory).build(ids, vecs)
+
+    store = make_store(factory)            # mmap 加载，第一次删除前复制到堆内
+    store.delete(["id0"])
+    store.upsert(["id0"], vecs[[0]])
+
+    reloaded = make_store(factory)
+    assert reloaded.count() == N
+    k = 10 if "PQ" in factory else 1
+    assert _self_hits(reloaded, ids[:200], vecs[:200], k) >= 198
+
+
+def test_legacy_idmap_wrapped_ivf_is_relabelled(make_store):
+    """IVF indexes saved by earlier versions are IndexIDMap2(IVF); the first mutation converts them."""
+    import faiss
+    import numpy as np
+
+    ids = [f"id{i}" for i in range(N)]
+    vecs = unit_vectors(N, seed=2)
+    store = make_store("IVF16,Flat")
+    base = faiss.index_factory(vecs.shape[1], "IVF16,Flat", faiss.METRIC_INNER_PRODUCT)
+    base.train(vecs)
+    store.index = faiss.IndexIDMap2(base)
+    store.index.add_with_ids(vecs, np.arange(N, dtype=np.int64))
+    store._set_id_map(list(enumerate(ids)))
+    store._apply_search_params(store.index)
+
+    store.delete(["id3", "id4"])
+    assert isinstance(store.index, faiss.IndexIVF)
+    keep = [i for i in range(N) if i not in (3, 4)]
+    assert _self_hits(store, [ids[i] for i in keep], vecs[keep]) == len(keep)
+    store.upsert(["id3"], vecs[[3]])
+    assert store.search(vecs[3], 1)[0] == ["id3"]
+
+
+def test_upsert_without_attrs_keeps_filter_attributes(make_store):
+    ids = [f"id{i}" for i in range(100)]
+    vecs = unit_vectors(100, seed=3)
+    attrs = {"difficulty": [0.5] * 100, "year": [[2020]] * 100, "topic": [["数列"]] * 100}
+    store = make_store("Flat")
+    store.build(ids, vecs, attrs)
+
+    store.upsert(["id7"], vecs[[7]])                   # 只换向量，属性沿用
+    spec = {"difficulty": [0.4, 0.6], "year": [2020], "topic": ["数列"]}
+    assert "id7" in store.search(vecs[7], 5, filters=spec)[0]
+
+    store.upsert(["id7"], vecs[[7]], {"difficulty": [0.9], "year": [[2021]], "topic": [["函数"]]})
+    assert "id7" not in store.search(vecs[7], 5, filters=spec)[0]
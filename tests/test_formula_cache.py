@@ -0,0 +1,81 @@
+# tests/test_formula_cache.py
+"""FormulaCache: one reader connection, write-behind, WAL."""
+import sqlite3
+
+import numpy as np
+import pytest
+
+from gaokao_rag import cache
+from gaokao_rag.cache import EmbedCache, FormulaCache
+from gaokao_rag.cfg import CFG
+
+DIM = 8
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = tmp_path / "embed_cache.sqlite"
+    monkeypatch.setattr(CFG, "cache", {**CFG.cache, "path": str(path)})
+    return path
+
+
+class Encoder:
+    def __init__(self):
+        self.seen = []
+
+    def __call__(self, formulas):
+        self.seen += formulas
+        return np.stack([np.full(DIM, len(f), dtype=np.float32) for f in formulas])
+
+
+def test_new_formulas_are_written_behind_and_found_by_the_next_process(db):
+    enc = Encoder()
+    fc = FormulaCache(persist=True)
+    out = fc.encode(["x^2", "x^{2}", "\\frac{1}{2}"], enc, DIM)
+    assert out.shape == (3, DIM)
+    assert len(enc.seen) == 2                  # x^2 与 x^{2} 规范化后是同一个公式
+    fc.flush()
+
+    enc2 = Encoder()
+    fresh = FormulaCache(persist=True)         # 空 LRU，只能从 SQLite 命中
+    np.testing.assert_array_equal(fresh.encode(["x^2", "\\frac{1}{2}"], enc2, DIM), out[[0, 2]])
+    assert enc2.seen == [] and fresh.disk_hits == 2
+
+
+def test_one_reader_connection_per_cache(db, monkeypatch):
+    opened = []
+    real = cache._connect
+    monkeypatch.setattr(cache, "_connect", lambda p: opened.append(p) or real(p))
+    fc = FormulaCache(persist=True)
+    for i in range(20):
+        fc.encode([f"a_{{{i}}}+b"], Encoder(), DIM)
+    fc.flush()
+    assert len(opened) == 2                    # 一个读连接 + 写线程的一个连接
+
+
+def test_stale_purge_runs_once_per_process(db):
+    EmbedCache("formula").close()
+    conn = sqlite3.connect(str(db))
+    conn.execute("INSERT INTO emb VALUES ('k', 'formula', 'old-model', 1, ?, 0)", (np.zeros(1, np.float32).tobytes(),))
+    conn.commit()
+    EmbedCache("formula").close()              # 同一进程再次打开不再清理
+    assert conn.execute("SELECT COUNT(*) FROM emb WHERE model_key = 'old-model'").fetchone()[0] == 1
+    conn.close()
+
+
+def test_reads_do_not_block_on_a_concurrent_writer(db):
+    fc = FormulaCache(persist=True)
+    fc.encode(["y=kx+b"], Encoder(), DIM)
+    fc.flush()
+    assert sqlite3.connect(str(db)).execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    writer = sqlite3.connect(str(db), timeout=0)
+    writer.execute("BEGIN IMMEDIATE")          # 例如另一进程正在 import
+    writer.execute("DELETE FROM emb WHERE ns = 'nothing'")
+    fresh = FormulaCache(persist=True)
+    enc = Encoder()
+    fresh.encode(["y=kx+b"], enc, DIM)
+    assert enc.seen == []
+    writer.rollback()
+    writer.close()
+    fresh.flush()
@@ -0,0 +1,95 @@
+# tests/test_ingest.py
+"""Streaming ingest: batched saves, checkpoints only after a save, per-row rejects."""
+import json
+
+import numpy as np
+import pytest
+
+from gaokao_rag import bench, ingest, snapshot
+from gaokao_rag.cfg import CFG
+from gaokao_rag.store.faiss import FaissStore
+
+N, CHUNK = 600, 50
+
+
+@pytest.fixture
+def work(tmp_path):
+    with bench.workspace(tmp_path):
+        from gaokao_rag import retriever
+        bench.synthetic_corpus(N, seed=3).to_excel(retriever.DATA_FILE_PATH, index=False)
+        CFG.base["ingest"] = {"chunk_rows": CHUNK, "save_every": 3, "save_growth": 0.25,
+                              "reject_file": str(tmp_path / "rejects.jsonl")}
+        yield tmp_path
+
+
+def _count_saves(monkeypatch, checkpoints):
+    saves = []
+    real_save, real_ckpt = FaissStore.save, ingest._write_checkpoint
+
+    def save(self):
+        saves.append(self.count())
+        real_save(self)
+
+    def write_checkpoint(staging, ckpt):
+        checkpoints.append((len(saves), ckpt["accepted"]))
+        real_ckpt(staging, ckpt)
+
+    monkeypatch.setattr(FaissStore, "save", save)
+    monkeypatch.setattr(ingest, "_write_checkpoint", write_checkpoint)
+    return saves
+
+
+def test_saves_are_batched_and_checkpoint_follows_save(work, monkeypatch):
+    checkpoints = []
+    saves = _count_saves(monkeypatch, checkpoints)
+    report = ingest.ingest()
+    assert report["indexed"] == N and report["rejected"] == 0
+    assert len(saves) < N // CHUNK
+    # 每个检查点都紧跟一次保存，且检查点记录的行数正是已保存的行数
+    assert [n for n, _ in checkpoints] == list(range(1, len(saves) + 1))
+    assert [a for _, a in checkpoints] == saves
+
+
+def test_resume_after_crash(work, monkeypatch):
+    real_iter = snapshot.iter_chunks
+
+    def crashing(*args, **kwargs):
+        for n, item in enumerate(real_iter(*args, **kwargs)):
+            if n == 7:
+                raise KeyboardInterrupt
+            yield item
+
+    monkeypatch.setattr(snapshot, "iter_chunks", crashing)
+    with pytest.raises(KeyboardInterrupt):
+        ingest.ingest()
+    ckpt = json.loads((ingest.staging_dir() / ingest.CHECKPOINT).read_text(encoding="utf-8"))
+    assert 0 < ckpt["rows_done"] < 7 * CHUNK
+
+    monkeypatch.setattr(snapshot, "iter_chunks", real_iter)
+    report = ingest.ingest()
+    assert report["indexed"] == N
+    from gaokao_rag.runtime import RUNTIME
+    assert RUNTIME.get("store").count() == N
+
+
+def test_wrong_dimension_rejects_only_that_row(work, monkeypatch):
+    from gaokao_rag import retriever
+    df = bench.synthetic_corpus(N, seed=3)
+    bad = str(df["id"][10])
+    df.loc[10, "stem"] = "BAD " + df.loc[10, "stem"]
+    df.to_excel(retriever.DATA_FILE_PATH, index=False)
+    real = ingest.encode_cached
+
+    def encode(stems, batch_size=64):
+        if any(s.startswith("BAD") for s in stems):
+            if len(stems) > 1:
+                raise ValueError("inhomogeneous shape")
+            return np.zeros((1, CFG.embed_dim + 1), dtype=np.float32)
+        return real(stems, batch_size=batch_size)
+
+    monkeypatch.setattr(ingest, "encode_cached", encode)
+    report = ingest.ingest()
+    assert report["indexed"] == N - 1 and report["rejected"] == 1
+    rejects = [json.loads(line) for line in open(report["reject_file"], encoding="utf-8")]
+    assert [r["id"] for r in rejects] == [bad]
+    assert rejects[0]["reason"].startswith("dimension")
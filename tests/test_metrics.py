@@ -0,0 +1,21 @@
+# tests/test_metrics.py
+"""metrics.enabled: false leaves no timing on the query path, slow-query log included."""
+from gaokao_rag import metrics, slowlog
+
+
+def test_disabled_metrics_turn_off_the_slow_log(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    assert not slowlog.enabled()
+    with slowlog.watch("query", ["x^2"], 5) as trace:
+        assert trace is None
+        assert metrics.span("query", "encode") is metrics._NOOP
+
+    # 剖析请求自带 Trace：仍然计时
+    outer = metrics.Trace()
+    token = metrics.TRACE.set(outer)
+    try:
+        with slowlog.watch("query", ["x^2"], 5) as trace:
+            assert trace is outer
+            assert metrics.span("query", "encode") is not metrics._NOOP
+    finally:
+        metrics.TRACE.reset(token)
@@ -0,0 +1,119 @@
+# tests/test_milvus_store.py
+"""MilvusStore write pipeline and filtered search, against the in-memory stand-in in fake_milvus.py."""
+import numpy as np
+import pytest
+
+import fake_milvus
+from conftest import unit_vectors
+from fake_milvus import Server
+from gaokao_rag.cfg import CFG, ROOT, _load_yaml
+from gaokao_rag.filters import milvus_expr, normalize
+from gaokao_rag.store import milvus
+
+DIM = 16
+
+
+@pytest.fixture
+def conf(monkeypatch):
+    Server.reset()
+    for name in ("connections", "utility", "Collection"):
+        monkeypatch.setattr(milvus, name, getattr(fake_milvus, name))
+    conf = _load_yaml(ROOT / "conf/milvus.yaml")
+    conf["collection"] = "test_collection"
+    monkeypatch.setattr(CFG, "store", conf)
+    monkeypatch.setattr(CFG, "embed_dim", DIM)
+    return conf
+
+
+def _data(n, seed=0):
+    ids = [f"q{i}" for i in range(n)]
+    attrs = {"difficulty": np.linspace(0.1, 0.9, n),
+             "year": [[2018 + i % 5] for i in range(n)],
+             "topic": [["数列"] if i % 2 else ["函数", "10873"] for i in range(n)]}
+    return ids, unit_vectors(n, DIM, seed), attrs
+
+
+def _events(*names):
+    return [e for e in Server.log if e[0] in names]
+
+
+def test_default_consistency_is_strong(conf):
+    store = milvus.MilvusStore()
+    assert store.consistency_level == "Strong"
+    ids, vecs, attrs = _data(10)
+    store.build(ids, vecs, attrs)
+    store.search(vecs[0], 3)
+    assert _events("search")[-1][2] == "Strong"
+
+
+def test_writes_are_chunked(conf):
+    conf["insert"] = {"batch_size": 100, "max_in_flight": 2}
+    store = milvus.MilvusStore()
+    ids, vecs, attrs = _data(1050)
+    store.build(ids, vecs, attrs)
+    assert sorted(e[1] for e in _events("insert")) == [50] + [100] * 10
+    assert store.count() == 1050
+
+
+def test_requests_in_flight_are_bounded(conf):
+    conf["insert"] = {"batch_size": 50, "max_in_flight": 3}
+    conf["pool_size"] = 4
+    store = milvus.MilvusStore()
+    ids, vecs, attrs = _data(1000)
+    store.upsert(ids, vecs, attrs)
+    assert 1 < Server.max_in_flight <= 3
+    # 分块轮流使用连接池中的各个连接
+    assert {e[2] for e in _events("upsert")} == set(store.aliases)
+
+
+def test_build_flushes_once(conf):
+    conf["insert"] = {"batch_size": 100, "max_in_flight": 4, "flush": "end"}
+    store = milvus.MilvusStore()
+    ids, vecs, attrs = _data(500)
+    store.build(ids, vecs, attrs)
+    assert len(_events("insert")) == 5
+    assert len(_events("flush")) == 1
+
+    # flush: each → 旧行为，每次写入后 flush
+    conf["insert"]["flush"] = "each"
+    store = milvus.MilvusStore()
+    store.add(ids[:10], vecs[:10], attrs=None)
+    store.delete(ids[:5])
+    assert len(_events("flush")) == 3
+
+
+def test_index_after_load_order(conf):
+    conf["insert"] = {"batch_size": 100, "max_in_flight": 2}
+    conf["index_after_load"] = True
+    store = milvus.MilvusStore()
+    start = len(Server.log)
+    ids, vecs, attrs = _data(300)
+    store.build(ids, vecs, attrs)
+
+    steps = []
+    for event in Server.log[start:]:
+        if event[0] in ("release", "drop_index", "insert", "flush", "create_index", "load") \
+                and (not steps or steps[-1] != event[0]):
+            steps.append(event[0])
+    assert steps == ["release", "drop_index", "insert", "flush", "create_index", "load"]
+    assert {e[1] for e in _events("drop_index")} == {"vec", "difficulty", "year", "topic"}
+
+
+def test_filters_are_pushed_down_as_expr(conf):
+    store = milvus.MilvusStore()
+    ids, vecs, attrs = _data(200)
+    store.build(ids, vecs, attrs)
+    spec = {"difficulty": [0.3, 0.6], "year": [2019, 2021], "topic": ["数列"]}
+
+    found, _ = store.search(vecs[0], 50, filters=spec)
+    expr = _events("search")[-1][1]
+    assert expr == milvus_expr(normalize(spec))
+    assert found
+    for item_id in found:
+        j = ids.index(item_id)
+        assert 0.3 <= attrs["difficulty"][j] <= 0.6
+        assert attrs["year"][j][0] in (2019, 2021) and "数列" in attrs["topic"][j]
+
+    # 没有标量字段的旧集合：过滤查询返回空结果
+    store.has_attrs = False
+    assert store.search(vecs[0], 5, filters=spec) == ([], [])
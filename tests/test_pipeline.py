@@ -0,0 +1,102 @@
+# tests/test_pipeline.py
+"""
+Build → query → sync (delete / edit / add) → reload on the synthetic corpus of
+ragmath bench, with its numpy stand-in encoders, for every index type and
+storage mode.
+"""
+import pandas as pd
+import pytest
+
+from gaokao_rag import bench
+from gaokao_rag.cfg import CFG
+
+N = 400
+FACTORIES = ["Flat", "HNSW16", "IVF8,Flat"]
+QUANTS = ["none", "fp16", "int8", "binary"]
+
+
+@pytest.fixture
+def pipeline(tmp_path, request):
+    factory, quant = request.param
+    with bench.workspace(tmp_path, factory=factory):
+        from gaokao_rag import retriever
+        from gaokao_rag.runtime import RUNTIME
+        CFG.store["quantization"] = {"mode": quant, "oversample": 8}
+        CFG.store["index"]["params"] = {"efConstruction": 64, "efSearch": 128, "nprobe": 8}
+        CFG.base["neardup"]["enabled"] = False      # 原题也要走向量检索
+        corpus = bench.synthetic_corpus(N, seed=5)
+        corpus.to_excel(retriever.DATA_FILE_PATH, index=False)
+        retriever.load_dataframe()
+        retriever.build_index()
+        yield retriever, RUNTIME, corpus
+
+
+def _top_ids(retriever, stem, k=5, filters=None):
+    return [r["id"] for r in retriever.query(stem, k, filters, cache=False)]
+
+
+def _hit_rate(retriever, corpus, rows):
+    return sum(str(corpus["id"][j]) == (_top_ids(retriever, corpus["stem"][j], 1) or [None])[0]
+               for j in rows) / len(rows)
+
+
+@pytest.mark.parametrize("pipeline", [(f, q) for f in FACTORIES for q in QUANTS], indirect=True,
+                         ids=lambda p: f"{p[0]}-{p[1]}")
+def test_build_sync_delete_query(pipeline):
+    retriever, runtime, corpus = pipeline
+    store = runtime.get("store")
+    assert store.count() == N
+    assert store.quant_in_use == CFG.store["quantization"]["mode"]
+    assert _hit_rate(retriever, corpus, range(0, N, 20)) >= 0.9
+
+    # 删 10 行、改 1 道题干、加 20 道新题，然后增量同步
+    deleted = [str(i) for i in corpus["id"][:10]]
+    edited = corpus.iloc[10:].copy()
+    edited.loc[10, "stem"] = "改写后的题干：" + edited.loc[10, "stem"]
+    extra = bench.synthetic_corpus(20, seed=6, start_id=int(corpus["id"].max()) + 1)
+    updated = pd.concat([edited, extra], ignore_index=True)
+    updated.to_excel(retriever.DATA_FILE_PATH, index=False)
+    retriever.sync_index()
+
+    store = runtime.get("store")
+    assert store.count() == N - 10 + 20
+    for j in range(10):
+        assert not set(deleted) & set(_top_ids(retriever, corpus["stem"][j], 10))
+    assert _top_ids(retriever, updated["stem"][0], 1) == [str(updated["id"][0])]
+    assert _hit_rate(retriever, updated, range(len(updated) - 20, len(updated))) >= 0.9
+
+    # 重新加载 (mmap) 后结果不变
+    runtime.invalidate("store")
+    assert runtime.get("store").count() == N + 10
+    assert _hit_rate(retriever, updated, range(0, len(updated), 25)) >= 0.9
+
+    # 过滤：所有结果都满足条件
+    lo, hi = 0.4, 0.7
+    for r in retriever.query(updated["stem"][3], 10, {"difficulty": [lo, hi]}, cache=False):
+        row = updated[updated["id"].astype(str) == r["id"]]
+        assert lo <= float(row["difficulty"].iloc[0]) <= hi
+
+
+def test_near_duplicate_fast_path(tmp_path):
+    with bench.workspace(tmp_path, factory="Flat"):
+        from gaokao_rag import neardup, retriever
+        CFG.base["neardup"].update({"enabled": True, "neighbours": 5})
+        corpus = bench.synthetic_corpus(N, seed=5)
+        corpus.to_excel(retriever.DATA_FILE_PATH, index=False)
+        retriever.load_dataframe()
+        retriever.build_index()
+        stem, pid = corpus["stem"][7], str(corpus["id"][7])
+
+        # 原题固定排第 1 (score 1.0)，近邻按 ANN 相似度降序
+        hits = neardup.STATS["hits"]
+        res = retriever.query(stem, 6, cache=False)
+        assert neardup.STATS["hits"] == hits + 1
+        assert res[0] == {"id": pid, "stem": res[0]["stem"], "score": 1.0}
+        scores = [r["score"] for r in res[1:]]
+        assert len(res) == 6 and scores == sorted(scores, reverse=True)
+        assert all(0.0 <= s <= 1.0 for s in scores)
+
+        # k 超过 1 + neighbours：走正常检索，返回满 k 条
+        res = retriever.query(stem, 10, cache=False)
+        assert neardup.STATS["hits"] == hits + 1
+        assert len(res) == 10 and res[0]["id"] == pid